@@ -0,0 +1,255 @@
+from __future__ import annotations
+
+import math
+
+import faiss
+import numpy as np
+
+from config import (
+    ANN_EF_SEARCH,
+    ANN_HNSW_MIN,
+    ANN_IVF_MIN,
+    ANN_NPROBE,
+    ANN_PQ_MIN,
+    ANN_TRAIN_SAMPLE,
+    INDEX_TYPE,
+)
+
+INDEX_TYPES = ("flat", "hnsw", "ivf", "ivfpq", "opq")
+
+_HNSW_M = 32
+# Points per centroid faiss wants for training
+_MIN_POINTS_PER_CENTROID = 39
+_PQ_CENTROIDS = 256
+
+
+def _nlist(n: int) -> int:
+    """Amount of IVF lists for a corpus of n vectors."""
+    return max(1, min(65536, int(4 * math.sqrt(n))))
+
+
+def _pq_m(dim: int) -> int:
+    """Amount of PQ sub-quantizers, about 16 dimensions per code byte."""
+    for m in (dim // 16, 64, 48, 32, 24, 16, 8, 4, 2, 1):
+        if 0 < m <= dim and dim % m == 0:
+            return m
+    return 1
+
+
+def _min_train_points(kind: str, n: int) -> int:
+    if kind == "ivf":
+        return _nlist(n) * _MIN_POINTS_PER_CENTROID
+    if kind in ("ivfpq", "opq"):
+        return max(_nlist(n), _PQ_CENTROIDS) * _MIN_POINTS_PER_CENTROID
+    return 0
+
+
+def choose_index_type(n: int, kind: str = INDEX_TYPE) -> str:
+    """Pick the index type for a corpus of n vectors.
+
+    Types that need training fall back to flat until there are enough
+    vectors to train them.
+    """
+    if kind == "auto":
+        if n >= ANN_PQ_MIN:
+            kind = "opq"
+        elif n >= ANN_IVF_MIN:
+            kind = "ivf"
+        elif n >= ANN_HNSW_MIN:
+            kind = "hnsw"
+        else:
+            kind = "flat"
+    if kind not in INDEX_TYPES:
+        raise ValueError(
+            f"Unknown index type '{kind}', expected auto or one of "
+            f"{', '.join(INDEX_TYPES)}"
+        )
+    if n < _min_train_points(kind, n):
+        return "flat"
+    return kind
+
+
+def _unwrap(index: faiss.Index) -> faiss.Index:
+    """Return the index inside an id map, or the index itself."""
+    index = faiss.downcast_index(index)
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return faiss.downcast_index(index.index)
+    return index
+
+
+def _ivf(index: faiss.Index) -> faiss.IndexIVF | None:
+    try:
+        return faiss.extract_index_ivf(index)
+    except RuntimeError:
+        return None
+
+
+def index_type(index: faiss.Index) -> str:
+    """Return the type name of an index."""
+    index = _unwrap(index)
+    if isinstance(index, faiss.IndexPreTransform):
+        return "opq"
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivfpq"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf"
+    return "flat"
+
+
+def make_index(kind: str, dim: int, vecs: np.ndarray) -> faiss.Index:
+    """Create an empty index of a type, trained on vecs when needed.
+
+    Vectors are added with the labels of their chunks. IVF indexes store
+    the labels themselves, flat and HNSW indexes are wrapped in an id map.
+    """
+    n = len(vecs)
+    if kind == "flat":
+        return faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+    if kind == "hnsw":
+        desc = f"HNSW{_HNSW_M}"
+    elif kind == "ivf":
+        desc = f"IVF{_nlist(n)},Flat"
+    elif kind == "ivfpq":
+        desc = f"IVF{_nlist(n)},PQ{_pq_m(dim)}"
+    elif kind == "opq":
+        m = _pq_m(dim)
+        desc = f"OPQ{m},IVF{_nlist(n)},PQ{m}"
+    else:
+        raise ValueError(f"Unknown index type '{kind}'")
+
+    index = faiss.index_factory(dim, desc, faiss.METRIC_INNER_PRODUCT)
+    if not index.is_trained:
+        if n > ANN_TRAIN_SAMPLE:
+            rng = np.random.default_rng(0)
+            sample = vecs[rng.choice(n, ANN_TRAIN_SAMPLE, replace=False)]
+        else:
+            sample = vecs
+        index.train(np.ascontiguousarray(sample))
+    if kind == "hnsw":
+        faiss.downcast_index(index).hnsw.efSearch = ANN_EF_SEARCH
+        index = faiss.IndexIDMap2(index)
+    return index
+
+
+def build_index(
+    vecs: np.ndarray,
+    labels: np.ndarray,
+    kind: str | None = None,
+) -> faiss.Index:
+    """Create, train and fill an index for the vectors and their labels."""
+    kind = choose_index_type(len(vecs), kind or INDEX_TYPE)
+    index = make_index(kind, int(vecs.shape[1]), vecs)
+    index.add_with_ids(vecs, np.asarray(labels, dtype=np.int64))
+    return index
+
+
+def is_positional(index: faiss.Index) -> bool:
+    """Return True for indexes of the old format, labelled by row number."""
+    if isinstance(faiss.downcast_index(index), (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return False
+    if _ivf(index) is None:
+        return True
+    # Chunk labels are 63 bit hashes, row numbers are all below ntotal
+    labels = index_labels(index)
+    return bool(len(labels)) and int(labels.max()) < index.ntotal
+
+
+def index_labels(index: faiss.Index) -> np.ndarray:
+    """Return the labels of all vectors of an index."""
+    outer = faiss.downcast_index(index)
+    if isinstance(outer, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return faiss.vector_to_array(outer.id_map).astype(np.int64)
+    ivf = _ivf(index)
+    if ivf is None:
+        return np.arange(index.ntotal, dtype=np.int64)
+    invlists = ivf.invlists
+    parts = [
+        faiss.rev_swig_ptr(invlists.get_ids(i), invlists.list_size(i)).copy()
+        for i in range(ivf.nlist) if invlists.list_size(i)
+    ]
+    if not parts:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(parts).astype(np.int64)
+
+
+def flat_vectors(index: faiss.Index) -> np.ndarray | None:
+    """Return a view of the stored vectors of a flat or HNSW index.
+
+    The rows are in the order of index_labels(). None for indexes that
+    store compressed vectors. The view is only valid while index is.
+    """
+    outer = faiss.downcast_index(index)
+    if not isinstance(outer, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return None
+    inner = faiss.downcast_index(outer.index)
+    if isinstance(inner, faiss.IndexHNSW):
+        inner = faiss.downcast_index(inner.storage)
+    if not isinstance(inner, faiss.IndexFlat) or inner.ntotal == 0:
+        return None
+    return faiss.rev_swig_ptr(inner.get_xb(), inner.ntotal * inner.d) \
+        .reshape(inner.ntotal, inner.d)
+
+
+def reconstruct_all(index: faiss.Index) -> tuple[np.ndarray, np.ndarray]:
+    """Return all vectors of an index and their labels.
+
+    The vectors are approximate for PQ indexes.
+    """
+    labels = index_labels(index)
+    if index.ntotal == 0:
+        return np.zeros((0, index.d), dtype="float32"), labels
+    outer = faiss.downcast_index(index)
+    if isinstance(outer, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        inner = outer.index
+        return inner.reconstruct_n(0, inner.ntotal), labels
+    if _ivf(index) is not None:
+        index = faiss.clone_index(index)
+        faiss.extract_index_ivf(index).set_direct_map_type(
+            faiss.DirectMap.Hashtable)
+        return index.reconstruct_batch(labels), labels
+    return index.reconstruct_n(0, index.ntotal), labels
+
+
+def remove_labels(index: faiss.Index, labels: np.ndarray) -> faiss.Index:
+    """Return a copy of an index without the vectors of labels.
+
+    Flat and IVF indexes remove the vectors in place of the copy, HNSW
+    graphs do not support removal and are rebuilt from the kept vectors.
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    if index_type(index) == "hnsw":
+        vecs, all_labels = reconstruct_all(index)
+        keep = ~np.isin(all_labels, labels)
+        return build_index(vecs[keep], all_labels[keep], "hnsw")
+    index = faiss.clone_index(index)
+    if len(labels):
+        index.remove_ids(faiss.IDSelectorBatch(labels))
+    return index
+
+
+def search_params(
+    index: faiss.Index,
+    nprobe: int | None = None,
+    ef_search: int | None = None,
+    sel: faiss.IDSelector | None = None,
+) -> faiss.SearchParameters | None:
+    """Search parameters for the type of the index.
+
+    sel restricts the search to the labels it selects.
+    """
+    kind = index_type(index)
+    if kind in ("ivf", "ivfpq", "opq"):
+        params = faiss.SearchParametersIVF(nprobe=nprobe or ANN_NPROBE)
+    elif kind == "hnsw":
+        params = faiss.SearchParametersHNSW(efSearch=ef_search or ANN_EF_SEARCH)
+    elif sel is not None:
+        params = faiss.SearchParameters()
+    else:
+        return None
+    if sel is not None:
+        params.sel = sel
+    if kind == "opq":
+        return faiss.SearchParametersPreTransform(index_params=params)
+    return params
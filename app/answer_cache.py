@@ -0,0 +1,196 @@
+from __future__ import annotations
+
+import base64
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+
+from config import (
+    ANSWER_CACHE_PERSIST,
+    ANSWER_CACHE_SIZE,
+    ANSWER_CACHE_THRESHOLD,
+    DATA_DIR,
+)
+
+log = logging.getLogger(__name__)
+
+CACHE_FILE = "answer_cache.jsonl"
+
+
+@dataclass
+class AnswerLookup:
+    """Result of a cache lookup, passed to AnswerCache.put() on a miss."""
+
+    key: str
+    vec: np.ndarray
+    # The cached answer, None on a miss
+    answer: str | None = None
+
+
+@dataclass
+class _Entry:
+    key: str
+    vec: np.ndarray
+    answer: str
+
+
+def answer_key(generation: str, model: str, chunk_ids: list[str]) -> str:
+    """Return the key of the answers of a chat model to the same context."""
+    raw = json.dumps([generation, model, sorted(set(chunk_ids))])
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class AnswerCache:
+    """LRU cache of the answers to similar questions over the same context.
+
+    A cached answer is reused for a question whose embedding has at least
+    threshold cosine similarity with the cached question, when the same
+    chunks were retrieved for it from the same index generation and the
+    same chat model answers it. See answer_key().
+
+    With a path the entries are appended to a json lines file and loaded
+    again on start. The file is rewritten without the evicted entries when
+    it has grown to more than twice the size of the cache.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        threshold: float,
+        path: Path | None = None,
+    ) -> None:
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[int, _Entry] = OrderedDict()
+        # Entries of each key, most keys have only a few
+        self._by_key: dict[str, set[int]] = {}
+        self._next_id = 0
+        self._records = 0
+        if path is not None:
+            self._load()
+
+    def lookup(self, key: str, vec: np.ndarray) -> AnswerLookup:
+        """Return the cached answer of the most similar question of key."""
+        vec = _unit(vec)
+        with self._lock:
+            ids = list(self._by_key.get(key, ()))
+            if ids:
+                sims = np.stack([self._entries[i].vec for i in ids]) @ vec
+                best = int(np.argmax(sims))
+                if sims[best] >= self.threshold:
+                    self._entries.move_to_end(ids[best])
+                    self.hits += 1
+                    return AnswerLookup(key, vec, self._entries[ids[best]].answer)
+            self.misses += 1
+        return AnswerLookup(key, vec)
+
+    def put(self, lookup: AnswerLookup, answer: str) -> None:
+        """Cache the answer to the question of a missed lookup."""
+        if lookup.answer is not None or not answer.strip():
+            return
+        with self._lock:
+            self._add(lookup.key, lookup.vec, answer)
+            if self.path is not None:
+                self._append(_Entry(lookup.key, lookup.vec, answer))
+
+    def _add(self, key: str, vec: np.ndarray, answer: str) -> None:
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = _Entry(key, vec, answer)
+        self._by_key.setdefault(key, set()).add(entry_id)
+        while len(self._entries) > self.max_entries:
+            old_id, old = self._entries.popitem(last=False)
+            ids = self._by_key[old.key]
+            ids.discard(old_id)
+            if not ids:
+                del self._by_key[old.key]
+
+    def _append(self, entry: _Entry) -> None:
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with self.path.open("a", encoding="utf-8") as f:
+                f.write(_dump(entry))
+            self._records += 1
+            if self._records > 2 * self.max_entries:
+                self._compact()
+        except OSError as e:
+            log.warning("Failed to write %s: %s", self.path, e)
+
+    def _load(self) -> None:
+        try:
+            f = self.path.open("rb")
+        except FileNotFoundError:
+            return
+        with f:
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break
+                try:
+                    obj = json.loads(raw)
+                    vec = np.frombuffer(
+                        base64.b64decode(obj["vec"]), dtype=np.float32)
+                    self._add(obj["key"], vec, obj["answer"])
+                except (ValueError, KeyError):
+                    # A damaged record, the others are still usable
+                    continue
+                self._records += 1
+
+    def _compact(self) -> None:
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with tmp.open("w", encoding="utf-8") as f:
+            f.writelines(_dump(e) for e in self._entries.values())
+        tmp.replace(self.path)
+        self._records = len(self._entries)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._by_key.clear()
+            self._records = 0
+            if self.path is not None:
+                self.path.unlink(missing_ok=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+def _unit(vec: np.ndarray) -> np.ndarray:
+    vec = np.asarray(vec, dtype=np.float32).reshape(-1)
+    norm = float(np.linalg.norm(vec))
+    return vec / norm if norm > 0 else vec
+
+
+def _dump(entry: _Entry) -> str:
+    return json.dumps({
+        "key": entry.key,
+        "vec": base64.b64encode(entry.vec.astype(np.float32).tobytes()).decode(),
+        "answer": entry.answer,
+    }) + "\n"
+
+
+@lru_cache(maxsize=None)
+def get_answer_cache(data_dir: str | None = None) -> AnswerCache | None:
+    """Return the process wide answer cache, None if it is disabled."""
+    if ANSWER_CACHE_SIZE <= 0:
+        return None
+    path = Path(data_dir or DATA_DIR) / CACHE_FILE if ANSWER_CACHE_PERSIST \
+        else None
+    return AnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_THRESHOLD, path)
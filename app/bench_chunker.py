@@ -0,0 +1,78 @@
+"""Compare the structure chunker with the character splitter.
+
+Run with python app/bench_chunker.py [--pages N]. The pages are generated
+documentation pages with headings, prose, lists and code blocks.
+"""
+from __future__ import annotations
+
+import argparse
+import random
+import time
+
+from chunker import char_spans, split_text
+from config import CHUNK_OVERLAP, CHUNK_OVERLAP_TOKENS, CHUNK_SIZE, CHUNK_TOKENS
+from tokens import count_tokens
+
+_WORDS = (
+    "index query vector chunk page request server client token model "
+    "config option value return default error cache store search result "
+    "the a of to and in is for with on that by this be are from"
+).split()
+
+
+def _sentence(rng: random.Random) -> str:
+    words = rng.choices(_WORDS, k=rng.randint(6, 24))
+    return " ".join(words).capitalize() + "."
+
+
+def _page(rng: random.Random) -> str:
+    blocks = [f"# {_sentence(rng)[:-1]}"]
+    for s in range(rng.randint(2, 6)):
+        blocks.append(f"## Section {s}")
+        for _ in range(rng.randint(1, 4)):
+            kind = rng.random()
+            if kind < 0.15:
+                blocks.append("\n".join(
+                    f"    {rng.choice(_WORDS)} = {rng.randint(0, 99)}"
+                    for _ in range(rng.randint(3, 12))))
+            elif kind < 0.3:
+                blocks.append("\n".join(
+                    f"- {_sentence(rng)}" for _ in range(rng.randint(2, 6))))
+            else:
+                blocks.append(" ".join(
+                    _sentence(rng) for _ in range(rng.randint(2, 12))))
+    return "\n\n".join(blocks)
+
+
+def _run(name: str, split, pages: list[str]) -> None:
+    t = time.perf_counter()
+    spans = [s for text in pages for s in split(text)]
+    seconds = time.perf_counter() - t
+    size = sum(len(text) for text in pages)
+    tokens = [count_tokens(s.text) for s in spans]
+    chunked = sum(s.end - s.start for s in spans)
+    print(
+        f"{name:<10} chunks={len(spans):<7} "
+        f"avg_tokens={sum(tokens) / max(1, len(tokens)):<7.1f} "
+        f"max_tokens={max(tokens, default=0):<5} "
+        f"overlap={100 * (chunked - size) / max(1, size):5.1f}% "
+        f"{size / 1e6 / max(seconds, 1e-9):6.2f} MB/s"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    pages = [_page(rng) for _ in range(args.pages)]
+    print(f"{len(pages)} pages, {sum(map(len, pages)) / 1e6:.2f} MB")
+    _run("chars", lambda t: char_spans(t, CHUNK_SIZE, CHUNK_OVERLAP), pages)
+    _run("structure",
+         lambda t: split_text(t, CHUNK_TOKENS, CHUNK_OVERLAP_TOKENS), pages)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,613 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import mmap
+import os
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import numpy as np
+
+# One row per chunk: page table index, id and text lengths and the offset of
+# the id bytes in the heap. The chunk text follows its id in the heap, its
+# heading path follows the text.
+ROW_DTYPE = np.dtype([
+    ("page", "<u4"),
+    ("id_len", "<u4"),
+    ("text_len", "<u4"),
+    ("off", "<u8"),
+])
+
+# Tombstones: a deleted row and the store size from which the delete applies.
+# Deletes made together with an append only apply once its rows are part of
+# the store, so an interrupted append does not delete anything.
+DEL_DTYPE = np.dtype([("row", "<u8"), ("rows", "<u8")])
+
+# Per row metadata: the chunk label used by the vector index and the time
+# the row was added, 0 for rows written before the times were kept.
+META_DTYPE = np.dtype([("label", "<i8"), ("added_at", "<f8")])
+
+# Per row position of the chunk in its page text and the length of its
+# heading path, which follows the chunk text in the heap. All 0 for rows
+# written before they were kept.
+LOC_DTYPE = np.dtype([("start", "<u4"), ("end", "<u4"), ("heading_len", "<u4")])
+
+ROWS_FILE = "chunks.rows"
+HEAP_FILE = "chunks.heap"
+PAGES_FILE = "pages.jsonl"
+DEL_FILE = "chunks.del"
+META_FILE = "chunks.meta"
+LOC_FILE = "chunks.loc"
+# Files renamed into place by replace_files(), kept until all are renamed
+JOURNAL_FILE = "replace.journal"
+# Legacy format with one json object per chunk
+DOCS_FILE = "docs.jsonl"
+
+
+@dataclass
+class ChunkDoc:
+    id: str
+    url: str
+    title: str
+    chunk: str
+    # Headings the chunk is under, joined by " > "
+    heading: str = ""
+    # Character offsets of the chunk in the page text
+    start: int = 0
+    end: int = 0
+
+
+@dataclass(frozen=True)
+class ChunkFilter:
+    """Conditions on the page and ingest time of the chunks to search.
+
+    A chunk matches when every set condition matches. domains are compared
+    to the host of the url without case, title matches the titles that
+    contain it without case. The times are unix times.
+    """
+
+    domains: tuple[str, ...] = ()
+    url_prefixes: tuple[str, ...] = ()
+    title: str = ""
+    added_after: float | None = None
+    added_before: float | None = None
+
+    def __bool__(self) -> bool:
+        return bool(self.domains or self.url_prefixes or self.title) \
+            or self.added_after is not None or self.added_before is not None
+
+
+def chunk_label(url: str, text: str) -> int:
+    """Return the stable 63 bit label of a chunk of a url."""
+    digest = hashlib.blake2b(
+        url.encode("utf-8") + b"\0" + text.encode("utf-8"), digest_size=8
+    ).digest()
+    return int.from_bytes(digest, "little") >> 1
+
+
+def chunk_id(url: str, text: str) -> str:
+    """Return the stable id of a chunk, derived from its url and text."""
+    return f"{chunk_label(url, text):016x}"
+
+
+def chunk_labels(chunks: list[ChunkDoc]) -> np.ndarray:
+    return np.array([chunk_label(c.url, c.chunk) for c in chunks],
+                    dtype=np.int64)
+
+
+def chunk_store_files(data_dir: Path) -> list[Path]:
+    """Return the files of the chunk store in a data dir."""
+    return [data_dir / ROWS_FILE, data_dir / HEAP_FILE, data_dir / PAGES_FILE,
+            data_dir / DEL_FILE, data_dir / META_FILE, data_dir / LOC_FILE]
+
+
+def replace_files(data_dir: Path, files: dict[Path, Path]) -> None:
+    """Rename the written files over their final paths as one step.
+
+    files maps the final paths to the new files. The renames are recorded
+    in a journal first, finish_replace() completes them after a crash.
+    """
+    journal = data_dir / JOURNAL_FILE
+    tmp = journal.with_name(journal.name + ".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        json.dump([[str(new), str(final)] for final, new in files.items()], f)
+        _fsync_file(f)
+    os.replace(tmp, journal)
+    finish_replace(data_dir)
+
+
+def finish_replace(data_dir: Path) -> bool:
+    """Complete the renames of an interrupted replace_files().
+
+    Returns True if there was a journal.
+    """
+    journal = data_dir / JOURNAL_FILE
+    if not journal.exists():
+        return False
+    for new, final in json.loads(journal.read_text(encoding="utf-8")):
+        if os.path.exists(new):
+            os.replace(new, final)
+    dir_fd = os.open(data_dir, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    journal.unlink()
+    return True
+
+
+def _fsync_file(f) -> None:
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def _map(path: Path, size: int) -> mmap.mmap | None:
+    """Memory map the first size bytes of a file read-only."""
+    if size <= 0:
+        return None
+    with path.open("rb") as f:
+        return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+
+
+class ChunkStore:
+    """Memory mapped, append-only store of chunks.
+
+    Chunk ids and texts live in a byte heap, a fixed size row per chunk
+    points into it. Urls and titles are stored once per page in a small page
+    table kept in memory. Chunks are decoded only when they are accessed.
+
+    A store is an immutable view of the first n rows on disk. append() writes
+    after those rows and returns a new view, views are never modified.
+    Deleted rows stay in the files as tombstones until the store is rewritten.
+    """
+
+    def __init__(
+        self,
+        data_dir: Path,
+        n_rows: int,
+        heap_bytes: int,
+        pages: list[tuple[str, str]],
+        pages_bytes: int,
+        deleted: np.ndarray | None = None,
+    ) -> None:
+        self.data_dir = data_dir
+        self.heap_bytes = heap_bytes
+        self.pages = pages
+        self.pages_bytes = pages_bytes
+        # Tombstone entries of this view
+        self.deleted = deleted if deleted is not None \
+            else np.zeros(0, dtype=DEL_DTYPE)
+        self._page_ids = {p: i for i, p in enumerate(pages)}
+        self._alive: np.ndarray | None = None
+        self._heap = _map(data_dir / HEAP_FILE, heap_bytes)
+        # Sorted labels and the rows they belong to
+        self._labels: tuple[np.ndarray, np.ndarray] | None = None
+        if n_rows > 0:
+            self._rows = np.memmap(
+                data_dir / ROWS_FILE, dtype=ROW_DTYPE, mode="r",
+                shape=(n_rows,),
+            )
+        else:
+            self._rows = np.zeros(0, dtype=ROW_DTYPE)
+        # Shorter than the rows only for stores written without it, open()
+        # fills in the missing rows
+        meta_path = data_dir / META_FILE
+        n_meta = min(n_rows, meta_path.stat().st_size // META_DTYPE.itemsize) \
+            if meta_path.exists() else 0
+        if n_meta > 0:
+            self.meta = np.memmap(meta_path, dtype=META_DTYPE, mode="r",
+                                  shape=(n_meta,))
+        else:
+            self.meta = np.zeros(0, dtype=META_DTYPE)
+        loc_path = data_dir / LOC_FILE
+        n_loc = min(n_rows, loc_path.stat().st_size // LOC_DTYPE.itemsize) \
+            if loc_path.exists() else 0
+        if n_loc > 0:
+            self.loc = np.memmap(loc_path, dtype=LOC_DTYPE, mode="r",
+                                 shape=(n_loc,))
+        else:
+            self.loc = np.zeros(0, dtype=LOC_DTYPE)
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __getitem__(self, i: int) -> ChunkDoc:
+        row = self._rows[i]
+        off = int(row["off"])
+        id_len = int(row["id_len"])
+        text_end = id_len + int(row["text_len"])
+        loc = self.loc[i]
+        assert self._heap is not None
+        raw = self._heap[off:off + text_end + int(loc["heading_len"])]
+        url, title = self.pages[int(row["page"])]
+        return ChunkDoc(
+            id=raw[:id_len].decode("utf-8"),
+            url=url,
+            title=title,
+            chunk=raw[id_len:text_end].decode("utf-8"),
+            heading=raw[text_end:].decode("utf-8"),
+            start=int(loc["start"]),
+            end=int(loc["end"]),
+        )
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def alive(self) -> np.ndarray:
+        """Boolean mask of the rows that are not deleted."""
+        if self._alive is None:
+            alive = np.ones(len(self), dtype=bool)
+            alive[self.deleted["row"].astype(np.int64)] = False
+            self._alive = alive
+        return self._alive
+
+    @property
+    def n_live(self) -> int:
+        return len(self) - int(np.count_nonzero(~self.alive)) \
+            if len(self.deleted) else len(self)
+
+    def urls(self) -> list[str]:
+        """Return the unique urls of the stored chunks."""
+        if not len(self.deleted):
+            return sorted({url for url, _title in self.pages})
+        pages = np.unique(self.page_rows()[self.alive])
+        return sorted({self.pages[int(p)][0] for p in pages})
+
+    def page_rows(self) -> np.ndarray:
+        """Return the page table index of every row."""
+        return np.asarray(self._rows["page"])
+
+    def rows_of_urls(
+        self,
+        urls: set[str],
+        before: float | None = None,
+    ) -> np.ndarray:
+        """Return the live rows of the urls.
+
+        With before, only the rows added before that time are returned.
+        """
+        page_ids = [i for i, (url, _title) in enumerate(self.pages)
+                    if url in urls]
+        return self._rows_of_pages(page_ids, before)
+
+    def rows_of_domains(self, domains: set[str]) -> np.ndarray:
+        """Return the live rows of the urls on the domains."""
+        domains = {d.lower() for d in domains}
+        page_ids = [i for i, (url, _title) in enumerate(self.pages)
+                    if urlsplit(url).netloc.lower() in domains]
+        return self._rows_of_pages(page_ids)
+
+    def filter_mask(self, f: ChunkFilter) -> np.ndarray:
+        """Return a mask of the live rows that match a filter.
+
+        The page conditions are checked once per page, not per row.
+        """
+        mask = self.alive.copy()
+        if f.domains or f.url_prefixes or f.title:
+            domains = {d.lower() for d in f.domains}
+            title = f.title.lower()
+            pages = np.fromiter(
+                ((not domains or urlsplit(url).netloc.lower() in domains)
+                 and (not f.url_prefixes or url.startswith(f.url_prefixes))
+                 and (not title or title in page_title.lower())
+                 for url, page_title in self.pages),
+                dtype=bool, count=len(self.pages))
+            mask &= pages[self.page_rows()]
+        if f.added_after is not None or f.added_before is not None:
+            added = np.asarray(self.meta["added_at"])
+            if f.added_after is not None:
+                mask &= added >= f.added_after
+            if f.added_before is not None:
+                mask &= added < f.added_before
+        return mask
+
+    def _rows_of_pages(
+        self,
+        page_ids: list[int],
+        before: float | None = None,
+    ) -> np.ndarray:
+        if not page_ids:
+            return np.zeros(0, dtype=np.int64)
+        mask = np.isin(self.page_rows(), page_ids) & self.alive
+        if before is not None:
+            mask &= np.asarray(self.meta["added_at"]) < before
+        return np.flatnonzero(mask)
+
+    def rows_of_labels(self, labels: np.ndarray) -> np.ndarray:
+        """Return the row of every label, -1 for unknown labels.
+
+        A label stored more than once, by stores written before labels were
+        derived from the content, maps to its last live row.
+        """
+        if self._labels is None:
+            # Live rows sort after dead ones, so the last row of a label is
+            # its last live row if it has one
+            order = np.lexsort((np.arange(len(self)), self.alive,
+                                np.asarray(self.meta["label"])))
+            self._labels = (np.asarray(self.meta["label"])[order], order)
+        sorted_labels, order = self._labels
+        labels = np.asarray(labels, dtype=np.int64)
+        pos = np.searchsorted(sorted_labels, labels, side="right") - 1
+        found = (pos >= 0) & (sorted_labels[np.maximum(pos, 0)] == labels)
+        return np.where(found, order[np.maximum(pos, 0)], -1)
+
+    def dead_labels(self) -> np.ndarray:
+        """Return the labels that have no live row."""
+        labels = np.asarray(self.meta["label"])
+        return np.setdiff1d(labels[~self.alive], labels[self.alive])
+
+    @classmethod
+    def open(cls, data_dir: Path, max_rows: int | None = None) -> ChunkStore:
+        """Open the store, ignoring rows past max_rows.
+
+        Rows and heap bytes past what the rows reference are left over from
+        an interrupted append, they are not part of the store.
+        """
+        rows_path = data_dir / ROWS_FILE
+        if not rows_path.exists():
+            raise FileNotFoundError(f"Chunk store not found in {data_dir}.")
+        n_rows = rows_path.stat().st_size // ROW_DTYPE.itemsize
+        if max_rows is not None:
+            n_rows = min(n_rows, max_rows)
+
+        heap_bytes = 0
+        if n_rows > 0:
+            rows = np.memmap(rows_path, dtype=ROW_DTYPE, mode="r",
+                             shape=(n_rows,))
+            ends = rows["off"] + rows["id_len"] + rows["text_len"]
+            loc_path = data_dir / LOC_FILE
+            n_loc = min(n_rows, loc_path.stat().st_size // LOC_DTYPE.itemsize) \
+                if loc_path.exists() else 0
+            if n_loc > 0:
+                loc = np.memmap(loc_path, dtype=LOC_DTYPE, mode="r",
+                                shape=(n_loc,))
+                ends[:n_loc] += loc["heading_len"]
+            heap_bytes = int(ends.max())
+
+        pages: list[tuple[str, str]] = []
+        pages_bytes = 0
+        with (data_dir / PAGES_FILE).open("rb") as f:
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break
+                obj = json.loads(raw)
+                pages.append((obj["url"], obj["title"]))
+                pages_bytes += len(raw)
+
+        deleted = np.zeros(0, dtype=DEL_DTYPE)
+        del_path = data_dir / DEL_FILE
+        if del_path.exists():
+            deleted = np.fromfile(del_path, dtype=DEL_DTYPE)
+            # Entries of an interrupted append are at the end of the file
+            n_del = int(np.searchsorted(deleted["rows"], n_rows, side="right"))
+            deleted = deleted[:n_del]
+
+        store = cls(data_dir, n_rows, heap_bytes, pages, pages_bytes, deleted)
+        # Stores written without the per row files get them filled in
+        if len(store.loc) < n_rows:
+            store._write_loc(len(store.loc))
+            store = cls(data_dir, n_rows, heap_bytes, pages, pages_bytes,
+                        deleted)
+        if len(store.meta) < n_rows:
+            store._write_meta(len(store.meta))
+            store = cls(data_dir, n_rows, heap_bytes, pages, pages_bytes,
+                        deleted)
+        return store
+
+    def _write_loc(self, start: int) -> None:
+        """Add empty locations for rows stored without them."""
+        path = self.data_dir / LOC_FILE
+        path.touch()
+        with path.open("r+b") as f:
+            f.seek(start * LOC_DTYPE.itemsize)
+            f.truncate()
+            f.write(np.zeros(len(self) - start, dtype=LOC_DTYPE).tobytes())
+            _fsync_file(f)
+
+    def _write_meta(self, start: int, batch: int = 10_000) -> None:
+        """Compute the labels of rows stored without them."""
+        path = self.data_dir / META_FILE
+        path.touch()
+        with path.open("r+b") as f:
+            f.seek(start * META_DTYPE.itemsize)
+            f.truncate()
+            for lo in range(start, len(self), batch):
+                hi = min(len(self), lo + batch)
+                meta = np.zeros(hi - lo, dtype=META_DTYPE)
+                meta["label"] = chunk_labels([self[i] for i in range(lo, hi)])
+                f.write(meta.tobytes())
+            _fsync_file(f)
+
+    @classmethod
+    def create(cls, data_dir: Path, chunks: list[ChunkDoc]) -> ChunkStore:
+        """Write a new store holding only the chunks.
+
+        The files are written under temporary names and renamed over the old
+        ones, so stores still mapping the old files keep working.
+        """
+        data_dir.mkdir(parents=True, exist_ok=True)
+        tmp = {p: p.with_name(p.name + ".tmp") for p in chunk_store_files(data_dir)}
+        for p in tmp.values():
+            p.write_bytes(b"")
+        empty = cls(data_dir, 0, 0, [], 0)
+        empty._write(chunks, files=tmp)
+        for final, p in tmp.items():
+            os.replace(p, final)
+        return cls.open(data_dir, len(chunks))
+
+    def write_live(self, out_dir: Path, batch: int = 10_000) -> ChunkStore:
+        """Write the live rows to a new store in out_dir.
+
+        Row numbers change, labels and add times are kept. Used to drop the
+        tombstones, see replace_files() for moving the files into place.
+        """
+        out = ChunkStore.create(out_dir, [])
+        live = np.flatnonzero(self.alive)
+        for lo in range(0, len(live), batch):
+            rows = live[lo:lo + batch]
+            pages_bytes, heap_bytes, pages = out._write(
+                [self[int(i)] for i in rows], meta=self.meta[rows])
+            out = ChunkStore(out_dir, lo + len(rows), heap_bytes, pages,
+                             pages_bytes)
+        return out
+
+    def append(
+        self,
+        chunks: list[ChunkDoc],
+        delete: np.ndarray | None = None,
+    ) -> ChunkStore:
+        """Write chunks after the rows of this store and return the new view.
+
+        The heap and the pages are written before the rows that reference
+        them, so an interrupted append leaves only unreferenced data behind.
+        The rows in delete are deleted once the new rows are part of the
+        store.
+        """
+        n_rows = len(self) + len(chunks)
+        deleted = self._write_deletes(delete, n_rows)
+        if not chunks:
+            return ChunkStore(self.data_dir, len(self), self.heap_bytes,
+                              self.pages, self.pages_bytes, deleted)
+        pages_bytes, heap_bytes, pages = self._write(chunks)
+        return ChunkStore(
+            self.data_dir,
+            n_rows,
+            heap_bytes,
+            pages,
+            pages_bytes,
+            deleted,
+        )
+
+    def _write_deletes(
+        self,
+        rows: np.ndarray | None,
+        n_rows: int,
+    ) -> np.ndarray:
+        """Append tombstones that apply from n_rows rows on.
+
+        Entries left over from an interrupted append are dropped even when
+        there is nothing to delete, they must not apply to the new rows.
+        """
+        path = self.data_dir / DEL_FILE
+        size = len(self.deleted) * DEL_DTYPE.itemsize
+        if rows is None or not len(rows):
+            if path.exists() and path.stat().st_size > size:
+                os.truncate(path, size)
+            return self.deleted
+        entries = np.zeros(len(rows), dtype=DEL_DTYPE)
+        entries["row"] = rows
+        entries["rows"] = n_rows
+        path.touch()
+        with path.open("r+b") as f:
+            f.seek(size)
+            f.truncate()
+            f.write(entries.tobytes())
+            _fsync_file(f)
+        return np.concatenate([self.deleted, entries])
+
+    def _write(
+        self,
+        chunks: list[ChunkDoc],
+        files: dict[Path, Path] | None = None,
+        meta: np.ndarray | None = None,
+    ) -> tuple[int, int, list[tuple[str, str]]]:
+        """Append chunks to the files after this view's data.
+
+        files maps the store files to the paths actually written. meta are
+        the labels and add times of the chunks, new ones if not given.
+        """
+        if files is None:
+            files = {p: p for p in chunk_store_files(self.data_dir)}
+        rows_path, heap_path, pages_path, _del_path, meta_path, loc_path = \
+            files.values()
+        if meta is None:
+            meta = np.zeros(len(chunks), dtype=META_DTYPE)
+            meta["label"] = chunk_labels(chunks)
+            meta["added_at"] = time.time()
+
+        pages = list(self.pages)
+        page_ids = dict(self._page_ids)
+        new_pages: list[bytes] = []
+        rows = np.zeros(len(chunks), dtype=ROW_DTYPE)
+        loc = np.zeros(len(chunks), dtype=LOC_DTYPE)
+        heap_parts: list[bytes] = []
+        off = self.heap_bytes
+        for i, c in enumerate(chunks):
+            key = (c.url, c.title)
+            page = page_ids.get(key)
+            if page is None:
+                page = len(pages)
+                page_ids[key] = page
+                pages.append(key)
+                new_pages.append((json.dumps(
+                    {"url": c.url, "title": c.title}, ensure_ascii=True
+                ) + "\n").encode())
+            id_raw = c.id.encode("utf-8")
+            text_raw = c.chunk.encode("utf-8")
+            heading_raw = c.heading.encode("utf-8")
+            rows[i] = (page, len(id_raw), len(text_raw), off)
+            loc[i] = (c.start, c.end, len(heading_raw))
+            heap_parts.extend((id_raw, text_raw, heading_raw))
+            off += len(id_raw) + len(text_raw) + len(heading_raw)
+
+        with heap_path.open("r+b") as f:
+            f.seek(self.heap_bytes)
+            f.truncate()
+            f.writelines(heap_parts)
+            _fsync_file(f)
+        with pages_path.open("r+b") as f:
+            f.seek(self.pages_bytes)
+            f.truncate()
+            f.writelines(new_pages)
+            _fsync_file(f)
+            pages_bytes = f.tell()
+        # Like the heap, the metadata is written before the rows
+        with meta_path.open("r+b") as f:
+            f.seek(len(self) * META_DTYPE.itemsize)
+            f.truncate()
+            f.write(np.ascontiguousarray(meta, dtype=META_DTYPE).tobytes())
+            _fsync_file(f)
+        with loc_path.open("r+b") as f:
+            f.seek(len(self) * LOC_DTYPE.itemsize)
+            f.truncate()
+            f.write(loc.tobytes())
+            _fsync_file(f)
+        with rows_path.open("r+b") as f:
+            f.seek(len(self) * ROW_DTYPE.itemsize)
+            f.truncate()
+            f.write(rows.tobytes())
+            _fsync_file(f)
+
+        return pages_bytes, off, pages
+
+
+def migrate_jsonl(data_dir: Path, batch_size: int = 10_000) -> bool:
+    """Convert a legacy docs.jsonl into a chunk store.
+
+    The chunks are converted in batches to keep memory bounded. The old file
+    is renamed to docs.jsonl.bak only after the conversion is complete, an
+    interrupted migration starts over. Returns False if there was nothing to
+    migrate.
+    """
+    docs_path = data_dir / DOCS_FILE
+    if not docs_path.exists():
+        return False
+    store = ChunkStore.create(data_dir, [])
+    batch: list[ChunkDoc] = []
+    with docs_path.open("rb") as f:
+        for raw in f:
+            line = raw.strip()
+            if not line:
+                continue
+            batch.append(ChunkDoc(**json.loads(line)))
+            if len(batch) >= batch_size:
+                store = store.append(batch)
+                batch = []
+    store.append(batch)
+    os.replace(docs_path, docs_path.with_name(DOCS_FILE + ".bak"))
+    return True
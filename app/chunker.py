@@ -1,39 +1,243 @@
 from __future__ import annotations
 
+import re
+from dataclasses import dataclass
 
-from index_store import ChunkDoc
-from crawler import PageDoc
+from typing import TYPE_CHECKING
 
+from chunk_store import ChunkDoc, chunk_id
+from config import (
+    CHUNK_OVERLAP,
+    CHUNK_OVERLAP_TOKENS,
+    CHUNK_SIZE,
+    CHUNK_TOKENS,
+    CHUNKER,
+)
+from tokens import count_tokens
 
-def chunk_pages(pages: list[PageDoc], chunk_size, overlap) -> list[ChunkDoc]:
+if TYPE_CHECKING:
+    # Kept out of the worker processes, which import this module
+    from crawler import PageDoc
+
+CHUNKERS = ("structure", "chars")
+
+# Blocks of the extracted text are separated by blank lines
+_BLOCK_SEP = re.compile(r"\n[ \t]*\n\s*")
+_HEADING = re.compile(r"(#{1,6}) +(.*)")
+# Ends of sentences, after the punctuation and any closing quotes
+_SENTENCE_END = re.compile(r"[.!?][\"')\]]*\s+")
+_LINE_END = re.compile(r"\n")
+_WORD = re.compile(r"\S+\s*")
+
+
+@dataclass
+class TextSpan:
+    """A chunk of a text with its position and heading path."""
+
+    text: str
+    start: int
+    end: int
+    heading: str = ""
+
+
+@dataclass
+class _Segment:
+    start: int
+    end: int
+    tokens: int
+    # Heading level, 0 for text
+    level: int = 0
+    title: str = ""
+
+
+def chunk_pages(pages: list[PageDoc], chunker: str = CHUNKER) -> list[ChunkDoc]:
     """Split list of pages into chunks."""
     chunks: list[ChunkDoc] = []
-    for p_i, p in enumerate(pages):
-        chunks.extend(
-            ChunkDoc(
-                id=f"p{p_i}-c{c_i}",
-                url=p.url,
-                title=p.title,
-                chunk=chunk,
-            )
-            for c_i, chunk in enumerate(
-                chunk_text(p.text, chunk_size, overlap)
-            )
-        )
+    for p in pages:
+        chunks.extend(chunk_page(p, chunker))
     return chunks
 
 
-def chunk_text(text: str, chunk_size: int, overlap: int) -> list[str]:
-    """Split text into chunks."""
-    text = (text or "").strip()
-    if not text:
+def chunk_page(page: PageDoc, chunker: str = CHUNKER) -> list[ChunkDoc]:
+    """Split a page into chunks with ids derived from the url and text."""
+    spans = text_spans(page.text, chunker)
+    return page_chunks(page, [(s.start, s.end) for s in spans],
+                       [s.heading for s in spans])
+
+
+def page_chunks(
+    page: PageDoc,
+    offsets,
+    headings: list[str],
+) -> list[ChunkDoc]:
+    """Return the chunks of a page at the (start, end) offsets of its text."""
+    chunks: list[ChunkDoc] = []
+    for (start, end), heading in zip(offsets, headings):
+        start, end = int(start), int(end)
+        text = page.text[start:end]
+        chunks.append(ChunkDoc(
+            id=chunk_id(page.url, text),
+            url=page.url,
+            title=page.title,
+            chunk=text,
+            heading=heading,
+            start=start,
+            end=end,
+        ))
+    return chunks
+
+
+def text_spans(text: str, chunker: str = CHUNKER) -> list[TextSpan]:
+    """Split a text with the chunker named chunker."""
+    if chunker == "structure":
+        return split_text(text, CHUNK_TOKENS, CHUNK_OVERLAP_TOKENS)
+    if chunker == "chars":
+        return char_spans(text, CHUNK_SIZE, CHUNK_OVERLAP)
+    raise ValueError(
+        f"Unknown chunker '{chunker}', expected one of {', '.join(CHUNKERS)}"
+    )
+
+
+def split_text(
+    text: str,
+    max_tokens: int,
+    overlap: int = 0,
+) -> list[TextSpan]:
+    """Split text into chunks of at most max_tokens tokens along its structure.
+
+    Chunks end at headings, paragraphs, sentences or lines, in that order of
+    preference, and words only if a sentence does not fit in a chunk. A
+    heading starts a new chunk unless the current one is still small.
+    Every chunk is a slice of text and knows the headings it is under.
+    overlap is the amount of tokens of trailing sentences repeated at the
+    start of the next chunk when a section is split. Every part of the text
+    is tokenized once, so the time is linear in its length.
+    """
+    text = text or ""
+    if max_tokens <= 0:
+        stripped = text.strip()
+        if not stripped:
+            return []
+        start = text.index(stripped[0])
+        return [TextSpan(stripped, start, start + len(stripped))]
+
+    min_tokens = max_tokens // 4
+    spans: list[TextSpan] = []
+    path: list[tuple[int, str]] = []
+    cur: list[_Segment] = []
+    cur_tokens = 0
+    heading = ""
+
+    def flush() -> None:
+        nonlocal cur, cur_tokens
+        if not cur:
+            return
+        start, end = cur[0].start, cur[-1].end
+        spans.append(TextSpan(text[start:end], start, end, heading))
+        # Repeat trailing text of the section in the next chunk
+        carry: list[_Segment] = []
+        carry_tokens = 0
+        for seg in reversed(cur):
+            if seg.level or carry_tokens + seg.tokens > overlap:
+                break
+            carry.insert(0, seg)
+            carry_tokens += seg.tokens
+        cur, cur_tokens = carry, carry_tokens
+
+    for seg in _segments(text, max_tokens):
+        if seg.level:
+            if cur_tokens >= min_tokens:
+                flush()
+                cur, cur_tokens = [], 0
+            while path and path[-1][0] >= seg.level:
+                path.pop()
+            path.append((seg.level, seg.title))
+        elif cur and cur_tokens + seg.tokens > max_tokens:
+            flush()
+        if not cur or all(s.level for s in cur):
+            heading = " > ".join(title for _level, title in path)
+        cur.append(seg)
+        cur_tokens += seg.tokens
+    if any(not s.level for s in cur) or not spans:
+        flush()
+    return spans
+
+
+def _segments(text: str, max_tokens: int):
+    """Yield the blocks of text, oversized blocks split into smaller parts."""
+    pos = 0
+    for sep in _BLOCK_SEP.finditer(text):
+        yield from _block(text, pos, sep.start(), max_tokens)
+        pos = sep.end()
+    yield from _block(text, pos, len(text), max_tokens)
+
+
+def _block(text: str, start: int, end: int, max_tokens: int):
+    block = text[start:end]
+    stripped = block.strip()
+    if not stripped:
+        return
+    start += block.index(stripped[0])
+    end = start + len(stripped)
+    m = _HEADING.fullmatch(stripped)
+    if m and "\n" not in stripped:
+        yield _Segment(start, end, count_tokens(stripped), len(m.group(1)),
+                       m.group(2).strip())
+        return
+    tokens = count_tokens(stripped)
+    if tokens <= max_tokens:
+        yield _Segment(start, end, tokens)
+        return
+    # Code and lists keep their lines, prose is split into sentences
+    sep = _LINE_END if "\n" in stripped else _SENTENCE_END
+    yield from _split(text, start, end, sep, max_tokens)
+
+
+def _split(text: str, start: int, end: int, sep: re.Pattern, max_tokens: int):
+    """Yield the parts of text[start:end] between the matches of sep."""
+    pos = start
+    for m in sep.finditer(text, start, end):
+        yield from _part(text, pos, m.end(), max_tokens)
+        pos = m.end()
+    if pos < end:
+        yield from _part(text, pos, end, max_tokens)
+
+
+def _part(text: str, start: int, end: int, max_tokens: int):
+    part = text[start:end].rstrip()
+    if not part.strip():
+        return
+    end = start + len(part)
+    tokens = count_tokens(part)
+    if tokens <= max_tokens:
+        yield _Segment(start, end, tokens)
+        return
+    # A sentence or line longer than a chunk is split between words
+    pos = start
+    acc = 0
+    for m in _WORD.finditer(text, start, end):
+        n = count_tokens(m.group())
+        if acc and acc + n > max_tokens:
+            yield _Segment(pos, m.start(), acc)
+            pos, acc = m.start(), 0
+        acc += n
+    if acc:
+        yield _Segment(pos, end, acc)
+
+
+def char_spans(text: str, chunk_size: int, overlap: int) -> list[TextSpan]:
+    """Split text into chunks of chunk_size characters with overlap."""
+    stripped = (text or "").strip()
+    if not stripped:
         return []
+    base = text.index(stripped[0])
+    text = stripped
     if chunk_size <= 0:
-        return [text]
+        return [TextSpan(text, base, base + len(text))]
 
     overlap = max(0, min(overlap, chunk_size - 1))
 
-    chunks: list[str] = []
+    spans: list[TextSpan] = []
     i = 0
     text_len = len(text)
 
@@ -41,9 +245,15 @@ def chunk_text(text: str, chunk_size: int, overlap: int) -> list[str]:
         j = min(text_len, i + chunk_size)
         chunk = text[i:j].strip()
         if chunk:
-            chunks.append(chunk)
+            start = base + i + text[i:j].index(chunk[0])
+            spans.append(TextSpan(chunk, start, start + len(chunk)))
         if j >= text_len:
             break
         i = j - overlap
 
-    return chunks
+    return spans
+
+
+def chunk_text(text: str, chunk_size: int, overlap: int) -> list[str]:
+    """Split text into chunks of chunk_size characters."""
+    return [s.text for s in char_spans(text, chunk_size, overlap)]
@@ -0,0 +1,175 @@
+from __future__ import annotations
+
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+
+from chunk_store import ChunkDoc, ChunkFilter
+from config import COLLECTION_MAX_BYTES, DATA_DIR
+from index_store import IndexStore, StoreManager, get_store_manager
+
+# The collection stored in DATA_DIR itself, as before collections
+DEFAULT_COLLECTION = "default"
+# Dir in DATA_DIR with a data dir per named collection
+COLLECTIONS_DIR = "collections"
+_NAME_RE = re.compile(r"[A-Za-z0-9][A-Za-z0-9_-]{0,63}")
+
+
+def collection_name(name: str | None) -> str:
+    """Return the collection name, DEFAULT_COLLECTION for an empty one.
+
+    Raises ValueError for names that are not usable as a dir name.
+    """
+    name = (name or "").strip() or DEFAULT_COLLECTION
+    if not _NAME_RE.fullmatch(name):
+        raise ValueError(
+            f"Invalid collection name '{name}', use up to 64 letters, "
+            "digits, '_' and '-'"
+        )
+    return name
+
+
+def collection_dir(name: str | None) -> str:
+    """Return the data dir of a collection."""
+    name = collection_name(name)
+    if name == DEFAULT_COLLECTION:
+        return DATA_DIR
+    return str(Path(DATA_DIR) / COLLECTIONS_DIR / name)
+
+
+def list_collections() -> list[str]:
+    """Return the names of the collections that have an index."""
+    names = []
+    if (Path(DATA_DIR) / "index.faiss").exists():
+        names.append(DEFAULT_COLLECTION)
+    root = Path(DATA_DIR) / COLLECTIONS_DIR
+    if root.is_dir():
+        names += sorted(p.name for p in root.iterdir()
+                        if _NAME_RE.fullmatch(p.name)
+                        and (p / "index.faiss").exists())
+    return names
+
+
+class CollectionManager:
+    """Store managers of the collections, with a memory budget.
+
+    Every collection has its own index in its own data dir. The stores of
+    the most recently used collections stay loaded, the least recently used
+    are unloaded when the loaded stores take more than max_bytes. An
+    unloaded collection is loaded again on its next use.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.unloads = 0
+        self._lock = threading.Lock()
+        # Least recently used first
+        self._used: OrderedDict[str, StoreManager] = OrderedDict()
+
+    def manager(self, name: str | None, create: bool = False) -> StoreManager:
+        """Return the store manager of a collection.
+
+        Raises FileNotFoundError if the collection does not exist, unless
+        create is set.
+        """
+        name = collection_name(name)
+        data_dir = collection_dir(name)
+        if not create and not Path(data_dir).is_dir():
+            raise FileNotFoundError(f"Collection '{name}' not found.")
+        manager = get_store_manager(data_dir)
+        with self._lock:
+            self._used[name] = manager
+            self._used.move_to_end(name)
+        return manager
+
+    def get(self, name: str | None) -> IndexStore:
+        """Return the store of a collection, loading it when needed.
+
+        Raises FileNotFoundError if the collection has no index.
+        """
+        name = collection_name(name)
+        store = self.manager(name).get()
+        self._unload_over_budget(keep=name)
+        return store
+
+    def search_store(self, names: list[str]) -> IndexStore | MultiStore:
+        """Return a store that searches all the named collections."""
+        names = list(dict.fromkeys(collection_name(n) for n in names))
+        if len(names) == 1:
+            return self.get(names[0])
+        return MultiStore(names, [self.get(n) for n in names])
+
+    def _unload_over_budget(self, keep: str) -> None:
+        with self._lock:
+            loaded = [(name, m, m.loaded) for name, m in self._used.items()]
+        loaded = [(name, m, s) for name, m, s in loaded if s is not None]
+        total = sum(s.nbytes for _name, _m, s in loaded)
+        for name, manager, store in loaded:
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            manager.unload()
+            total -= store.nbytes
+            self.unloads += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            used = list(self._used.items())
+        loaded = {name: m.loaded for name, m in used}
+        loaded = {name: s for name, s in loaded.items() if s is not None}
+        return {
+            "loaded": sorted(loaded),
+            "bytes": sum(s.nbytes for s in loaded.values()),
+            "max_bytes": self.max_bytes,
+            "unloads": self.unloads,
+        }
+
+
+class MultiStore:
+    """Searches several collection stores as one.
+
+    Each store is searched for top_k hits and the hits are merged by score.
+    The stores are searched at the same time in a thread pool, FAISS and
+    the query embedding release the GIL while they wait.
+    The scores of a search mode are on the same scale in every store: the
+    cosine similarity for dense, the fused rank score for hybrid and BM25
+    for lexical, which is only roughly comparable between collections.
+    """
+
+    def __init__(self, names: list[str], stores: list[IndexStore]) -> None:
+        self.names = names
+        self.stores = stores
+        stamps = [s.stamp for s in stores]
+        # Identifies the contents of all the stores for the answer cache
+        self.stamp = None if any(s is None for s in stamps) \
+            else tuple(zip(names, stamps))
+
+    def search(
+        self,
+        top_k: int,
+        query: str,
+        nprobe: int | None = None,
+        ef_search: int | None = None,
+        mode: str | None = None,
+        filters: ChunkFilter | None = None,
+    ) -> list[tuple[float, ChunkDoc]]:
+        hits: list[tuple[float, ChunkDoc]] = []
+        for found in _search_pool().map(
+                lambda store: store.search(top_k, query, nprobe, ef_search,
+                                           mode, filters),
+                self.stores):
+            hits += found
+        hits.sort(key=lambda x: x[0], reverse=True)
+        return hits[:top_k]
+
+
+@lru_cache(maxsize=1)
+def _search_pool() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(thread_name_prefix="collection-search")
+
+
+collection_manager = CollectionManager(COLLECTION_MAX_BYTES)
@@ -8,11 +8,30 @@ def _int(name: str, default: int) -> int:
     return int(val)
 
 
+def _float(name: str, default: float) -> float:
+    val = os.getenv(name)
+    if val is None or val == "":
+        return default
+    return float(val)
+
+
+def _int_map(name: str) -> dict[str, int]:
+    """Parse a "key=value,key=value" variable into a dict of ints."""
+    out: dict[str, int] = {}
+    for item in os.getenv(name, "").split(","):
+        key, sep, val = item.partition("=")
+        if sep and key.strip():
+            out[key.strip()] = int(val)
+    return out
+
+
 # OpenAI
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "")
 OPENAI_CHAT_MODEL = os.getenv("OPENAI_CHAT_MODEL", "gpt-4o-mini")
 OPENAI_EMBED_MODEL = os.getenv("OPENAI_EMBED_MODEL", "text-embedding-3-small")
+# Seconds the list of available models is cached
+MODELS_CACHE_TTL = _float("MODELS_CACHE_TTL", 300.0)
 
 # Dir for saving data
 DATA_DIR = os.getenv("DATA_DIR", "data")
@@ -23,9 +42,147 @@ MAX_PAGES = _int("MAX_PAGES", 50)
 # Max depth for the pages
 MAX_DEPTH = _int("MAX_DEPTH", 3)
 
-# Chunk size for the embeds
+# Chunker: "structure" splits on headings, paragraphs and sentences with
+# sizes in tokens, "chars" splits at fixed character offsets
+CHUNKER = os.getenv("CHUNKER", "structure").strip().lower()
+# Max tokens per chunk and tokens of trailing sentences repeated at the
+# start of the next chunk of the same section, for the structure chunker
+CHUNK_TOKENS = _int("CHUNK_TOKENS", 256)
+CHUNK_OVERLAP_TOKENS = _int("CHUNK_OVERLAP_TOKENS", 0)
+# tiktoken encoding used to count tokens, estimated if it is not available
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "cl100k_base")
+# Chunk size and overlap in characters for the chars chunker
 CHUNK_SIZE = _int("CHUNK_SIZE", 1200)
-# Overlap amount for chunks
 CHUNK_OVERLAP = _int("CHUNK_OVERLAP", 200)
 # Number of best hits to return from the index
 TOP_K = _int("TOP_K", 6)
+# Hits retrieved per context slot, the context is picked from them with MMR
+CONTEXT_CANDIDATES = _int("CONTEXT_CANDIDATES", 3)
+# MMR trade-off between relevance and redundancy, 1 ranks by relevance only
+MMR_LAMBDA = _float("MMR_LAMBDA", 0.7)
+# Max tokens of the prompt sent to the chat model: the system prompt,
+# history, context and question
+PROMPT_TOKENS = _int("PROMPT_TOKENS", 8000)
+# Per model prompt tokens, e.g. "gpt-4o=16000,gpt-4o-mini=12000"
+PROMPT_TOKENS_BY_MODEL = _int_map("PROMPT_TOKENS_BY_MODEL")
+# Share of the prompt tokens the history may use, the rest is for context
+HISTORY_TOKEN_SHARE = _float("HISTORY_TOKEN_SHARE", 0.25)
+
+# Seconds between checks for index files changed on disk by another process
+STORE_CHECK_INTERVAL = _float("STORE_CHECK_INTERVAL", 1.0)
+# Max bytes of collection indexes kept loaded, the least recently used
+# collections are unloaded first
+COLLECTION_MAX_BYTES = _int("COLLECTION_MAX_BYTES", 2 * 1024 * 1024 * 1024)
+
+# Max amount of embeddings kept in the on-disk embedding cache, 0 disables it
+EMBED_CACHE_MAX_ROWS = _int("EMBED_CACHE_MAX_ROWS", 200_000)
+
+# Max amount of embedding requests in flight at once
+EMBED_CONCURRENCY = _int("EMBED_CONCURRENCY", 4)
+# Max retries for an embedding request on rate limit and server errors
+EMBED_MAX_RETRIES = _int("EMBED_MAX_RETRIES", 5)
+
+# Max amount of query embeddings kept in memory, 0 disables the cache
+QUERY_CACHE_SIZE = _int("QUERY_CACHE_SIZE", 1024)
+# Seconds a cached query embedding stays valid
+QUERY_CACHE_TTL = _float("QUERY_CACHE_TTL", 3600.0)
+
+# Max amount of answers kept in the answer cache, 0 disables it
+ANSWER_CACHE_SIZE = _int("ANSWER_CACHE_SIZE", 1000)
+# Min cosine similarity of a question to a cached one for its answer to be
+# reused, the retrieved chunks must be the same as well
+ANSWER_CACHE_THRESHOLD = _float("ANSWER_CACHE_THRESHOLD", 0.95)
+# Keep the answer cache in DATA_DIR across restarts
+ANSWER_CACHE_PERSIST = _int("ANSWER_CACHE_PERSIST", 0)
+
+# Where chat sessions are kept: memory, or sqlite to share them between
+# server processes and keep them across restarts
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory").strip().lower()
+# SQLite database of the sessions, defaults to DATA_DIR/sessions.sqlite3
+SESSION_DB = os.getenv("SESSION_DB", "")
+# Seconds a session is kept after its last turn, 0 keeps it until evicted
+SESSION_TTL = _float("SESSION_TTL", 86400.0)
+# Max amount of sessions, the least recently used are evicted first
+SESSION_MAX = _int("SESSION_MAX", 10_000)
+# Max bytes of session history kept in memory by the memory backend
+SESSION_MAX_BYTES = _int("SESSION_MAX_BYTES", 64 * 1024 * 1024)
+# Max tokens of history kept per session, the oldest turns are dropped
+SESSION_HISTORY_TOKENS = _int("SESSION_HISTORY_TOKENS", 4000)
+
+# Milliseconds to wait for more queries to embed in the same request
+QUERY_BATCH_WINDOW_MS = _float("QUERY_BATCH_WINDOW_MS", 2.0)
+# Max amount of queries embedded in one request, 1 disables batching
+QUERY_BATCH_MAX = _int("QUERY_BATCH_MAX", 64)
+# Max amount of query embedding requests in flight at once
+QUERY_BATCH_CONCURRENCY = _int("QUERY_BATCH_CONCURRENCY", 4)
+
+# FAISS index type: auto, flat, hnsw, ivf, ivfpq or opq
+INDEX_TYPE = os.getenv("INDEX_TYPE", "auto").strip().lower()
+# Corpus sizes where the auto index type switches to hnsw, ivf and opq
+ANN_HNSW_MIN = _int("ANN_HNSW_MIN", 100_000)
+ANN_IVF_MIN = _int("ANN_IVF_MIN", 1_000_000)
+ANN_PQ_MIN = _int("ANN_PQ_MIN", 4_000_000)
+# Max amount of vectors used for training IVF and PQ indexes
+ANN_TRAIN_SAMPLE = _int("ANN_TRAIN_SAMPLE", 200_000)
+# Default search parameters for IVF and HNSW indexes
+ANN_NPROBE = _int("ANN_NPROBE", 16)
+ANN_EF_SEARCH = _int("ANN_EF_SEARCH", 64)
+
+# Search mode: hybrid, dense or lexical
+SEARCH_MODE = os.getenv("SEARCH_MODE", "hybrid").strip().lower()
+# Max chunks matched by a search filter that are scored one by one instead
+# of searching the index with the filter, for flat and HNSW indexes
+FILTER_EXACT_MAX = _int("FILTER_EXACT_MAX", 2_000)
+# Weights of the dense and lexical results in reciprocal rank fusion
+DENSE_WEIGHT = _float("DENSE_WEIGHT", 1.0)
+LEXICAL_WEIGHT = _float("LEXICAL_WEIGHT", 1.0)
+# Rank constant of reciprocal rank fusion
+RRF_K = _int("RRF_K", 60)
+# Amount of candidates taken from each retriever per result in hybrid mode
+HYBRID_CANDIDATES = _int("HYBRID_CANDIDATES", 4)
+
+# Amount of ingest jobs processed at once
+INGEST_WORKERS = _int("INGEST_WORKERS", 2)
+# Amount of finished ingest jobs kept for the status API
+INGEST_JOB_HISTORY = _int("INGEST_JOB_HISTORY", 100)
+# Amount of chunks embedded per step of an ingest job
+INGEST_EMBED_BATCH = _int("INGEST_EMBED_BATCH", 1024)
+# Processes that parse and chunk pages, shared by all ingest jobs. 0 runs
+# them in threads of the server process.
+INGEST_PROCESSES = _int("INGEST_PROCESSES", max(1, (os.cpu_count() or 2) - 1))
+# Niceness of the worker processes, so that queries get the CPU first
+INGEST_PROCESS_NICE = _int("INGEST_PROCESS_NICE", 10)
+# Max amount of pages waiting to be chunked during an ingest
+INGEST_PAGE_QUEUE = _int("INGEST_PAGE_QUEUE", 32)
+# Amount of embedding batches of an ingest job in flight at once
+INGEST_EMBED_TASKS = _int("INGEST_EMBED_TASKS", 2)
+# Amount of embedded chunks collected before they are written to the index
+INGEST_COMMIT_CHUNKS = _int("INGEST_COMMIT_CHUNKS", 4096)
+# Pages of a domain a text block must appear on before it is dropped as
+# boilerplate, 0 disables the filter
+EXTRACT_BOILERPLATE_PAGES = _int("EXTRACT_BOILERPLATE_PAGES", 3)
+# Max amount of differing SimHash bits between near duplicate chunks, at
+# most 5, -1 only drops exact duplicates
+DEDUP_MAX_BITS = _int("DEDUP_MAX_BITS", 5)
+# Min amount of words in a text for near duplicate detection
+DEDUP_MIN_WORDS = _int("DEDUP_MIN_WORDS", 24)
+# Seconds between scheduled refreshes of the ingested sites, 0 disables them
+REFRESH_INTERVAL = _float("REFRESH_INTERVAL", 0.0)
+# Deleted chunks are compacted away in the background once they are at
+# least this fraction of the stored rows and at least COMPACT_MIN_DEAD rows
+COMPACT_DEAD_RATIO = _float("COMPACT_DEAD_RATIO", 0.2)
+COMPACT_MIN_DEAD = _int("COMPACT_MIN_DEAD", 1000)
+# Max amount of requests in flight over all hosts of a crawl and per host
+CRAWL_MAX_CONCURRENCY = _int("CRAWL_MAX_CONCURRENCY", 64)
+CRAWL_HOST_CONCURRENCY = _int("CRAWL_HOST_CONCURRENCY", 4)
+# Max requests per second to one host, 0 for no limit. A crawl delay in
+# the host's robots.txt lowers it further.
+CRAWL_HOST_RATE = _float("CRAWL_HOST_RATE", 5.0)
+# Obey the rules and crawl delay of robots.txt files
+CRAWL_RESPECT_ROBOTS = _int("CRAWL_RESPECT_ROBOTS", 1)
+# Retries of a failed request and the base of their exponential backoff
+# in seconds, the actual wait is random up to the backoff
+CRAWL_RETRIES = _int("CRAWL_RETRIES", 2)
+CRAWL_RETRY_BACKOFF = _float("CRAWL_RETRY_BACKOFF", 1.0)
+# Seconds a request may take
+CRAWL_TIMEOUT = _float("CRAWL_TIMEOUT", 30.0)
@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import re
+from dataclasses import dataclass, field
+
+from chunk_store import ChunkDoc
+from config import PROMPT_TOKENS, PROMPT_TOKENS_BY_MODEL
+from tokens import count_tokens
+
+ChatMessage = dict[str, str]
+
+# Tokens the chat format adds to every message
+MESSAGE_OVERHEAD = 4
+# Max characters between chunks of a page that are merged into one block
+_MERGE_GAP = 8
+_WORD_RE = re.compile(r"\w+")
+
+
+@dataclass
+class ContextBlock:
+    """Text of one or more adjacent chunks of a page."""
+
+    url: str
+    title: str
+    heading: str
+    text: str
+    start: int
+    end: int
+    # The merged chunks, in page order
+    chunks: list[ChunkDoc] = field(default_factory=list)
+
+
+def prompt_budget(chat_model: str) -> int:
+    """Return the max prompt tokens of a chat model."""
+    return PROMPT_TOKENS_BY_MODEL.get(chat_model, PROMPT_TOKENS)
+
+
+def message_tokens(content: str) -> int:
+    return count_tokens(content) + MESSAGE_OVERHEAD
+
+
+def mmr(
+    hits: list[tuple[float, ChunkDoc]],
+    k: int,
+    lambda_: float,
+) -> list[tuple[float, ChunkDoc]]:
+    """Pick k of the ranked hits by maximal marginal relevance.
+
+    Relevance is the rank of a hit and redundancy its largest word overlap
+    with the hits picked before it, so near duplicates of a picked hit come
+    after hits with new content. The hits are returned in the order they
+    were picked.
+    """
+    if k <= 0:
+        return []
+    if len(hits) <= k or lambda_ >= 1:
+        return hits[:k]
+    words = [set(_WORD_RE.findall(doc.chunk.lower())) for _score, doc in hits]
+    n = len(hits)
+    gain = [lambda_ * (1 - i / n) for i in range(n)]
+    overlap = [0.0] * n
+    left = list(range(n))
+    picked: list[int] = []
+    while left and len(picked) < k:
+        best = max(left, key=lambda i: gain[i] - (1 - lambda_) * overlap[i])
+        left.remove(best)
+        picked.append(best)
+        for i in left:
+            overlap[i] = max(overlap[i], _jaccard(words[i], words[best]))
+    return [hits[i] for i in picked]
+
+
+def _jaccard(a: set[str], b: set[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def merge_hits(hits: list[tuple[float, ChunkDoc]]) -> list[ContextBlock]:
+    """Merge the hits of a page that overlap or are adjacent in its text.
+
+    A block takes the rank of its best ranked chunk. Chunks stored without
+    their offsets are not merged.
+    """
+    ranked: dict[str, list[tuple[int, ChunkDoc]]] = {}
+    for rank, (_score, doc) in enumerate(hits):
+        ranked.setdefault(doc.url, []).append((rank, doc))
+
+    blocks: list[tuple[int, ContextBlock]] = []
+    for docs in ranked.values():
+        docs.sort(key=lambda x: (x[1].start, x[1].end))
+        cur: ContextBlock | None = None
+        cur_rank = 0
+        for rank, doc in docs:
+            if cur is not None and doc.end > 0 and cur.end > 0 \
+                    and doc.start <= cur.end + _MERGE_GAP:
+                if doc.end > cur.end:
+                    skip = max(0, cur.end - doc.start)
+                    sep = "\n" if doc.start > cur.end else ""
+                    cur.text += sep + doc.chunk[skip:]
+                    cur.end = doc.end
+                cur.chunks.append(doc)
+                cur_rank = min(cur_rank, rank)
+                blocks[-1] = (cur_rank, cur)
+                continue
+            cur = ContextBlock(doc.url, doc.title, doc.heading, doc.chunk,
+                               doc.start, doc.end, [doc])
+            cur_rank = rank
+            blocks.append((cur_rank, cur))
+    blocks.sort(key=lambda x: x[0])
+    return [block for _rank, block in blocks]
+
+
+def build_context(
+    hits: list[tuple[float, ChunkDoc]],
+    max_tokens: int,
+) -> list[ContextBlock]:
+    """Merge the hits into blocks and take the best that fit in max_tokens.
+
+    A block that does not fit is skipped, a smaller later one may still fit.
+    """
+    blocks: list[ContextBlock] = []
+    used = 0
+    for block in merge_hits(hits):
+        tokens = count_tokens(_format_block(len(blocks) + 1, block)) + 2
+        if used + tokens > max_tokens:
+            continue
+        blocks.append(block)
+        used += tokens
+    return blocks
+
+
+def fit_history(
+    history: list[ChatMessage],
+    max_tokens: int,
+    max_messages: int,
+) -> list[ChatMessage]:
+    """Return the latest messages of history that fit in max_tokens."""
+    kept: list[ChatMessage] = []
+    used = 0
+    for m in reversed(history[-max_messages:] if max_messages > 0 else []):
+        tokens = message_tokens(m.get("content") or "")
+        if used + tokens > max_tokens:
+            break
+        kept.append(m)
+        used += tokens
+    kept.reverse()
+    return kept
+
+
+def format_context(blocks: list[ContextBlock]) -> str:
+    """Format the blocks as the numbered context of the prompt."""
+    return "\n\n".join(
+        _format_block(i, block) for i, block in enumerate(blocks, start=1))
+
+
+def _format_block(i: int, block: ContextBlock) -> str:
+    title = block.title.strip() or block.url
+    section = f"SECTION: {block.heading}\n" if block.heading else ""
+    return f"[{i}] {title}\nURL: {block.url}\n{section}CONTENT: {block.text}"
@@ -0,0 +1,201 @@
+from __future__ import annotations
+
+import json
+import os
+import threading
+from dataclasses import asdict, dataclass, field
+from functools import lru_cache
+from pathlib import Path
+from urllib.parse import urlsplit
+
+from config import DATA_DIR
+from dedup import canonical_url
+
+STATE_FILE = "crawl_state.jsonl"
+
+
+@dataclass
+class PageState:
+    """What was fetched from a url the last time it was crawled."""
+
+    url: str
+    etag: str = ""
+    last_modified: str = ""
+    # content_hash() of the extracted text, as hex
+    content_hash: str = ""
+    depth: int = 0
+    fetched_at: float = 0.0
+    # extract.block_keys() of the page, as hex, to count the boilerplate of
+    # its domain when the page is not modified
+    blocks: list[str] = field(default_factory=list)
+
+
+@dataclass
+class Source:
+    """Start url and limits of an ingest, used to refresh it later."""
+
+    url: str
+    max_pages: int
+    max_depth: int
+    refreshed_at: float = 0.0
+
+
+class CrawlState:
+    """Per url crawl metadata used for conditional re-crawls.
+
+    Records are appended to a json lines file and the last record of a url
+    wins. A forget record removes the url. Records appended by other
+    processes are read before every lookup. The file is rewritten without
+    the old records when it has grown to more than twice the size of the
+    state.
+    """
+
+    def __init__(self, data_dir: str | None = None) -> None:
+        self.path = Path(data_dir or DATA_DIR) / STATE_FILE
+        self._lock = threading.Lock()
+        self._pages: dict[str, PageState] = {}
+        self._sources: dict[str, Source] = {}
+        self._records = 0
+        # Inode and offset of the part of the file already read
+        self._read: tuple[int, int] = (0, 0)
+
+    def page(self, url: str) -> PageState | None:
+        with self._lock:
+            self._sync()
+            return self._pages.get(canonical_url(url))
+
+    def pages_of_host(self, host: str) -> list[PageState]:
+        """Return the known pages of a host."""
+        host = host.lower()
+        with self._lock:
+            self._sync()
+            return [p for key, p in self._pages.items()
+                    if urlsplit(key).netloc == host]
+
+    def sources(self) -> list[Source]:
+        with self._lock:
+            self._sync()
+            return list(self._sources.values())
+
+    def update(
+        self,
+        pages: list[PageState] = (),
+        sources: list[Source] = (),
+    ) -> None:
+        """Record the state of crawled pages and ingest sources."""
+        lines = [json.dumps({"kind": "page", **asdict(p)}) + "\n" for p in pages]
+        lines += [json.dumps({"kind": "source", **asdict(s)}) + "\n"
+                  for s in sources]
+        if not lines:
+            return
+        with self._lock:
+            self._append(lines)
+
+    def _append(self, lines: list[str]) -> None:
+        self._sync()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.open("a", encoding="utf-8") as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        self._sync()
+        if self._records > 2 * (len(self._pages) + len(self._sources)) + 1000:
+            self._compact()
+
+    def forget(self, urls: list[str] = (), hosts: list[str] = ()) -> None:
+        """Drop the state of urls and of all pages and sources of hosts."""
+        hosts = {h.lower() for h in hosts}
+        with self._lock:
+            self._sync()
+            keys = {canonical_url(u) for u in urls}
+            keys.update(k for k in (*self._pages, *self._sources)
+                        if urlsplit(k).netloc in hosts)
+        lines = [json.dumps({"kind": "forget", "url": k}) + "\n"
+                 for k in sorted(keys)]
+        if not lines:
+            return
+        with self._lock:
+            self._append(lines)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.path.unlink(missing_ok=True)
+            self._pages.clear()
+            self._sources.clear()
+            self._records = 0
+            self._read = (0, 0)
+
+    def _sync(self) -> None:
+        """Read the records appended since the last read."""
+        try:
+            st = self.path.stat()
+        except FileNotFoundError:
+            if self._read != (0, 0):
+                self._pages.clear()
+                self._sources.clear()
+                self._records = 0
+                self._read = (0, 0)
+            return
+        inode, offset = self._read
+        if st.st_ino != inode:
+            # New or compacted file
+            self._pages.clear()
+            self._sources.clear()
+            self._records = 0
+            offset = 0
+        if st.st_size == offset:
+            self._read = (st.st_ino, offset)
+            return
+        with self.path.open("rb") as f:
+            f.seek(offset)
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break
+                offset += len(raw)
+                self._apply(json.loads(raw))
+        self._read = (st.st_ino, offset)
+
+    def _apply(self, obj: dict) -> None:
+        kind = obj.pop("kind", "page")
+        self._records += 1
+        if kind == "forget":
+            key = canonical_url(obj["url"])
+            self._pages.pop(key, None)
+            self._sources.pop(key, None)
+        elif kind == "source":
+            src = Source(**obj)
+            self._sources[canonical_url(src.url)] = src
+        else:
+            page = PageState(**obj)
+            self._pages[canonical_url(page.url)] = page
+
+    def _compact(self) -> None:
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with tmp.open("w", encoding="utf-8") as f:
+            for p in self._pages.values():
+                f.write(json.dumps({"kind": "page", **asdict(p)}) + "\n")
+            for s in self._sources.values():
+                f.write(json.dumps({"kind": "source", **asdict(s)}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self._read = (0, 0)
+        self._sync()
+
+
+def conditional_headers(state: PageState | None) -> dict[str, str]:
+    """Request headers that let the server answer 304 if nothing changed."""
+    headers: dict[str, str] = {}
+    if state is None:
+        return headers
+    if state.etag:
+        headers["If-None-Match"] = state.etag
+    if state.last_modified:
+        headers["If-Modified-Since"] = state.last_modified
+    return headers
+
+
+@lru_cache(maxsize=None)
+def get_crawl_state(data_dir: str | None = None) -> CrawlState:
+    """Return the process wide crawl state of a data dir."""
+    return CrawlState(data_dir)
@@ -1,9 +1,53 @@
 from __future__ import annotations
 
 import asyncio
-from crawlee.crawlers import BasicCrawlingContext, BeautifulSoupCrawler, BeautifulSoupCrawlingContext
+import logging
+import random
+import time
+import uuid
+from collections.abc import Awaitable, Callable, Iterable, Sequence
+from datetime import timedelta
+from crawlee import ConcurrencySettings, Request, RequestOptions
+from crawlee.http_clients import (
+    HttpCrawlingResult,
+    HttpResponse,
+    ImpitHttpClient,
+)
+from crawlee.storage_clients import MemoryStorageClient
+from crawlee.storages import RequestQueue
+from crawlee.crawlers import (
+    AbstractHttpCrawler,
+    AbstractHttpParser,
+    BasicCrawlingContext,
+    ParsedHttpCrawlingContext,
+)
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from urllib.parse import urljoin, urlsplit
+from urllib.robotparser import RobotFileParser
+
+from config import (
+    CRAWL_HOST_CONCURRENCY,
+    CRAWL_HOST_RATE,
+    CRAWL_MAX_CONCURRENCY,
+    CRAWL_RESPECT_ROBOTS,
+    CRAWL_RETRIES,
+    CRAWL_RETRY_BACKOFF,
+    CRAWL_TIMEOUT,
+    USER_AGENT,
+)
+from extract import ParsedPage, parse_html
+from workers import run_cpu
+
+try:
+    from crawlee._utils.blocked import RETRY_CSS_SELECTORS
+except ImportError:
+    RETRY_CSS_SELECTORS = ()
+
+log = logging.getLogger(__name__)
+
+# Sent with every request, robots.txt rules for USER_AGENT apply to the crawl
+_HEADERS = {"User-Agent": USER_AGENT}
 
 
 @dataclass(frozen=True)
@@ -11,27 +55,259 @@ class PageDoc:
     url: str
     title: str
     text: str
+    # Size of the whole page text before content extraction
+    raw_bytes: int = 0
+    # Url given by the page's canonical link, empty if it has none
+    canonical: str = ""
+    depth: int = 0
+    # Validators sent by the server for conditional requests
+    etag: str = ""
+    last_modified: str = ""
+    # The server answered 304, the page has no text
+    not_modified: bool = False
+    # Content blocks joined in text, repeated boilerplate is removed later
+    # by the ingest, see extract.BoilerplateFilter
+    blocks: tuple[str, ...] = ()
 
 
-async def crawl_async(
+@dataclass
+class CrawlStats:
+    """Throughput of a crawl, updated while it runs."""
+
+    pages: int = 0
+    # Response body bytes
+    bytes: int = 0
+    retries: int = 0
+    failed: int = 0
+    started_at: float = field(default_factory=time.monotonic)
+    finished_at: float | None = None
+    # Pages, bytes and robots.txt crawl delay per host
+    hosts: dict[str, dict[str, float]] = field(default_factory=dict)
+
+    def add_page(self, host: str, size: int) -> None:
+        self.pages += 1
+        self.bytes += size
+        h = self.hosts.setdefault(host, {"pages": 0, "bytes": 0})
+        h["pages"] += 1
+        h["bytes"] += size
+
+    def to_dict(self) -> dict:
+        end = self.finished_at if self.finished_at is not None \
+            else time.monotonic()
+        seconds = max(end - self.started_at, 1e-9)
+        return {
+            "pages": self.pages,
+            "bytes": self.bytes,
+            "retries": self.retries,
+            "failed": self.failed,
+            "seconds": round(seconds, 3),
+            "pages_per_sec": round(self.pages / seconds, 2),
+            "bytes_per_sec": round(self.bytes / seconds, 1),
+            "hosts": self.hosts,
+        }
+
+
+async def crawl_stream(
     urls: set[str],
     max_pages: int,
     max_depth: int,
-) -> list[PageDoc]:
-    """Crawl a list of urls and scrape the data."""
-    crawler = BeautifulSoupCrawler(
-        max_request_retries=0,
-        max_requests_per_crawl=max_pages,
-    )
-    docs: list[PageDoc] = []
+    on_page: Callable[[PageDoc], Awaitable[None]],
+    seeds: list[tuple[str, int]] = (),
+    headers_for: Callable[[str], dict[str, str]] | None = None,
+    stats: CrawlStats | None = None,
+) -> int:
+    """Crawl a list of urls and pass every page to on_page.
+
+    Pages are not kept after on_page returns. A slow on_page slows the
+    crawl down, which bounds memory use. Returns the amount of pages.
+
+    seeds are (url, depth) pairs of pages known from earlier crawls, they
+    are crawled after urls. headers_for returns the conditional request
+    headers of a url, pages answered with 304 are passed to on_page with
+    not_modified set and their links are not followed. The start urls are
+    always fetched in full so their links are followed.
+
+    Every host is crawled by a crawler of its own, all at the same time, so
+    a slow host does not hold up the others. Each host gets at most
+    CRAWL_HOST_CONCURRENCY requests at once, and together at most
+    CRAWL_MAX_CONCURRENCY, a slot freed by one host is taken by the next
+    request of any host. A host starts at half its limit and is scaled up
+    while the system is idle. Requests to a host are spaced by CRAWL_HOST_RATE
+    or by the crawl delay of its robots.txt, whichever is slower. stats is
+    updated while the crawl runs. Pages are parsed and their content is
+    extracted in the worker processes, see workers.run_cpu().
+    """
+    start: dict[str, list[Request]] = {}
+    for url in sorted(urls):
+        start.setdefault(_host_of(url), []).append(
+            Request.from_url(url, user_data={"depth": 0}))
+    for url, depth in seeds:
+        if depth <= max_depth:
+            start.setdefault(_host_of(url), []).append(Request.from_url(
+                url, user_data={"depth": depth},
+                headers=headers_for(url) if headers_for else None))
+    crawl = _Crawl(max_pages, max_depth, on_page, headers_for,
+                   stats or CrawlStats())
+    try:
+        async with asyncio.TaskGroup() as tg:
+            for host, requests in start.items():
+                tg.create_task(crawl.run_host(host, requests))
+    finally:
+        crawl.stats.finished_at = time.monotonic()
+    return crawl.pages
+
+
+def _host_of(url: str) -> str:
+    return urlsplit(url).netloc.lower()
+
+
+class _PoolParser(AbstractHttpParser[ParsedPage, ParsedPage]):
+    """Parses pages in the worker processes instead of the event loop.
+
+    The response body is sent to a worker and only the links, metadata and
+    content blocks of the page come back, see extract.parse_html().
+    """
+
+    async def parse(self, response: HttpResponse) -> ParsedPage:
+        body = await response.read()
+        if response.status_code == 304 or not body:
+            return ParsedPage()
+        return await run_cpu(parse_html, body,
+                             response.headers.get("content-type"),
+                             tuple(RETRY_CSS_SELECTORS))
+
+    async def parse_text(self, text: str) -> ParsedPage:
+        return await run_cpu(parse_html, text.encode("utf-8"),
+                             "text/html; charset=utf-8",
+                             tuple(RETRY_CSS_SELECTORS))
+
+    async def select(self, parsed_content: ParsedPage,
+                     selector: str) -> Sequence[ParsedPage]:
+        return ()
+
+    def is_matching_selector(self, parsed_content: ParsedPage,
+                             selector: str) -> bool:
+        return selector in parsed_content.matched
+
+    def find_links(self, parsed_content: ParsedPage, selector: str,
+                   attribute: str) -> Iterable[str]:
+        # The crawler asks for the <base> href and for the links to follow
+        if selector.startswith("base"):
+            return [parsed_content.base] if parsed_content.base else []
+        return parsed_content.links
+
+
+class _SlotHttpClient(ImpitHttpClient):
+    """HTTP client whose requests wait for a slot of a shared semaphore."""
+
+    def __init__(self, slots: asyncio.Semaphore) -> None:
+        super().__init__(headers=_HEADERS)
+        self.slots = slots
+
+    async def crawl(self, request: Request, **kwargs) -> HttpCrawlingResult:
+        async with self.slots:
+            return await super().crawl(request, **kwargs)
+
+
+class _PageCrawler(AbstractHttpCrawler.create_parsed_http_crawler_class(
+        static_parser=_PoolParser())):
+    """Crawler of the pages of one host, see _Crawl.run_host()."""
 
-    @crawler.failed_request_handler
-    async def failed_handler(ctx: BasicCrawlingContext, error: Exception) -> None:
-        ctx.log.warning(f"Failed to fetch {ctx.request.url}: {error}")
 
-    @crawler.router.default_handler
-    async def request_handler(ctx: BeautifulSoupCrawlingContext) -> None:
-        if len(docs) >= max_pages:
+class _Crawl:
+    """State shared by the host crawlers of one crawl_stream() call."""
+
+    def __init__(
+        self,
+        max_pages: int,
+        max_depth: int,
+        on_page: Callable[[PageDoc], Awaitable[None]],
+        headers_for: Callable[[str], dict[str, str]] | None,
+        stats: CrawlStats,
+    ) -> None:
+        self.max_pages = max_pages
+        self.max_depth = max_depth
+        self.on_page = on_page
+        self.headers_for = headers_for
+        self.stats = stats
+        self.pages = 0
+        # Requests in flight over all hosts, the hosts take free slots as
+        # they need them
+        self.slots = asyncio.Semaphore(max(1, CRAWL_MAX_CONCURRENCY))
+        self.crawlers: list[AbstractHttpCrawler] = []
+
+    async def run_host(self, host: str, requests: list[Request]) -> None:
+        robots = await _robots(requests[0].url) if CRAWL_RESPECT_ROBOTS \
+            else None
+        delay = float((robots.crawl_delay(USER_AGENT) if robots else None) or 0)
+        self.stats.hosts.setdefault(host, {"pages": 0, "bytes": 0})[
+            "crawl_delay"] = delay
+        requests = [r for r in requests
+                    if robots is None or robots.can_fetch(USER_AGENT, r.url)]
+        if not requests or self.pages >= self.max_pages:
+            return
+
+        per_minute = float("inf")
+        if CRAWL_HOST_RATE > 0:
+            per_minute = CRAWL_HOST_RATE * 60
+        if delay > 0:
+            per_minute = min(per_minute, 60 / delay)
+        # A crawl delay asks for one request at a time
+        concurrency = 1 if delay > 0 else max(1, CRAWL_HOST_CONCURRENCY)
+
+        # A queue of its own, the default queue is shared by all crawls of
+        # the process and would skip urls handled by an earlier crawl
+        queue = await RequestQueue.open(
+            alias=f"crawl-{uuid.uuid4().hex}",
+            storage_client=MemoryStorageClient(),
+        )
+        crawler = _PageCrawler(
+            request_manager=queue,
+            http_client=_SlotHttpClient(self.slots),
+            max_request_retries=CRAWL_RETRIES,
+            max_requests_per_crawl=self.max_pages,
+            navigation_timeout=timedelta(seconds=CRAWL_TIMEOUT),
+            request_handler_timeout=timedelta(seconds=max(60.0, 2 * CRAWL_TIMEOUT)),
+            concurrency_settings=ConcurrencySettings(
+                max_concurrency=concurrency,
+                # The pool scales up from here while the system is idle
+                desired_concurrency=max(1, concurrency // 2),
+                max_tasks_per_minute=per_minute,
+            ),
+        )
+        self.crawlers.append(crawler)
+
+        @crawler.error_handler
+        async def error_handler(ctx: BasicCrawlingContext, error: Exception) -> None:
+            # Wait before the retry, with jitter so retries of many requests
+            # do not hit the host at the same time
+            self.stats.retries += 1
+            backoff = CRAWL_RETRY_BACKOFF * 2 ** ctx.request.retry_count
+            await asyncio.sleep(random.uniform(0, backoff))
+
+        @crawler.failed_request_handler
+        async def failed_handler(ctx: BasicCrawlingContext, error: Exception) -> None:
+            self.stats.failed += 1
+            ctx.log.warning(f"Failed to fetch {ctx.request.url}: {error}")
+
+        @crawler.router.default_handler
+        async def request_handler(
+            ctx: ParsedHttpCrawlingContext[ParsedPage],
+        ) -> None:
+            await self._handle(ctx, host, robots)
+
+        try:
+            await crawler.run(requests)
+        finally:
+            await queue.drop()
+
+    async def _handle(
+        self,
+        ctx: ParsedHttpCrawlingContext[ParsedPage],
+        host: str,
+        robots: RobotFileParser | None,
+    ) -> None:
+        if self.pages >= self.max_pages:
             return
 
         user_data = ctx.request.user_data or {}
@@ -43,23 +319,97 @@ async def crawl_async(
         else:
             depth = 0
 
-        data = PageDoc(
+        self.pages += 1
+        if self.pages >= self.max_pages:
+            # The page budget is shared, the other hosts can stop
+            for crawler in self.crawlers:
+                crawler.stop("Page limit reached")
+        self.stats.add_page(host, len(await ctx.http_response.read()))
+        if ctx.http_response.status_code == 304:
+            await self.on_page(PageDoc(
+                url=ctx.request.url, title="", text="", depth=depth,
+                not_modified=True,
+            ))
+            return
+
+        def add_headers(options: RequestOptions) -> RequestOptions | str:
+            if robots is not None and not robots.can_fetch(USER_AGENT, options["url"]):
+                return "skip"
+            headers = self.headers_for(options["url"]) \
+                if self.headers_for else None
+            if not headers:
+                return "unchanged"
+            options["headers"] = headers
+            return options
+
+        if depth < self.max_depth:
+            await ctx.enqueue_links(
+                strategy="same-domain",
+                user_data={"depth": depth + 1},
+                transform_request_function=add_headers,
+            )
+
+        parsed = ctx.parsed_content
+        await self.on_page(PageDoc(
             url=ctx.request.url,
-            title=(ctx.soup.title.string or "") if ctx.soup.title else "",
-            text=ctx.soup.text,
-        )
-        docs.append(data)
-        await ctx.push_data({"url": data.url, "title": data.title, "text": data.text})
+            title=parsed.title,
+            text="\n\n".join(parsed.blocks),
+            raw_bytes=parsed.raw_bytes,
+            canonical=_canonical_link(parsed.canonical, ctx.request.url),
+            depth=depth,
+            etag=ctx.http_response.headers.get("etag", ""),
+            last_modified=ctx.http_response.headers.get("last-modified", ""),
+            blocks=parsed.blocks,
+        ))
 
-        if depth >= max_depth:
-            return
 
-        await ctx.enqueue_links(
-            strategy="same-domain",
-            user_data={"depth": depth + 1},
-        )
+async def _robots(url: str) -> RobotFileParser | None:
+    """Fetch the robots.txt of the host of url, None if there are no rules.
+
+    A missing file allows everything, a server error disallows everything.
+    """
+    parts = urlsplit(url)
+    robots_url = f"{parts.scheme}://{parts.netloc}/robots.txt"
+    try:
+        async with ImpitHttpClient(headers=_HEADERS) as http:
+            response = await http.send_request(
+                robots_url, timeout=timedelta(seconds=CRAWL_TIMEOUT))
+            body = await response.read()
+    except Exception as e:
+        log.warning("Failed to read %s: %s", robots_url, e)
+        return None
+    robots = RobotFileParser(robots_url)
+    if response.status_code >= 500:
+        robots.disallow_all = True
+    elif response.status_code >= 400:
+        return None
+    else:
+        robots.parse(body.decode("utf-8", errors="replace").splitlines())
+    return robots
+
+
+def _canonical_link(href: str, url: str) -> str:
+    """Return the canonical link of a page if it points to the same host."""
+    if not href:
+        return ""
+    href = urljoin(url, href)
+    if urlsplit(href).netloc.lower() != urlsplit(url).netloc.lower():
+        return ""
+    return href
+
+
+async def crawl_async(
+    urls: set[str],
+    max_pages: int,
+    max_depth: int,
+) -> list[PageDoc]:
+    """Crawl a list of urls and scrape the data."""
+    docs: list[PageDoc] = []
+
+    async def on_page(page: PageDoc) -> None:
+        docs.append(page)
 
-    await crawler.run(list(urls))
+    await crawl_stream(urls, max_pages, max_depth, on_page)
     return docs
 
 
@@ -0,0 +1,299 @@
+from __future__ import annotations
+
+import hashlib
+import re
+import zlib
+from pathlib import Path
+from typing import TYPE_CHECKING
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import numpy as np
+
+from config import DEDUP_MAX_BITS, DEDUP_MIN_WORDS
+
+if TYPE_CHECKING:
+    from index_store import IndexStore
+
+# Exact content hash and SimHash of one chunk, one row per chunk store row.
+# A simhash of 0 means the text was too short for near duplicate detection.
+SIG_DTYPE = np.dtype([("hash", "<u8"), ("simhash", "<u8")])
+SIG_FILE = "chunks.sig"
+
+# Query parameters that do not change the content of a page
+_IGNORED_PARAMS = re.compile(
+    r"^(utm_.*|gclid|fbclid|msclkid|mc_[a-z]+|ref|ref_src|sessionid"
+    r"|session_id|sid|phpsessid|jsessionid|print|printable)$",
+    re.IGNORECASE,
+)
+_INDEX_PAGE = re.compile(r"/(index|default)\.(html?|php|aspx?)$", re.IGNORECASE)
+_WORD_RE = re.compile(r"\w+")
+_SPACE = re.compile(r"\s+")
+
+# SimHash bands as (shift, bits). A near duplicate within len(_BANDS) - 1
+# bits of another shares at least one band with it.
+_BANDS = ((0, 11), (11, 11), (22, 11), (33, 11), (44, 10), (54, 10))
+_SHINGLE = 3
+_M64 = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+
+def canonical_url(url: str) -> str:
+    """Normalize a url so that variants of the same page compare equal.
+
+    Lowercases the scheme and host, drops default ports, fragments, tracking
+    and print parameters, sorts the remaining query parameters and removes
+    index pages and trailing slashes.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    port = parts.port
+    if port and (scheme, port) not in (("http", 80), ("https", 443)):
+        host = f"{host}:{port}"
+    path = _INDEX_PAGE.sub("/", parts.path or "/")
+    path = re.sub(r"/{2,}", "/", path)
+    if len(path) > 1:
+        path = path.rstrip("/")
+    query = sorted(
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if not _IGNORED_PARAMS.match(k)
+    )
+    return urlunsplit((scheme, host, path, urlencode(query), ""))
+
+
+def normalize_text(text: str) -> str:
+    return _SPACE.sub(" ", text.lower()).strip()
+
+
+def content_hash(text: str) -> int:
+    """Return a 64 bit hash of the normalized text."""
+    digest = hashlib.blake2b(
+        normalize_text(text).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def simhash(text: str, min_words: int = DEDUP_MIN_WORDS) -> int:
+    """Return the 64 bit SimHash of the word shingles of a text.
+
+    Texts with less than min_words words get 0, they are too short for the
+    hash to tell near duplicates from unrelated texts.
+    """
+    words = _WORD_RE.findall(text.lower())
+    if len(words) < max(min_words, _SHINGLE):
+        return 0
+    h = np.fromiter((zlib.crc32(w.encode("utf-8")) for w in words),
+                    dtype=np.uint64, count=len(words))
+    shingles = h[:-2] * np.uint64(0x9E3779B97F4A7C15) \
+        ^ h[1:-1] * np.uint64(0xC2B2AE3D27D4EB4F) ^ h[2:]
+    shingles = _mix64(shingles)
+    bits = (shingles[:, None] >> np.arange(64, dtype=np.uint64)) & np.uint64(1)
+    votes = bits.sum(axis=0) * 2 > len(shingles)
+    fp = int((np.uint64(1) << np.flatnonzero(votes).astype(np.uint64)).sum())
+    # 0 is reserved for texts without a simhash
+    return fp or 1
+
+
+def _mix64(x: np.ndarray) -> np.ndarray:
+    """splitmix64 finalizer, spreads the shingle hashes over all bits."""
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return (x ^ (x >> np.uint64(31))) & _M64
+
+
+def signatures(
+    texts: list[str],
+    min_words: int = DEDUP_MIN_WORDS,
+) -> np.ndarray:
+    """Return the content hash and simhash of every text."""
+    sigs = np.zeros(len(texts), dtype=SIG_DTYPE)
+    for i, text in enumerate(texts):
+        sigs[i] = (content_hash(text), simhash(text, min_words))
+    return sigs
+
+
+def hamming(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Return the amount of differing bits between uint64 arrays."""
+    x = np.ascontiguousarray(np.bitwise_xor(a, b), dtype=np.uint64)
+    return np.unpackbits(x.view(np.uint8)).reshape(-1, 64).sum(axis=1)
+
+
+def _band_keys(sims: np.ndarray, band: int) -> np.ndarray:
+    shift, bits = _BANDS[band]
+    keys = (sims >> np.uint64(shift)) & np.uint64((1 << bits) - 1)
+    return keys.astype(np.uint16)
+
+
+class Signatures:
+    """Content signatures of the stored chunks.
+
+    Row i holds the signature of chunk store row i. Like the chunk store, a
+    Signatures object is an immutable view of the first n rows of its file.
+    The lookup tables are sorted arrays built on the first lookup.
+    """
+
+    def __init__(self, data_dir: Path, sigs: np.ndarray) -> None:
+        self.data_dir = data_dir
+        self.sigs = sigs
+        # Sorted hashes and band keys and the rows they belong to
+        self._hashes: tuple[np.ndarray, np.ndarray] | None = None
+        self._bands: list[tuple[np.ndarray, np.ndarray]] | None = None
+
+    def __len__(self) -> int:
+        return len(self.sigs)
+
+    @classmethod
+    def open(cls, data_dir: Path, max_rows: int | None = None) -> Signatures:
+        path = data_dir / SIG_FILE
+        n = path.stat().st_size // SIG_DTYPE.itemsize if path.exists() else 0
+        if max_rows is not None:
+            n = min(n, max_rows)
+        if n == 0:
+            return cls(data_dir, np.zeros(0, dtype=SIG_DTYPE))
+        sigs = np.memmap(path, dtype=SIG_DTYPE, mode="r", shape=(n,))
+        return cls(data_dir, sigs)
+
+    def append(self, sigs: np.ndarray) -> Signatures:
+        """Write sigs after the rows of this view and return the new view."""
+        path = self.data_dir / SIG_FILE
+        path.touch()
+        with path.open("r+b") as f:
+            f.seek(len(self) * SIG_DTYPE.itemsize)
+            f.truncate()
+            f.write(np.ascontiguousarray(sigs, dtype=SIG_DTYPE).tobytes())
+        return Signatures.open(self.data_dir, len(self) + len(sigs))
+
+    def rows_with_hash(self, h: int) -> np.ndarray:
+        """Return the rows with the content hash."""
+        if self._hashes is None:
+            hashes = np.asarray(self.sigs["hash"])
+            order = np.argsort(hashes, kind="stable").astype(np.uint32)
+            self._hashes = (hashes[order], order)
+        hashes, order = self._hashes
+        q = np.uint64(h)
+        lo, hi = np.searchsorted(hashes, q), np.searchsorted(hashes, q, "right")
+        return order[lo:hi]
+
+    def rows_near(self, sim: int, max_bits: int) -> np.ndarray:
+        """Return the rows whose simhash is within max_bits of sim."""
+        if sim == 0 or max_bits < 0 or len(self) == 0:
+            return np.zeros(0, dtype=np.uint32)
+        sims = np.asarray(self.sigs["simhash"])
+        if self._bands is None:
+            bands = []
+            for band in range(len(_BANDS)):
+                keys = _band_keys(sims, band)
+                order = np.argsort(keys, kind="stable").astype(np.uint32)
+                bands.append((keys[order], order))
+            self._bands = bands
+        q = np.uint64(sim)
+        found: list[np.ndarray] = []
+        for band, (keys, order) in enumerate(self._bands):
+            key = _band_keys(q, band)
+            lo, hi = np.searchsorted(keys, key), np.searchsorted(keys, key, "right")
+            rows = order[lo:hi]
+            cands = sims[rows]
+            found.append(rows[(cands != 0) & (hamming(cands, q) <= max_bits)])
+        return np.unique(np.concatenate(found))
+
+
+class Deduper:
+    """Drops duplicate pages and chunks of one ingest before embedding.
+
+    Pages are compared by canonical url and content with the earlier pages
+    of the ingest. Chunks are compared by exact content hash and by SimHash
+    with the earlier chunks of the ingest and with the live chunks of the
+    store. Stored chunks of the same url are ignored, the page replaces
+    them.
+    """
+
+    def __init__(
+        self,
+        store: IndexStore | None,
+        max_bits: int = DEDUP_MAX_BITS,
+        min_words: int = DEDUP_MIN_WORDS,
+    ) -> None:
+        # The bands only find every match up to len(_BANDS) - 1 bits
+        self.max_bits = min(max_bits, len(_BANDS) - 1)
+        self.min_words = min_words
+        self.store = store
+        self._url_pages: dict[str, list[int]] = {}
+        if store is not None:
+            for i, (url, _title) in enumerate(store.docs.pages):
+                self._url_pages.setdefault(url, []).append(i)
+        self._urls: set[str] = set()
+        self._pages: set[int] = set()
+        self._page_sims: dict[tuple[int, int], list[int]] = {}
+        self._hashes: set[int] = set()
+        self._sims: dict[tuple[int, int], list[int]] = {}
+
+    def is_duplicate_page(self, url: str, text: str) -> bool:
+        """Check a page and remember it if it is new."""
+        url = canonical_url(url)
+        if url in self._urls:
+            return True
+        self._urls.add(url)
+        h = content_hash(text)
+        if h in self._pages:
+            return True
+        sim = simhash(text, self.min_words)
+        if self._near(self._page_sims, sim):
+            return True
+        self._pages.add(h)
+        self._remember(self._page_sims, sim)
+        return False
+
+    def new_chunks(
+        self,
+        texts: list[str],
+        url: str = "",
+        sigs: np.ndarray | None = None,
+    ) -> list[int]:
+        """Return the indexes of the texts of a page that are not duplicates.
+
+        sigs are the signatures() of the texts if they are already known.
+        """
+        if sigs is None:
+            sigs = signatures(texts, self.min_words)
+        keep: list[int] = []
+        for i, (h, sim) in enumerate(sigs.tolist()):
+            if h in self._hashes or self._in_store(
+                    self.store.sigs.rows_with_hash(h) if self.store else None,
+                    url):
+                continue
+            self._hashes.add(h)
+            if self._near(self._sims, sim) or self._in_store(
+                    self.store.sigs.rows_near(sim, self.max_bits)
+                    if self.store else None, url):
+                continue
+            self._remember(self._sims, sim)
+            keep.append(i)
+        return keep
+
+    def _in_store(self, rows: np.ndarray | None, url: str) -> bool:
+        """Return True if any of the stored rows is live and of another url."""
+        if rows is None or not len(rows):
+            return False
+        docs = self.store.docs
+        rows = rows[rows < len(docs)]
+        rows = rows[docs.alive[rows]]
+        own = self._url_pages.get(url)
+        if own and len(rows):
+            rows = rows[~np.isin(docs.page_rows()[rows], own)]
+        return bool(len(rows))
+
+    def _near(self, table: dict[tuple[int, int], list[int]], sim: int) -> bool:
+        if sim == 0 or self.max_bits < 0:
+            return False
+        q = np.uint64(sim)
+        for band in range(len(_BANDS)):
+            cands = table.get((band, int(_band_keys(q, band))))
+            if cands and hamming(np.array(cands, dtype=np.uint64), q).min() \
+                    <= self.max_bits:
+                return True
+        return False
+
+    def _remember(self, table: dict[tuple[int, int], list[int]], sim: int) -> None:
+        if sim == 0:
+            return
+        q = np.uint64(sim)
+        for band in range(len(_BANDS)):
+            table.setdefault((band, int(_band_keys(q, band))), []).append(sim)
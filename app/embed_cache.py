@@ -0,0 +1,270 @@
+from __future__ import annotations
+
+import fcntl
+import hashlib
+import json
+import os
+import re
+import threading
+from collections.abc import Iterator
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+
+from config import DATA_DIR, EMBED_CACHE_MAX_ROWS
+
+_KEY_BYTES = 16
+_MIN_ROWS = 1024
+
+
+def text_key(text: str) -> bytes:
+    """Hash of a text used as the cache key."""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=_KEY_BYTES).digest()
+
+
+class EmbedCache:
+    """Persistent embedding cache for one embedding model.
+
+    Vectors, text hashes and last used ticks are kept in memory mapped files
+    with a row per entry. The least recently used rows are evicted when the
+    cache is full. A row with tick 0 is free.
+
+    Writes only touch the rows they add and hold a lock file, so processes
+    sharing the cache do not take the same rows. A process reads the rows
+    added by the others when it next writes. The ticks of cache hits reach
+    the disk with the next write. The hash of a row is cleared before its
+    vector is replaced and checked again after the vector is read, so a
+    reader never gets the vector of another text.
+    """
+
+    def __init__(self, path: Path, max_rows: int) -> None:
+        self.path = path
+        self.max_rows = max_rows
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    @property
+    def _vecs_path(self) -> Path:
+        return self.path / "vectors.f32"
+
+    @property
+    def _keys_path(self) -> Path:
+        return self.path / "keys.u8"
+
+    @property
+    def _used_path(self) -> Path:
+        return self.path / "used.i64"
+
+    @property
+    def _meta_path(self) -> Path:
+        return self.path / "meta.json"
+
+    def _clear(self, dim: int = 0) -> None:
+        self._dim = dim
+        self._tick = 0
+        # Number of writes to the files when they were last read
+        self._generation = 0
+        self._vecs: np.memmap | None = None
+        self._keys = np.zeros((0, _KEY_BYTES), dtype=np.uint8)
+        self._used = np.zeros(0, dtype=np.int64)
+        self._rows: dict[bytes, int] = {}
+        self._free: list[int] = []
+
+    def _read_meta(self) -> dict | None:
+        try:
+            return json.loads(self._meta_path.read_text())
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self) -> None:
+        tmp = self._meta_path.with_name(self._meta_path.name + ".tmp")
+        tmp.write_text(json.dumps(
+            {"dim": self._dim, "generation": self._generation}))
+        os.replace(tmp, self._meta_path)
+
+    def _load(self) -> None:
+        """Map the files of the cache and index its live rows."""
+        self._clear()
+        meta = self._read_meta()
+        if meta is None:
+            return
+        try:
+            dim = int(meta["dim"])
+            generation = int(meta.get("generation", 0))
+            vecs = np.memmap(self._vecs_path, dtype=np.float32, mode="r+")
+            keys = np.memmap(self._keys_path, dtype=np.uint8, mode="r+")
+            used = np.memmap(self._used_path, dtype=np.int64, mode="r+")
+            vecs = vecs.reshape(-1, dim)
+            keys = keys.reshape(-1, _KEY_BYTES)
+        except (OSError, ValueError, KeyError):
+            # Empty or unreadable cache, start from scratch
+            return
+        rows = min(len(keys), len(used), vecs.shape[0])
+        self._dim = dim
+        self._generation = generation
+        self._vecs = vecs[:rows]
+        self._keys = keys[:rows]
+        self._used = used[:rows]
+        self._tick = int(self._used.max(initial=0))
+        live = (self._used > 0) & self._keys.any(axis=1)
+        rows_live = np.flatnonzero(live)
+        flat = self._keys[rows_live].tobytes()
+        self._rows = {
+            flat[i * _KEY_BYTES:(i + 1) * _KEY_BYTES]: row
+            for i, row in enumerate(rows_live.tolist())}
+        self._free = np.flatnonzero(~live)[::-1].tolist()
+
+    def _reset(self, dim: int) -> None:
+        """Drop all entries and start storing vectors of a new dimension.
+
+        New files replace the old ones, the mappings of other processes stay
+        valid until they read the cache again.
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        generation = self._generation
+        self._clear(dim)
+        self._generation = generation
+        for path in (self._vecs_path, self._keys_path, self._used_path):
+            tmp = path.with_name(path.name + ".tmp")
+            tmp.write_bytes(b"")
+            os.replace(tmp, path)
+        # Files of the earlier format
+        for name in ("keys.npy", "used.npy"):
+            (self.path / name).unlink(missing_ok=True)
+
+    def _grow(self, needed: int) -> None:
+        """Make room for at least `needed` more rows, up to max_rows."""
+        size = len(self._keys)
+        new_size = min(self.max_rows, max(size * 2, size + needed, _MIN_ROWS))
+        if new_size <= size:
+            return
+        for path, row_bytes in ((self._vecs_path, self._dim * 4),
+                                (self._keys_path, _KEY_BYTES),
+                                (self._used_path, 8)):
+            with path.open("r+b") as f:
+                f.truncate(new_size * row_bytes)
+        self._vecs = np.memmap(
+            self._vecs_path, dtype=np.float32, mode="r+",
+            shape=(new_size, self._dim),
+        )
+        self._keys = np.memmap(
+            self._keys_path, dtype=np.uint8, mode="r+",
+            shape=(new_size, _KEY_BYTES),
+        )
+        self._used = np.memmap(
+            self._used_path, dtype=np.int64, mode="r+", shape=(new_size,))
+        self._free.extend(range(new_size - 1, size - 1, -1))
+
+    def _evict(self, count: int) -> None:
+        """Free `count` least recently used rows."""
+        used = np.where(self._used > 0, self._used, np.iinfo(np.int64).max)
+        count = min(count, len(used))
+        rows = np.argpartition(used, count - 1)[:count]
+        for row in rows.tolist():
+            self._rows.pop(self._keys[row].tobytes(), None)
+            self._used[row] = 0
+            self._free.append(row)
+            self.evictions += 1
+
+    @contextmanager
+    def _writer(self) -> Iterator[None]:
+        """Hold the lock file shared by the writers of all processes."""
+        self.path.mkdir(parents=True, exist_ok=True)
+        with (self.path / ".write.lock").open("a") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def get_many(self, keys: list[bytes]) -> list[np.ndarray | None]:
+        """Return the cached vectors, None for the misses."""
+        out: list[np.ndarray | None] = []
+        with self._lock:
+            self._tick += 1
+            for key in keys:
+                row = self._rows.get(key)
+                vec = None
+                if row is not None and self._vecs is not None:
+                    vec = np.array(self._vecs[row])
+                    # The row may have been taken by another process
+                    if self._keys[row].tobytes() != key:
+                        del self._rows[key]
+                        vec = None
+                if vec is None:
+                    self.misses += 1
+                    out.append(None)
+                    continue
+                self.hits += 1
+                self._used[row] = self._tick
+                out.append(vec)
+        return out
+
+    def put_many(self, keys: list[bytes], vecs: np.ndarray) -> None:
+        """Store vectors and write the new rows to disk."""
+        if not keys:
+            return
+        with self._lock, self._writer():
+            meta = self._read_meta()
+            if meta is None or meta.get("generation") != self._generation:
+                # Written by another process since it was read
+                self._load()
+            dim = int(vecs.shape[1])
+            if dim != self._dim:
+                self._reset(dim)
+            # Only the most recent max_rows entries can be kept
+            keys = keys[-self.max_rows:]
+            vecs = vecs[-self.max_rows:]
+
+            new: dict[bytes, int] = {}
+            for i, key in enumerate(keys):
+                if key not in self._rows:
+                    new[key] = i
+            if not new:
+                return
+            if len(new) > len(self._free):
+                self._grow(len(new) - len(self._free))
+            if len(new) > len(self._free):
+                self._evict(len(new) - len(self._free))
+
+            assert self._vecs is not None
+            rows = [self._free.pop() for _ in new]
+            # Readers must not match the old hash of a row with its new
+            # vector, so the hash is cleared on disk first
+            self._keys[rows] = 0
+            self._keys.flush()
+            self._vecs[rows] = vecs[list(new.values())]
+            self._vecs.flush()
+            self._keys[rows] = np.frombuffer(
+                b"".join(new), dtype=np.uint8).reshape(-1, _KEY_BYTES)
+            self._keys.flush()
+            self._tick += 1
+            self._used[rows] = self._tick
+            self._used.flush()
+            self._rows.update(zip(new, rows))
+            self._generation += 1
+            self._write_meta()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._rows),
+                "max_entries": self.max_rows,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+@lru_cache(maxsize=8)
+def get_embed_cache(embed_model: str) -> EmbedCache | None:
+    """Return the embedding cache for a model, None if caching is disabled."""
+    if EMBED_CACHE_MAX_ROWS <= 0:
+        return None
+    name = re.sub(r"[^A-Za-z0-9_.-]+", "_", embed_model)
+    return EmbedCache(Path(DATA_DIR) / "embed_cache" / name, EMBED_CACHE_MAX_ROWS)
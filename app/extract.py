@@ -0,0 +1,247 @@
+from __future__ import annotations
+
+import hashlib
+import re
+from collections import Counter, defaultdict
+from collections.abc import Iterable, Sequence
+from dataclasses import dataclass
+from urllib.parse import urlsplit
+
+from bs4 import BeautifulSoup, NavigableString, Tag
+
+# Elements that never hold page content
+_DROP_TAGS = (
+    "script", "style", "noscript", "template", "svg", "canvas", "iframe",
+    "nav", "aside", "form", "button", "select", "dialog",
+)
+# Site headers and footers, kept inside an article where they hold its title
+_PAGE_TAGS = ("header", "footer")
+_DROP_ROLES = {
+    "navigation", "banner", "contentinfo", "complementary", "search",
+    "menu", "menubar", "dialog", "alertdialog",
+}
+# Class and id names of cookie banners, menus and other page chrome
+_DROP_NAMES = re.compile(
+    r"(^|[-_ ])(cookie|consent|gdpr|banner|navbar|nav|menu|sidebar|breadcrumbs?"
+    r"|footer|header|toc|skip-link|share|social|newsletter|popup|modal)"
+    r"($|[-_ ])",
+    re.IGNORECASE,
+)
+# Elements whose text is a separate block
+_BLOCK_TAGS = {
+    "address", "article", "blockquote", "body", "dd", "details", "div", "dl",
+    "dt", "figcaption", "figure", "h1", "h2", "h3", "h4", "h5", "h6", "hr",
+    "li", "main", "ol", "p", "pre", "section", "summary", "table", "tbody",
+    "td", "th", "thead", "tr", "ul",
+}
+# Elements kept even if their class names look like page chrome
+_KEEP_TAGS = {"html", "body", "main", "article"}
+_HEADINGS = {"h1": 1, "h2": 2, "h3": 3, "h4": 4, "h5": 5, "h6": 6}
+_SPACE = re.compile(r"\s+")
+_CHARSET = re.compile(r"charset=[\"']?([\w.:-]+)", re.IGNORECASE)
+# Size of the fingerprint of a text block
+_KEY_BYTES = 8
+
+
+@dataclass(frozen=True)
+class ParsedPage:
+    """What the crawler needs of a page, without the parsed tree.
+
+    Small enough to be sent back from a worker process.
+    """
+
+    title: str = ""
+    # href of the canonical link, as written in the page
+    canonical: str = ""
+    # href of the <base> element
+    base: str = ""
+    # href of every link, as written in the page
+    links: tuple[str, ...] = ()
+    # Text blocks of the main content, see extract_blocks()
+    blocks: tuple[str, ...] = ()
+    # Size of the whole page text before content extraction
+    raw_bytes: int = 0
+    # Selectors of the given ones that match the page
+    matched: tuple[str, ...] = ()
+
+
+def parse_html(
+    body: bytes,
+    content_type: str | None,
+    selectors: tuple[str, ...] = (),
+) -> ParsedPage:
+    """Parse a page and extract its links, metadata and content blocks.
+
+    Runs in the worker processes, only the extracted parts are sent back.
+    """
+    m = _CHARSET.search(content_type or "")
+    soup = BeautifulSoup(body, "lxml", from_encoding=m.group(1) if m else None)
+    title = (soup.title.string or "") if soup.title else ""
+    base = soup.find("base", href=True)
+    # Links are collected before extraction removes the navigation
+    links = tuple(a["href"].strip() for a in soup.find_all("a", href=True)
+                  if a["href"].strip())
+    matched = tuple(s for s in selectors if soup.select_one(s) is not None)
+    canonical = soup.find("link", rel="canonical", href=True)
+    raw_bytes = len(soup.text.encode("utf-8"))
+    return ParsedPage(
+        title=title.strip(),
+        canonical=canonical["href"].strip() if canonical else "",
+        base=base["href"].strip() if base else "",
+        links=links,
+        blocks=tuple(extract_blocks(soup)),
+        raw_bytes=raw_bytes,
+        matched=matched,
+    )
+
+
+def extract_blocks(soup: BeautifulSoup) -> list[str]:
+    """Return the text blocks of the main content of a page.
+
+    Scripts, navigation, headers, footers, sidebars, forms and cookie banners
+    are removed. Headings are kept as markdown style "#" lines so the heading
+    structure survives. The soup is modified.
+    """
+    for el in soup.find_all(_DROP_TAGS):
+        el.decompose()
+    for el in soup.find_all(_PAGE_TAGS):
+        if el.find_parent(("main", "article")) is None:
+            el.decompose()
+    for el in soup.find_all(_is_chrome):
+        el.decompose()
+
+    root = soup.find("main") or soup.find(attrs={"role": "main"}) \
+        or soup.find("article") or soup.body or soup
+    if not _text_len(root):
+        root = soup.body or soup
+
+    blocks: list[str] = []
+    parts: list[str] = []
+    current: Tag | None = None
+
+    def flush() -> None:
+        text = "".join(parts)
+        parts.clear()
+        if current is None:
+            return
+        # Keep the layout of code blocks
+        if current.name == "pre":
+            text = text.strip("\n")
+        else:
+            text = _SPACE.sub(" ", text).strip()
+        if not text.strip():
+            return
+        level = _HEADINGS.get(current.name, 0)
+        blocks.append("#" * level + " " + text if level else text)
+
+    for s in root.find_all(string=True):
+        if type(s) is not NavigableString:
+            continue
+        block = _block_of(s, root)
+        if block is not current:
+            flush()
+            current = block
+        parts.append(str(s))
+    flush()
+    return blocks
+
+
+def _is_chrome(el: Tag) -> bool:
+    """Return True for elements that are page chrome by role, class or id."""
+    attrs = el.attrs
+    if not attrs or el.name in _KEEP_TAGS:
+        return False
+    if attrs.get("role") in _DROP_ROLES or attrs.get("aria-hidden") == "true":
+        return True
+    if "hidden" in attrs:
+        return True
+    names = " ".join(attrs.get("class") or ()) + " " + (attrs.get("id") or "")
+    return bool(_DROP_NAMES.search(names))
+
+
+def _block_of(s: NavigableString, root: Tag) -> Tag | None:
+    """Return the nearest block element containing a string."""
+    el = s.parent
+    while el is not None and el is not root:
+        if el.name in _BLOCK_TAGS:
+            return el
+        el = el.parent
+    return root
+
+
+def _text_len(el: Tag) -> int:
+    return len(el.get_text(strip=True))
+
+
+class BoilerplateFilter:
+    """Removes text blocks repeated across pages of the same domain.
+
+    Each block is fingerprinted by its normalized text, see block_keys().
+    Pages are counted with add() and filter() drops the blocks found on at
+    least min_pages pages of the domain so far. This catches menus, footers
+    and notices that the element rules miss. Headings are never dropped
+    since they give structure to the text under them.
+
+    The pages of an earlier crawl can be counted first. Pages filtered
+    before the blocks of their domain were known are returned by stale()
+    and can be filtered again once the whole crawl is counted, so the end
+    result does not depend on the crawl order.
+    """
+
+    def __init__(self, min_pages: int = 3) -> None:
+        self.min_pages = min_pages
+        self._counts: dict[str, Counter[bytes]] = defaultdict(Counter)
+        # Keys counted for each url, and the keys each filtered page kept
+        self._pages: dict[str, bytes] = {}
+        self._kept: dict[str, bytes] = {}
+
+    def add(self, url: str, keys: Iterable[bytes]) -> None:
+        """Count the block keys of a page, in place of its earlier keys."""
+        if self.min_pages <= 0:
+            return
+        counts = self._counts[_domain(url)]
+        for key in _split_keys(self._pages.get(url, b"")):
+            counts[key] -= 1
+            if counts[key] <= 0:
+                del counts[key]
+        keys = list(dict.fromkeys(keys))
+        counts.update(keys)
+        self._pages[url] = b"".join(keys)
+
+    def filter(self, url: str, blocks: Sequence[str]) -> list[str]:
+        if self.min_pages <= 0:
+            return list(blocks)
+        counts = self._counts[_domain(url)]
+        kept = [b for b in blocks if b.startswith("#")
+                or counts[_block_key(b)] < self.min_pages]
+        self._kept[url] = b"".join(block_keys(kept))
+        return kept
+
+    def stale(self) -> list[str]:
+        """Return the filtered pages that kept blocks now seen as boilerplate."""
+        urls = []
+        for url, kept in self._kept.items():
+            counts = self._counts[_domain(url)]
+            if any(counts[k] >= self.min_pages for k in _split_keys(kept)):
+                urls.append(url)
+        return urls
+
+
+def block_keys(blocks: Sequence[str]) -> list[bytes]:
+    """Return the fingerprints of the blocks that may be boilerplate."""
+    return list(dict.fromkeys(
+        _block_key(b) for b in blocks if not b.startswith("#")))
+
+
+def _split_keys(keys: bytes) -> list[bytes]:
+    return [keys[i:i + _KEY_BYTES] for i in range(0, len(keys), _KEY_BYTES)]
+
+
+def _domain(url: str) -> str:
+    return urlsplit(url).netloc.lower()
+
+
+def _block_key(block: str) -> bytes:
+    text = _SPACE.sub(" ", block.lower()).strip()
+    return hashlib.blake2b(text.encode("utf-8"),
+                           digest_size=_KEY_BYTES).digest()
@@ -1,51 +1,173 @@
 from __future__ import annotations
 
-import json
+import fcntl
+import logging
 import os
-from dataclasses import asdict, dataclass
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
 from pathlib import Path
 
 import faiss
 import numpy as np
 
-from config import DATA_DIR
+from ann import (
+    build_index,
+    choose_index_type,
+    flat_vectors,
+    index_labels,
+    index_type,
+    is_positional,
+    reconstruct_all,
+    remove_labels,
+    search_params,
+)
+from chunk_store import (
+    DEL_FILE,
+    DOCS_FILE,
+    JOURNAL_FILE,
+    ROWS_FILE,
+    ChunkDoc,
+    ChunkFilter,
+    ChunkStore,
+    chunk_labels,
+    chunk_store_files,
+    finish_replace,
+    migrate_jsonl,
+    replace_files,
+)
+from config import (
+    COMPACT_DEAD_RATIO,
+    COMPACT_MIN_DEAD,
+    DATA_DIR,
+    DENSE_WEIGHT,
+    FILTER_EXACT_MAX,
+    HYBRID_CANDIDATES,
+    LEXICAL_WEIGHT,
+    RRF_K,
+    SEARCH_MODE,
+    STORE_CHECK_INTERVAL,
+)
+from crawl_state import get_crawl_state
+from dedup import SIG_FILE, Signatures, signatures
+from embed_cache import get_embed_cache, text_key
+from lexical import LexicalIndex
 from model import default_model
+from query_embed import QueryEmbedder
 
+log = logging.getLogger(__name__)
 
-@dataclass
-class ChunkDoc:
-    id: str
-    url: str
-    title: str
-    chunk: str
+# Filters whose matching rows are kept by each store
+_FILTER_CACHE_SIZE = 32
 
 
 def _paths(data_dir: str | None = None) -> tuple[Path, Path]:
-    """Return the paths to the stored embeddings data."""
+    """Return the paths to the stored index and chunk rows."""
     d = Path(data_dir or DATA_DIR)
     d.mkdir(parents=True, exist_ok=True)
-    return d / "index.faiss", d / "docs.jsonl"
+    return d / "index.faiss", d / ROWS_FILE
+
+
+SEARCH_MODES = ("hybrid", "dense", "lexical")
+
 
+def _lexical_dir(data_dir: str | None = None) -> Path:
+    return _paths(data_dir)[0].parent / "lexical"
 
-def _embed_texts(texts: list[str]) -> np.ndarray:
-    """Create embeddings for the input"""
+
+def _embed_texts(texts: list[str], use_cache: bool = True) -> np.ndarray:
+    """Create embeddings for the input
+
+    With use_cache the embeddings are looked up from the embedding cache and
+    only the misses are sent to the API.
+    """
     model = default_model()
-    vecs = model.get_embeddings(texts)
-    arr = np.array(vecs, dtype="float32")
+    cache = get_embed_cache(model.cfg.embed_model) if use_cache else None
+    if cache is None:
+        arr = np.array(model.get_embeddings(texts), dtype="float32")
+    else:
+        keys = [text_key(t) for t in texts]
+        found = cache.get_many(keys)
+        # Embed every missing text once
+        missing: dict[bytes, str] = {}
+        for key, text, vec in zip(keys, texts, found):
+            if vec is None:
+                missing.setdefault(key, text)
+        if missing:
+            new = np.array(
+                model.get_embeddings(list(missing.values())), dtype="float32")
+            cache.put_many(list(missing), new)
+            new_vecs = dict(zip(missing, new))
+            found = [new_vecs[k] if v is None else v
+                     for k, v in zip(keys, found)]
+        arr = np.array(found, dtype="float32")
     faiss.normalize_L2(arr)
     return arr
 
 
+def embed_chunks(chunks: list[ChunkDoc]) -> np.ndarray:
+    """Create the normalized embeddings of chunks."""
+    return _embed_texts([c.chunk for c in chunks])
+
+
+def _fsync_path(path: Path) -> None:
+    """Flush a file or directory to disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+query_embedder = QueryEmbedder(
+    embed_fn=lambda texts: _embed_texts(texts, use_cache=False),
+    model_fn=lambda: default_model().cfg.embed_model,
+)
+
+
+@dataclass
+class _FilterRows:
+    """The rows of a store that match a filter."""
+
+    # Live rows that match
+    mask: np.ndarray
+    labels: np.ndarray
+    # Selector of labels for searching the index, None with positions
+    selector: faiss.IDSelector | None = None
+    # Positions of the vectors of labels in the index, when they are few
+    # enough to be scored one by one
+    positions: np.ndarray | None = None
+
+
 class IndexStore:
     def __init__(
         self,
         index: faiss.Index,
-        docs: list[ChunkDoc],
+        docs: ChunkStore,
         data_dir: str | None = None,
+        lexical: LexicalIndex | None = None,
+        sigs: Signatures | None = None,
     ):
         self.index = index
         self.docs = docs
         self.data_dir = data_dir
+        self.lexical = lexical or LexicalIndex()
+        # Content signatures used to drop duplicates before embedding
+        self.sigs = sigs or Signatures.open(docs.data_dir, 0)
+        self._selector: tuple[faiss.IDSelector, faiss.IDSelector] | None = None
+        self._nbytes: int | None = None
+        self._filters: OrderedDict[ChunkFilter, _FilterRows] = OrderedDict()
+        self._filters_lock = threading.Lock()
+        # Sorted labels of the index vectors and their positions
+        self._positions: tuple[np.ndarray, np.ndarray] | None = None
+        # Set by StoreManager when the store is published. The stamp of the
+        # files identifies the contents of the store across restarts.
+        self.generation = 0
+        self.stamp: tuple[int, ...] | None = None
 
     @property
     def idx_path(self) -> Path:
@@ -60,79 +182,663 @@ class IndexStore:
         cls,
         chunks: list[ChunkDoc],
         data_dir: str | None = None,
+        emb: np.ndarray | None = None,
+    ) -> IndexStore:
+        """Build the embeddings from provided chunks.
+
+        The index type is picked by INDEX_TYPE and the amount of chunks.
+        The chunks are written to a new chunk store right away. emb are the
+        embeddings of the chunks if they were already created.
+        """
+        texts = [c.chunk for c in chunks]
+        if emb is None:
+            emb = _embed_texts(texts)
+        index = build_index(emb, chunk_labels(chunks))
+        docs = ChunkStore.create(_paths(data_dir)[1].parent, chunks)
+        lexical = LexicalIndex().add(texts)
+        sigs = Signatures.open(docs.data_dir, 0).append(signatures(texts))
+        return cls(index=index, docs=docs, data_dir=data_dir, lexical=lexical,
+                   sigs=sigs)
+
+    def add_chunks(
+        self,
+        chunks: list[ChunkDoc],
+        emb: np.ndarray | None = None,
+        replace_urls: set[str] | None = None,
+        replace_before: float | None = None,
     ) -> IndexStore:
-        """Build the embeddings from provided chunks."""
+        """Return a new store with the chunks added.
+
+        Only the new chunks are embedded. The index is cloned before adding
+        so readers still using this store are not affected. When the corpus
+        grows past the size of the current index type, the index is rebuilt
+        as the new type from its stored vectors.
+
+        The chunks are appended to the chunk store right away, they become
+        visible to load() once the new index is saved. emb are the embeddings
+        of the chunks if they were already created.
+
+        Chunks are upserted by their label: chunks already stored and live
+        are kept as they are. The other chunks stored for replace_urls are
+        deleted, only the ones added before the time replace_before if it
+        is set. Deleted rows are left out of searches until compact().
+        """
+        labels = chunk_labels(chunks)
+        rows = self.docs.rows_of_labels(labels)
+        stored = rows >= 0
+        stored[stored] = self.docs.alive[rows[stored]]
+        delete = None
+        if replace_urls:
+            delete = self.docs.rows_of_urls(replace_urls, replace_before)
+            delete = delete[~np.isin(delete, rows[stored])]
+        if stored.any():
+            keep = np.flatnonzero(~stored)
+            chunks = [chunks[i] for i in keep]
+            labels = labels[keep]
+            if emb is not None:
+                emb = emb[keep]
+        if not chunks:
+            return IndexStore(self.index, self.docs.append([], delete),
+                              self.data_dir, self.lexical, self.sigs)
         texts = [c.chunk for c in chunks]
-        emb = _embed_texts(texts)
-        dim = int(emb.shape[1])
-        index = faiss.IndexFlatIP(dim)
-        index.add(emb)
-        return cls(index=index, docs=chunks, data_dir=data_dir)
+        if emb is None:
+            emb = _embed_texts(texts)
+        if int(emb.shape[1]) != self.index.d:
+            raise ValueError(
+                f"Embedding dimension {emb.shape[1]} does not match the "
+                f"index dimension {self.index.d}. Clear the index after "
+                "changing the embedding model."
+            )
+        kind = choose_index_type(self.index.ntotal + len(emb))
+        if kind != index_type(self.index):
+            vecs, old_labels = reconstruct_all(self.index)
+            index = build_index(np.vstack([vecs, emb]),
+                                np.concatenate([old_labels, labels]), kind)
+        else:
+            index = faiss.clone_index(self.index)
+            index.add_with_ids(emb, labels)
+        return IndexStore(
+            index,
+            self.docs.append(chunks, delete),
+            self.data_dir,
+            self.lexical.add(texts),
+            self.sigs.append(signatures(texts)),
+        )
+
+    def delete(
+        self,
+        urls: set[str] | None = None,
+        domains: set[str] | None = None,
+    ) -> IndexStore:
+        """Return a new store without the chunks of the urls and domains.
+
+        The rows are marked deleted, nothing is rebuilt.
+        """
+        rows = [self.docs.rows_of_urls(urls)] if urls else []
+        if domains:
+            rows.append(self.docs.rows_of_domains(domains))
+        delete = np.unique(np.concatenate(rows)) if rows else None
+        return IndexStore(self.index, self.docs.append([], delete),
+                          self.data_dir, self.lexical, self.sigs)
+
+    @property
+    def dead_rows(self) -> int:
+        return len(self.docs) - self.docs.n_live
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory use of the index and lexical index.
+
+        The chunk store and signatures are memory mapped and not counted.
+        """
+        if self._nbytes is None:
+            try:
+                index_bytes = self.idx_path.stat().st_size
+            except FileNotFoundError:
+                index_bytes = self.index.ntotal * self.index.d * 4
+            self._nbytes = index_bytes + self.lexical.nbytes
+        return self._nbytes
+
+    def compact(self) -> IndexStore:
+        """Rewrite the store without its deleted rows.
+
+        The vectors of deleted chunks are removed from the index, the chunk
+        store, signatures and lexical index are rewritten from the live
+        rows. The new files are written to a staging dir and renamed into
+        place together, readers of this store keep using the old files.
+        """
+        data_dir = self.docs.data_dir
+        stage = data_dir / "compact"
+        shutil.rmtree(stage, ignore_errors=True)
+        stage.mkdir()
+
+        docs = self.docs.write_live(stage)
+        live = np.flatnonzero(self.docs.alive)
+        Signatures.open(stage, 0).append(self.sigs.sigs[live])
+        live_labels = np.asarray(docs.meta["label"])
+        kind = choose_index_type(len(live_labels))
+        index = None
+        if kind == index_type(self.index):
+            index = remove_labels(self.index, self.docs.dead_labels())
+        if index is None or index.ntotal != len(live_labels):
+            # A label of both a live and a deleted row has two vectors, or
+            # the type changed. Rebuild with one vector per live row.
+            vecs, labels = reconstruct_all(self.index)
+            uniq, first = np.unique(labels, return_index=True)
+            pos = first[np.searchsorted(uniq, live_labels)]
+            index = build_index(vecs[pos], live_labels, kind)
+        faiss.write_index(index, str(stage / "index.faiss"))
+
+        names = [p.name for p in chunk_store_files(data_dir)]
+        names += [SIG_FILE, "index.faiss"]
+        replace_files(data_dir, {data_dir / n: stage / n for n in names})
+        shutil.rmtree(stage, ignore_errors=True)
+
+        lexical = LexicalIndex()
+        batch = 10_000
+        for start in range(0, len(docs), batch):
+            end = min(len(docs), start + batch)
+            lexical = lexical.add([docs[i].chunk for i in range(start, end)])
+        lexical_dir = _lexical_dir(self.data_dir)
+        shutil.rmtree(lexical_dir, ignore_errors=True)
+        lexical.save(lexical_dir)
+        docs = ChunkStore.open(data_dir, max_rows=index.ntotal)
+        return IndexStore(index, docs, self.data_dir, lexical,
+                          Signatures.open(data_dir, len(docs)))
 
     def save(self) -> dict:
-        """Write the embeddings to disk."""
+        """Write the embeddings to disk.
+
+        The chunks are already in the chunk store, the index is written
+        after them and atomically replaced. After a crash the chunk store may
+        hold rows that have no vector, load() ignores them and the next append
+        overwrites them. The lexical index is written last, load() catches it
+        up from the chunk store if it is behind.
+        """
         idx_path, docs_path = _paths(self.data_dir)
-        idx_path.touch()
-        faiss.write_index(self.index, str(idx_path))
-        with docs_path.open("w+", encoding="utf-8") as f:
-            for c in self.docs:
-                f.write(json.dumps(asdict(c), ensure_ascii=True) + "\n")
+        tmp_idx = idx_path.with_name(idx_path.name + ".tmp")
+        faiss.write_index(self.index, str(tmp_idx))
+        _fsync_path(tmp_idx)
+        os.replace(tmp_idx, idx_path)
+        _fsync_path(idx_path.parent)
+        self.lexical.save(_lexical_dir(self.data_dir))
 
         return {
-            "chunks": len(self.docs),
+            "chunks": self.docs.n_live,
+            "index_type": index_type(self.index),
             "index_path": str(idx_path),
             "docs_path": str(docs_path),
         }
 
     @classmethod
     def load(cls, data_dir: str | None = None) -> IndexStore:
-        """Load the embeddings from disk."""
+        """Load the embeddings from disk.
+
+        Chunks stored in the old docs.jsonl format are migrated to the chunk
+        store first.
+        """
         idx_path, docs_path = _paths(data_dir)
+        # Complete an interrupted compaction
+        finish_replace(docs_path.parent)
+        if idx_path.exists():
+            migrate_jsonl(docs_path.parent)
         if not idx_path.exists() or not docs_path.exists():
             raise FileNotFoundError(
                 f"Index not found. Missing {idx_path} or {docs_path}."
             )
 
         index = faiss.read_index(str(idx_path))
-        docs: list[ChunkDoc] = []
-        with docs_path.open("r", encoding="utf-8") as f:
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-                obj = json.loads(line)
-                docs.append(ChunkDoc(**obj))
-
-        return cls(index=index, docs=docs, data_dir=data_dir)
+        docs = ChunkStore.open(docs_path.parent, max_rows=index.ntotal)
+        lexical = _load_lexical(_lexical_dir(data_dir), docs)
+        sigs = _load_signatures(docs)
+        store = cls(index=index, docs=docs, data_dir=data_dir, lexical=lexical,
+                    sigs=sigs)
+        if is_positional(index):
+            # Written before vectors were labelled by chunk
+            vecs, _rows = reconstruct_all(index)
+            store.index = build_index(
+                vecs, np.asarray(docs.meta["label"]), index_type(index))
+            store.save()
+        return store
 
     def clear(self) -> None:
         """Delete the data index."""
         idx_path, docs_path = _paths(self.data_dir)
         os.remove(idx_path)
-        os.remove(docs_path)
-
-    def search(self, top_k: int, query: str) -> list[tuple[float, ChunkDoc]]:
-        """Search for relevant content from the embeddings."""
-        query_vec = _embed_texts([query])
-        # Search for similar content
-        scores, ids = self.index.search(query_vec, top_k)
-        hits: list[tuple[float, ChunkDoc]] = []
-        for score, idx in zip(scores[0].tolist(), ids[0].tolist()):
-            if idx < 0 or idx >= len(self.docs):
-                continue
-            hits.append((float(score), self.docs[idx]))
+        for path in chunk_store_files(docs_path.parent):
+            path.unlink(missing_ok=True)
+        (docs_path.parent / SIG_FILE).unlink(missing_ok=True)
+        (docs_path.parent / JOURNAL_FILE).unlink(missing_ok=True)
+        shutil.rmtree(_lexical_dir(self.data_dir), ignore_errors=True)
+
+    def search(
+        self,
+        top_k: int,
+        query: str,
+        nprobe: int | None = None,
+        ef_search: int | None = None,
+        mode: str | None = None,
+        filters: ChunkFilter | None = None,
+    ) -> list[tuple[float, ChunkDoc]]:
+        """Search for relevant content.
+
+        mode is dense for the embeddings only, lexical for BM25 only, which
+        needs no embedding call, or hybrid to fuse both with reciprocal rank
+        fusion. nprobe and ef_search tune IVF and HNSW indexes, they are
+        ignored by the other index types. filters restricts the search to
+        the matching chunks, see _filter_rows().
+        """
+        mode = mode or SEARCH_MODE
+        if mode not in SEARCH_MODES:
+            raise ValueError(
+                f"Unknown search mode '{mode}', expected one of "
+                f"{', '.join(SEARCH_MODES)}"
+            )
+
+        matched = self._filter_rows(filters) if filters else None
+        if matched is not None:
+            if not len(matched.labels):
+                return []
+            exclude = ~matched.mask
+        else:
+            exclude = ~self.docs.alive if len(self.docs.deleted) else None
+        if mode == "dense":
+            rows = self._dense_search(query, top_k, nprobe, ef_search, matched)
+        elif mode == "lexical":
+            rows = self.lexical.search(query, top_k, exclude)
+        else:
+            k = top_k * max(1, HYBRID_CANDIDATES)
+            rows = _rrf([
+                (DENSE_WEIGHT,
+                 self._dense_search(query, k, nprobe, ef_search, matched)),
+                (LEXICAL_WEIGHT, self.lexical.search(query, k, exclude)),
+            ], top_k)
+
+        return [(score, self.docs[row]) for score, row in rows
+                if 0 <= row < len(self.docs)]
+
+    def _dense_search(
+        self,
+        query: str,
+        top_k: int,
+        nprobe: int | None = None,
+        ef_search: int | None = None,
+        matched: _FilterRows | None = None,
+    ) -> list[tuple[float, int]]:
+        """Return (score, row) pairs of the nearest chunks.
+
+        With matched only the chunks matching a filter are searched.
+        """
+        query_vec = query_embedder.embed(query).reshape(1, -1)
+        if matched is not None and matched.positions is not None:
+            # Few chunks match, scoring them all is exact and cheaper than
+            # searching the index
+            scores = flat_vectors(self.index)[matched.positions] @ query_vec[0]
+            k = min(top_k, len(scores))
+            best = np.argpartition(-scores, k - 1)[:k] if k else \
+                np.zeros(0, dtype=np.int64)
+            best = best[np.argsort(-scores[best])]
+            scores, labels = scores[best], matched.labels[best]
+        else:
+            # Search for similar content
+            sel = matched.selector if matched is not None \
+                else self._live_selector()
+            params = search_params(self.index, nprobe, ef_search, sel)
+            scores, ids = self.index.search(query_vec, top_k, params=params)
+            found = ids[0] >= 0
+            scores, labels = scores[0][found], ids[0][found]
+        rows = self.docs.rows_of_labels(labels)
+        hits: list[tuple[float, int]] = []
+        seen: set[int] = set()
+        for score, row in zip(scores.tolist(), rows.tolist()):
+            # A label stored twice has a vector per row
+            if row >= 0 and row not in seen:
+                seen.add(row)
+                hits.append((float(score), row))
         return hits
 
+    def _filter_rows(self, filters: ChunkFilter) -> _FilterRows:
+        """Return the rows matching a filter, cached per filter.
+
+        The index is searched with a selector of the matching labels. When
+        at most FILTER_EXACT_MAX chunks match and the index keeps the full
+        vectors, the matching vectors are scored directly instead.
+        """
+        with self._filters_lock:
+            matched = self._filters.get(filters)
+            if matched is not None:
+                self._filters.move_to_end(filters)
+                return matched
+
+        mask = self.docs.filter_mask(filters)
+        labels = np.unique(np.asarray(self.docs.meta["label"])[mask])
+        matched = _FilterRows(mask, labels)
+        if len(labels) <= FILTER_EXACT_MAX \
+                and flat_vectors(self.index) is not None:
+            if self._positions is None:
+                all_labels = index_labels(self.index)
+                order = np.argsort(all_labels, kind="stable")
+                self._positions = (all_labels[order], order)
+            sorted_labels, order = self._positions
+            pos = np.minimum(np.searchsorted(sorted_labels, labels),
+                             max(0, len(sorted_labels) - 1))
+            # Rows written without a vector before a crash have no position
+            found = sorted_labels[pos] == labels
+            matched.labels = labels[found]
+            matched.positions = order[pos[found]]
+        elif len(labels):
+            matched.selector = faiss.IDSelectorBatch(labels)
+
+        with self._filters_lock:
+            self._filters[filters] = matched
+            while len(self._filters) > _FILTER_CACHE_SIZE:
+                self._filters.popitem(last=False)
+        return matched
+
+    def _live_selector(self) -> faiss.IDSelector | None:
+        """Selector of the live labels, None without deletes."""
+        if not len(self.docs.deleted):
+            return None
+        if self._selector is None:
+            batch = faiss.IDSelectorBatch(self.docs.dead_labels())
+            # The not selector does not own the batch selector, keep both
+            self._selector = (batch, faiss.IDSelectorNot(batch))
+        return self._selector[1]
+
+
+def _rrf(
+    results: list[tuple[float, list[tuple[float, int]]]],
+    top_k: int,
+) -> list[tuple[float, int]]:
+    """Fuse weighted ranked lists with reciprocal rank fusion."""
+    fused: dict[int, float] = {}
+    for weight, hits in results:
+        if weight <= 0:
+            continue
+        for rank, (_score, row) in enumerate(hits):
+            fused[row] = fused.get(row, 0.0) + weight / (RRF_K + rank + 1)
+    best = sorted(fused.items(), key=lambda x: x[1], reverse=True)[:top_k]
+    return [(score, row) for row, score in best]
+
+
+def _load_lexical(path: Path, docs: ChunkStore) -> LexicalIndex:
+    """Load the lexical index and bring it in line with the chunk store."""
+    lexical = LexicalIndex.load(path)
+    if lexical.n_docs > len(docs):
+        # Ahead of the vectors after an interrupted write, rebuild it
+        lexical = LexicalIndex()
+    if lexical.n_docs < len(docs):
+        batch = 10_000
+        for start in range(lexical.n_docs, len(docs), batch):
+            end = min(len(docs), start + batch)
+            lexical = lexical.add([docs[i].chunk for i in range(start, end)])
+        shutil.rmtree(path, ignore_errors=True)
+        lexical.save(path)
+    return lexical
+
+
+def _load_signatures(docs: ChunkStore) -> Signatures:
+    """Load the chunk signatures, computing the missing ones."""
+    sigs = Signatures.open(docs.data_dir, max_rows=len(docs))
+    batch = 10_000
+    for start in range(len(sigs), len(docs), batch):
+        end = min(len(docs), start + batch)
+        sigs = sigs.append(signatures([docs[i].chunk for i in range(start, end)]))
+    return sigs
+
 
 def append_and_save(
     chunks: list[ChunkDoc],
     data_dir: str | None = None,
 ) -> dict:
+    """Add chunks to the stored index through the shared store manager."""
+    return get_store_manager(data_dir).append(chunks)
+
+
+def _file_stamp(data_dir: str | None = None) -> tuple[int, ...] | None:
+    """Return the mtimes and sizes of the index files, None if missing."""
+    idx_path, docs_path = _paths(data_dir)
+    if not docs_path.exists() and (docs_path.parent / DOCS_FILE).exists():
+        # Not migrated yet, the first load will migrate it
+        docs_path = docs_path.parent / DOCS_FILE
     try:
-        old_store = IndexStore.load(data_dir)
-        new_chunks = old_store.docs
-        new_chunks.extend(chunks)
-        index_store = IndexStore.build(new_chunks, data_dir)
+        idx_st = idx_path.stat()
+        docs_st = docs_path.stat()
     except FileNotFoundError:
-        index_store = IndexStore.build(chunks, data_dir)
-    return index_store.save()
+        return None
+    # Deletes change only the tombstone file
+    try:
+        del_size = (docs_path.parent / DEL_FILE).stat().st_size
+    except FileNotFoundError:
+        del_size = 0
+    return (idx_st.st_mtime_ns, idx_st.st_size, docs_st.st_mtime_ns,
+            docs_st.st_size, del_size)
+
+
+class StoreManager:
+    """Keeps one loaded IndexStore resident for the whole process.
+
+    Readers get the currently published store and keep using it for the whole
+    request. Writers never modify a published store: they build a new one,
+    save it and swap it in as a new generation. Changes made to the files by
+    another process are picked up by comparing file mtimes.
+    """
+
+    def __init__(self, data_dir: str | None = None) -> None:
+        self.data_dir = data_dir
+        # Guards the published store and its file stamp
+        self._lock = threading.Lock()
+        # Serializes loads and writes
+        self._write_lock = threading.Lock()
+        self._store: IndexStore | None = None
+        self._stamp: tuple[int, ...] | None = None
+        self._generation = 0
+        self._checked_at = 0.0
+        # Background compaction thread, if one is running
+        self._compactor: threading.Thread | None = None
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def _publish(
+        self,
+        store: IndexStore | None,
+        stamp: tuple[int, ...] | None,
+    ) -> None:
+        with self._lock:
+            self._generation += 1
+            if store is not None:
+                store.generation = self._generation
+                store.stamp = stamp
+            self._store = store
+            self._stamp = stamp
+            self._checked_at = time.monotonic()
+
+    def _current(self) -> IndexStore | None:
+        """Return the up to date store or None if there is no index."""
+        with self._lock:
+            store, stamp = self._store, self._stamp
+            checked_at = self._checked_at
+
+        if store is not None and \
+                time.monotonic() - checked_at < STORE_CHECK_INTERVAL:
+            return store
+
+        disk = _file_stamp(self.data_dir)
+        if store is not None and disk == stamp:
+            with self._lock:
+                self._checked_at = time.monotonic()
+            return store
+
+        with self._write_lock:
+            return self._refresh_locked()
+
+    def get(self) -> IndexStore:
+        """Return the current store, loading it from disk when needed."""
+        store = self._current()
+        if store is None:
+            idx_path, docs_path = _paths(self.data_dir)
+            raise FileNotFoundError(
+                f"Index not found. Missing {idx_path} or {docs_path}."
+            )
+        return store
+
+    @contextmanager
+    def writer(self) -> Iterator[None]:
+        """Hold the single writer lock of the data dir.
+
+        Serializes writers of this process and, through a lock file, writers
+        in other processes using the same data dir.
+        """
+        lock_path = _paths(self.data_dir)[0].parent / ".write.lock"
+        with self._write_lock, lock_path.open("a") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def append(
+        self,
+        chunks: list[ChunkDoc],
+        emb: np.ndarray | None = None,
+        replace_urls: set[str] | None = None,
+        replace_before: float | None = None,
+    ) -> dict:
+        """Add chunks to the index and publish the result.
+
+        emb are the embeddings of the chunks if they were already created.
+        The stored chunks of replace_urls are deleted, see
+        IndexStore.add_chunks().
+        """
+        with self.writer():
+            old_store = self._refresh_locked()
+            if old_store is None:
+                if not chunks:
+                    raise FileNotFoundError("Index not found.")
+                store = IndexStore.build(chunks, self.data_dir, emb)
+                meta = store.save()
+            else:
+                store = old_store.add_chunks(
+                    chunks, emb, replace_urls, replace_before)
+                meta = store.save()
+            self._publish(store, _file_stamp(self.data_dir))
+        self._maybe_compact(store)
+        return meta
+
+    def delete(
+        self,
+        urls: set[str] | None = None,
+        domains: set[str] | None = None,
+    ) -> dict:
+        """Delete the chunks of urls and domains and publish the result.
+
+        The crawl state of the deleted pages is dropped as well, so they are
+        fetched in full when they are ingested again.
+        """
+        with self.writer():
+            old_store = self._refresh_locked()
+            if old_store is None:
+                raise FileNotFoundError("Index not found.")
+            store = old_store.delete(urls, domains)
+            meta = store.save()
+            self._publish(store, _file_stamp(self.data_dir))
+            get_crawl_state(self.data_dir).forget(urls or (), domains or ())
+        meta["deleted_chunks"] = old_store.docs.n_live - store.docs.n_live
+        self._maybe_compact(store)
+        return meta
+
+    def compact(self) -> dict:
+        """Rewrite the store without its deleted rows and publish it."""
+        with self.writer():
+            store = self._refresh_locked()
+            if store is None:
+                raise FileNotFoundError("Index not found.")
+            if store.dead_rows:
+                store = store.compact()
+                self._publish(store, _file_stamp(self.data_dir))
+            return {
+                "chunks": store.docs.n_live,
+                "index_type": index_type(store.index),
+            }
+
+    def _maybe_compact(self, store: IndexStore) -> None:
+        """Compact in a background thread once enough rows are deleted.
+
+        Readers keep using the published store meanwhile, writers wait
+        for the compaction to finish.
+        """
+        dead = store.dead_rows
+        if dead < max(1, COMPACT_MIN_DEAD) or \
+                dead < COMPACT_DEAD_RATIO * len(store.docs):
+            return
+        with self._lock:
+            if self._compactor is not None and self._compactor.is_alive():
+                return
+            self._compactor = threading.Thread(
+                target=self._compact_in_background, name="compact",
+                daemon=True)
+            self._compactor.start()
+
+    def _compact_in_background(self) -> None:
+        try:
+            self.compact()
+        except Exception:
+            log.exception("Compaction of %s failed", self.data_dir or DATA_DIR)
+
+    def clear(self) -> None:
+        """Delete the index from disk and memory."""
+        with self.writer():
+            store = self._refresh_locked()
+            if store is None:
+                idx_path, docs_path = _paths(self.data_dir)
+                raise FileNotFoundError(
+                    f"Index not found. Missing {idx_path} or {docs_path}."
+                )
+            store.clear()
+            get_crawl_state(self.data_dir).clear()
+            self._publish(None, None)
+
+    @property
+    def loaded(self) -> IndexStore | None:
+        """The store in memory, None if it is not loaded."""
+        with self._lock:
+            return self._store
+
+    def unload(self) -> None:
+        """Drop the store from memory, the next get() loads it again.
+
+        Readers still using the store keep it until they are done.
+        """
+        self._publish(None, None)
+
+    def _refresh_locked(self) -> IndexStore | None:
+        """Reload the store if the files changed. Needs the write lock."""
+        with self._lock:
+            store, stamp = self._store, self._stamp
+        disk = _file_stamp(self.data_dir)
+        if disk is None:
+            if store is not None:
+                self._publish(None, None)
+            return None
+        if store is not None and disk == stamp:
+            return store
+        store = IndexStore.load(self.data_dir)
+        self._publish(store, disk)
+        return store
+
+
+_MANAGERS_LOCK = threading.Lock()
+_MANAGERS: dict[str, StoreManager] = {}
+
+
+def get_store_manager(data_dir: str | None = None) -> StoreManager:
+    """Return the process wide manager for a data dir."""
+    key = str(Path(data_dir or DATA_DIR).resolve())
+    with _MANAGERS_LOCK:
+        manager = _MANAGERS.get(key)
+        if manager is None:
+            manager = StoreManager(data_dir)
+            _MANAGERS[key] = manager
+        return manager
@@ -0,0 +1,595 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict, deque
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field, replace
+from urllib.parse import urlsplit
+
+import numpy as np
+
+from ann import index_type
+from chunker import page_chunks
+from collection import (
+    DEFAULT_COLLECTION,
+    collection_dir,
+    collection_manager,
+    list_collections,
+)
+from config import (
+    CHUNKER,
+    EXTRACT_BOILERPLATE_PAGES,
+    INGEST_COMMIT_CHUNKS,
+    INGEST_EMBED_BATCH,
+    INGEST_EMBED_TASKS,
+    INGEST_JOB_HISTORY,
+    INGEST_PAGE_QUEUE,
+    INGEST_PROCESSES,
+    INGEST_WORKERS,
+)
+from crawl_state import (
+    CrawlState,
+    PageState,
+    Source,
+    conditional_headers,
+    get_crawl_state,
+)
+from crawler import CrawlStats, PageDoc, crawl_stream
+from dedup import Deduper, canonical_url, content_hash
+from extract import BoilerplateFilter, block_keys
+from index_store import ChunkDoc, IndexStore, embed_chunks
+from workers import chunk_offsets, run_cpu
+
+log = logging.getLogger(__name__)
+
+
+class IngestError(Exception):
+    """Ingest failed for a reason that should be shown to the user."""
+
+
+@dataclass
+class IngestJob:
+    id: str
+    urls: list[str]
+    max_pages: int
+    max_depth: int
+    collection: str = DEFAULT_COLLECTION
+    # Started by a refresh of an earlier ingest
+    refresh: bool = False
+    status: str = "queued"
+    # Earliest stage still running, the later stages run alongside it
+    stage: str | None = None
+    created_at: float = field(default_factory=time.time)
+    started_at: float | None = None
+    finished_at: float | None = None
+    # Seconds each stage has spent working
+    stage_times: dict[str, float] = field(default_factory=dict)
+    progress: dict[str, int] = field(default_factory=lambda: {
+        "pages": 0,
+        "chunks": 0,
+        "embedded": 0,
+        "indexed": 0,
+        "raw_bytes": 0,
+        "text_bytes": 0,
+        "duplicate_pages": 0,
+        "duplicate_chunks": 0,
+        # Pages not modified since the last crawl and pages that replaced
+        # their stored chunks
+        "unchanged_pages": 0,
+        "replaced_pages": 0,
+        # Pages that had at least one new chunk
+        "added_pages": 0,
+    })
+    # Throughput of the crawl stage
+    crawl: CrawlStats | None = None
+    result: dict | None = None
+    error: str | None = None
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "urls": self.urls,
+            "collection": self.collection,
+            "refresh": self.refresh,
+            "status": self.status,
+            "stage": self.stage,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "stage_times": self.stage_times,
+            "progress": self.progress,
+            "crawl": self.crawl.to_dict() if self.crawl else None,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class JobManager:
+    """Runs ingest jobs in the background on a pool of worker tasks.
+
+    Jobs go through the crawl, chunk, embed and index stages. Jobs and the
+    stages within a job run concurrently, writes to the index go through the
+    single writer of the store manager.
+    """
+
+    def __init__(
+        self,
+        workers: int = INGEST_WORKERS,
+        history: int = INGEST_JOB_HISTORY,
+    ) -> None:
+        self.workers = max(1, workers)
+        self.history = history
+        self._jobs: OrderedDict[str, IngestJob] = OrderedDict()
+        self._queue: asyncio.Queue[IngestJob] | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._done: dict[str, asyncio.Event] = {}
+
+    def _start(self) -> asyncio.Queue[IngestJob]:
+        """Start the workers on the running event loop."""
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._tasks = [
+                asyncio.create_task(self._worker(), name=f"ingest-{i}")
+                for i in range(self.workers)
+            ]
+        return self._queue
+
+    def submit(
+        self,
+        urls: list[str],
+        max_pages: int,
+        max_depth: int,
+        collection: str = DEFAULT_COLLECTION,
+        refresh: bool = False,
+    ) -> IngestJob:
+        """Queue an ingest job into a collection and return it right away."""
+        job = IngestJob(
+            id=uuid.uuid4().hex,
+            urls=sorted(urls),
+            max_pages=max_pages,
+            max_depth=max_depth,
+            collection=collection,
+            refresh=refresh,
+        )
+        self._jobs[job.id] = job
+        self._done[job.id] = asyncio.Event()
+        self._forget_old()
+        self._start().put_nowait(job)
+        return job
+
+    def refresh(
+        self,
+        urls: list[str] | None = None,
+        collection: str | None = None,
+    ) -> list[IngestJob]:
+        """Queue jobs that re-crawl the earlier ingests.
+
+        urls limits the refresh to the ingests of their hosts and collection
+        to the ingests of one collection. Ingests that have a job queued or
+        running are skipped. Only changed pages are fetched in full and
+        re-embedded.
+        """
+        names = [collection] if collection else list_collections()
+        hosts = {_host(u) for u in urls} if urls else None
+        active = {(j.collection, u) for j in self._jobs.values()
+                  if j.status in ("queued", "running") for u in j.urls}
+        jobs: list[IngestJob] = []
+        for name in names:
+            state = get_crawl_state(collection_dir(name))
+            for src in state.sources():
+                host = _host(src.url)
+                if (hosts is not None and host not in hosts) \
+                        or (name, src.url) in active:
+                    continue
+                # The known pages are crawled again, new pages fit after them
+                known = len(state.pages_of_host(host))
+                jobs.append(self.submit(
+                    [src.url], src.max_pages + known, src.max_depth, name,
+                    refresh=True))
+        return jobs
+
+    async def refresh_every(self, interval: float) -> None:
+        """Refresh all earlier ingests every interval seconds."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                jobs = self.refresh()
+                log.info("Scheduled refresh queued %d jobs", len(jobs))
+            except Exception:
+                log.exception("Scheduled refresh failed")
+
+    def get(self, job_id: str) -> IngestJob | None:
+        return self._jobs.get(job_id)
+
+    def list(self) -> list[IngestJob]:
+        return list(reversed(self._jobs.values()))
+
+    async def wait(self, job: IngestJob) -> IngestJob:
+        """Wait until a job has finished."""
+        event = self._done.get(job.id)
+        if event is not None:
+            await event.wait()
+        return job
+
+    def _forget_old(self) -> None:
+        """Drop the oldest finished jobs above the history limit."""
+        finished = [j.id for j in self._jobs.values()
+                    if j.status in ("done", "failed")]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self._jobs[job_id]
+            self._done.pop(job_id, None)
+
+    async def _worker(self) -> None:
+        assert self._queue is not None
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run(job)
+            except Exception as e:
+                log.exception("Ingest job %s failed", job.id)
+                job.status = "failed"
+                job.error = str(e) or type(e).__name__
+            finally:
+                job.stage = None
+                job.finished_at = time.time()
+                event = self._done.get(job.id)
+                if event is not None:
+                    event.set()
+                self._queue.task_done()
+
+    async def _run(self, job: IngestJob) -> None:
+        job.status = "running"
+        job.started_at = time.time()
+        boilerplate = BoilerplateFilter(EXTRACT_BOILERPLATE_PAGES)
+        try:
+            stale = await _run_pipeline(job, boilerplate)
+            if stale:
+                # Pages crawled before the boilerplate of their domain was
+                # known are fetched again and replaced
+                await _run_pipeline(job, boilerplate, stale)
+        except BaseExceptionGroup as eg:
+            # Report the error of the stage that failed
+            raise eg.exceptions[0] from None
+        p = job.progress
+        if p["chunks"] + p["duplicate_chunks"] + p["duplicate_pages"] \
+                + p["unchanged_pages"] == 0:
+            raise IngestError("No text extracted from provided sites")
+        if job.result is None:
+            # Everything was already in the index
+            store = await asyncio.to_thread(
+                collection_manager.get, job.collection)
+            job.result = _result(job, {
+                "chunks": store.docs.n_live,
+                "index_type": index_type(store.index),
+            })
+        job.status = "done"
+
+
+async def _run_pipeline(
+    job: IngestJob,
+    boilerplate: BoilerplateFilter,
+    recheck: list[str] | None = None,
+) -> list[str]:
+    """Crawl, chunk, embed and index the pages of a job as a stream.
+
+    The stages run concurrently and pass pages, chunk batches and embedded
+    batches to each other through bounded queues. A stage that falls behind
+    makes the earlier stages wait, so memory use does not depend on the
+    size of the crawl. Pages are chunked in the worker processes, several at
+    a time. Duplicate pages and chunks are dropped in the chunk stage, in
+    crawl order, before they are embedded. Embedded chunks are written to the
+    index every INGEST_COMMIT_CHUNKS chunks.
+
+    Boilerplate is removed with the block counts of the crawl so far and
+    of the pages known from the last crawl. Returns the pages that kept
+    blocks found to be boilerplate later in the crawl. Passing them as
+    recheck fetches just these pages again and replaces their chunks.
+
+    Pages crawled before are requested conditionally and skipped when the
+    server answers 304 or their text has not changed. The stored chunks of
+    changed pages are replaced. The crawl state is saved once all chunks
+    are in the index.
+    """
+    pages_q: asyncio.Queue[PageDoc | None] = asyncio.Queue(INGEST_PAGE_QUEUE)
+    batch_q: asyncio.Queue[tuple[list[ChunkDoc], set[str]] | None] = \
+        asyncio.Queue(INGEST_EMBED_TASKS)
+    emb_q: asyncio.Queue[
+        tuple[list[ChunkDoc], np.ndarray | None, set[str]] | None] = \
+        asyncio.Queue(INGEST_EMBED_TASKS)
+    embed_tasks = max(1, INGEST_EMBED_TASKS)
+    job.stage = "crawl"
+    store = await asyncio.to_thread(_stored, job.collection)
+    deduper = Deduper(store)
+    # Chunks added by this job are never replaced
+    started_at = time.time()
+    live_urls = set(store.docs.urls()) if store is not None else set()
+    state = get_crawl_state(collection_dir(job.collection))
+    page_states: list[PageState] = []
+    if recheck is None:
+        await asyncio.to_thread(_count_known, state, boilerplate, job.urls)
+
+    async def crawl() -> None:
+        async def on_page(page: PageDoc) -> None:
+            if recheck is None:
+                job.progress["pages"] += 1
+            if page.not_modified:
+                job.progress["unchanged_pages"] += 1
+                return
+            job.progress["raw_bytes"] += page.raw_bytes
+            # Counted by canonical url, like the pages of the crawl state
+            boilerplate.add(canonical_url(page.url), block_keys(page.blocks))
+            page = replace(page, text="\n\n".join(
+                boilerplate.filter(page.url, page.blocks)))
+            job.progress["text_bytes"] += len(page.text.encode("utf-8"))
+            await pages_q.put(page)
+
+        if job.crawl is None:
+            job.crawl = CrawlStats()
+        with _stage(job, "crawl"):
+            if recheck is None:
+                await crawl_stream(
+                    urls=set(job.urls),
+                    max_pages=job.max_pages,
+                    max_depth=job.max_depth,
+                    on_page=on_page,
+                    seeds=_seeds(state, job.urls),
+                    headers_for=lambda url: conditional_headers(
+                        state.page(url)),
+                    stats=job.crawl,
+                )
+            else:
+                await crawl_stream(
+                    urls=set(recheck),
+                    max_pages=len(recheck),
+                    max_depth=0,
+                    on_page=on_page,
+                    stats=job.crawl,
+                )
+        job.stage = "chunk"
+        await pages_q.put(None)
+
+    async def chunk() -> None:
+        buf: list[ChunkDoc] = []
+        replace: set[str] = set()
+        # Pages being chunked by the worker processes. Their results are
+        # taken in crawl order so duplicates are found the same way as
+        # without workers.
+        pending: deque[tuple[PageDoc, bool, asyncio.Task | None]] = deque()
+        ahead = 2 * max(1, INGEST_PROCESSES)
+
+        async def take() -> None:
+            nonlocal buf, replace
+            page, changed, task = pending.popleft()
+            chunks: list[ChunkDoc] = []
+            if task is not None:
+                with _stage(job, "chunk"):
+                    offsets, headings, sigs = await task
+                    chunks = await asyncio.to_thread(
+                        _new_chunks, job, deduper, page, offsets, headings,
+                        sigs)
+            if changed and page.url in live_urls:
+                replace.add(page.url)
+            job.progress["chunks"] += len(chunks)
+            buf.extend(chunks)
+            while len(buf) >= INGEST_EMBED_BATCH:
+                await batch_q.put((buf[:INGEST_EMBED_BATCH], replace))
+                buf = buf[INGEST_EMBED_BATCH:]
+                replace = set()
+
+        try:
+            while (page := await pages_q.get()) is not None:
+                with _stage(job, "chunk"):
+                    page_state, changed = await asyncio.to_thread(
+                        _check_page, job, deduper, state, page)
+                if page_state is not None:
+                    page_states.append(page_state)
+                task = asyncio.create_task(run_cpu(
+                    chunk_offsets, page.text, CHUNKER, deduper.min_words,
+                )) if changed else None
+                pending.append((page, changed, task))
+                while pending and (len(pending) >= ahead
+                                   or pending[0][2] is None
+                                   or pending[0][2].done()):
+                    await take()
+            while pending:
+                await take()
+        finally:
+            for _page, _changed, task in pending:
+                if task is not None:
+                    task.cancel()
+        if buf or replace:
+            await batch_q.put((buf, replace))
+        job.stage = "embed"
+        for _ in range(embed_tasks):
+            await batch_q.put(None)
+
+    async def embed() -> None:
+        while (item := await batch_q.get()) is not None:
+            batch, replace = item
+            emb = None
+            if batch:
+                with _stage(job, "embed"):
+                    emb = await asyncio.to_thread(embed_chunks, batch)
+            job.progress["embedded"] += len(batch)
+            await emb_q.put((batch, emb, replace))
+        await emb_q.put(None)
+
+    async def index() -> None:
+        chunks: list[ChunkDoc] = []
+        vecs: list[np.ndarray] = []
+        replace: set[str] = set()
+        finished = 0
+
+        async def commit() -> None:
+            with _stage(job, "index"):
+                meta = await asyncio.to_thread(
+                    collection_manager.manager(
+                        job.collection, create=True).append,
+                    chunks,
+                    np.vstack(vecs) if vecs else None,
+                    set(replace),
+                    started_at,
+                )
+            job.progress["indexed"] += len(chunks)
+            job.progress["replaced_pages"] += len(replace)
+            job.result = _result(job, meta)
+            chunks.clear()
+            vecs.clear()
+            replace.clear()
+
+        while finished < embed_tasks:
+            item = await emb_q.get()
+            if item is None:
+                finished += 1
+                continue
+            chunks.extend(item[0])
+            if item[1] is not None:
+                vecs.append(item[1])
+            replace.update(item[2])
+            if len(chunks) >= INGEST_COMMIT_CHUNKS:
+                await commit()
+        job.stage = "index"
+        if chunks or replace:
+            await commit()
+
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(crawl())
+        tg.create_task(chunk())
+        for _ in range(embed_tasks):
+            tg.create_task(embed())
+        tg.create_task(index())
+
+    now = time.time()
+    sources = [Source(url, job.max_pages, job.max_depth, now)
+               for url in job.urls] if recheck is None else []
+    await asyncio.to_thread(state.update, page_states, sources)
+    return [] if recheck is not None else boilerplate.stale()
+
+
+def _stored(collection: str) -> IndexStore | None:
+    """Return the current store of a collection, None if it has no index."""
+    try:
+        return collection_manager.get(collection)
+    except FileNotFoundError:
+        return None
+
+
+def _host(url: str) -> str:
+    return urlsplit(canonical_url(url)).netloc
+
+
+def _seeds(state: CrawlState, urls: list[str]) -> list[tuple[str, int]]:
+    """Return the known pages of the hosts of urls with their depths."""
+    hosts = {_host(u) for u in urls}
+    return [(p.url, p.depth) for host in sorted(hosts)
+            for p in state.pages_of_host(host)]
+
+
+def _count_known(
+    state: CrawlState,
+    boilerplate: BoilerplateFilter,
+    urls: list[str],
+) -> None:
+    """Count the blocks of the known pages of the hosts of urls."""
+    for host in sorted({_host(u) for u in urls}):
+        for page in state.pages_of_host(host):
+            boilerplate.add(canonical_url(page.url),
+                            (bytes.fromhex(k) for k in page.blocks))
+
+
+def _check_page(
+    job: IngestJob,
+    deduper: Deduper,
+    state: CrawlState,
+    page: PageDoc,
+) -> tuple[PageState | None, bool]:
+    """Check whether a page has new content to chunk.
+
+    Returns the state to record for the page, None for duplicate pages, and
+    whether the page must be chunked and its stored chunks replaced. Pages
+    whose text is unchanged since the last crawl are not chunked.
+    """
+    page_state = PageState(
+        url=page.url,
+        etag=page.etag,
+        last_modified=page.last_modified,
+        content_hash=f"{content_hash(page.text):016x}",
+        depth=page.depth,
+        fetched_at=time.time(),
+        blocks=[k.hex() for k in block_keys(page.blocks)],
+    )
+    old = state.page(page.url)
+    if old is not None and old.content_hash == page_state.content_hash:
+        job.progress["unchanged_pages"] += 1
+        return page_state, False
+    if deduper.is_duplicate_page(page.canonical or page.url, page.text):
+        job.progress["duplicate_pages"] += 1
+        return None, False
+    return page_state, True
+
+
+def _new_chunks(
+    job: IngestJob,
+    deduper: Deduper,
+    page: PageDoc,
+    offsets: np.ndarray,
+    headings: list[str],
+    sigs: np.ndarray,
+) -> list[ChunkDoc]:
+    """Build the chunks of a page from the result of chunk_offsets().
+
+    Duplicates of earlier or stored content are left out.
+    """
+    chunks = page_chunks(page, offsets, headings)
+    keep = deduper.new_chunks([c.chunk for c in chunks], page.url, sigs)
+    job.progress["duplicate_chunks"] += len(chunks) - len(keep)
+    job.progress["added_pages"] += bool(keep)
+    return [chunks[i] for i in keep]
+
+
+def _result(job: IngestJob, meta: dict) -> dict:
+    p = job.progress
+    crawl = job.crawl.to_dict() if job.crawl else {}
+    return {
+        "total_chunks": meta["chunks"],
+        "index_type": meta["index_type"],
+        "added_chunks": p["indexed"],
+        "added_pages": p["added_pages"],
+        "added_domains": job.urls,
+        "duplicate_pages": p["duplicate_pages"],
+        "duplicate_chunks": p["duplicate_chunks"],
+        "unchanged_pages": p["unchanged_pages"],
+        "replaced_pages": p["replaced_pages"],
+        "raw_bytes": p["raw_bytes"],
+        "text_bytes": p["text_bytes"],
+        "bytes_removed_pct": _reduction(job),
+        "failed_pages": crawl.get("failed", 0),
+        "pages_per_sec": crawl.get("pages_per_sec", 0.0),
+        "bytes_per_sec": crawl.get("bytes_per_sec", 0.0),
+    }
+
+
+def _reduction(job: IngestJob) -> float:
+    """Percentage of the raw page text removed by content extraction."""
+    raw = job.progress["raw_bytes"]
+    if raw <= 0:
+        return 0.0
+    return round(100.0 * (1 - job.progress["text_bytes"] / raw), 1)
+
+
+@contextmanager
+def _stage(job: IngestJob, name: str) -> Iterator[None]:
+    """Add the time spent in a block to the busy time of a stage."""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        job.stage_times[name] = round(
+            job.stage_times.get(name, 0.0) + time.monotonic() - start, 3)
+
+
+job_manager = JobManager()
@@ -0,0 +1,318 @@
+from __future__ import annotations
+
+import os
+import re
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+
+_TOKEN_RE = re.compile(r"[A-Za-z0-9_]+(?:[.:/\-][A-Za-z0-9_]+)*")
+_PART_RE = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+")
+
+# BM25 parameters
+_K1 = 1.2
+_B = 0.75
+
+
+def tokenize(text: str) -> list[str]:
+    """Split text into lowercase search terms.
+
+    Identifiers like os.path.join, ERR_CONN_RESET or getUserName are kept
+    whole and also split into their parts, so both exact symbol lookups and
+    searches for the words in them match.
+    """
+    terms: list[str] = []
+    for m in _TOKEN_RE.finditer(text):
+        tok = m.group()
+        terms.append(tok.lower())
+        parts = _PART_RE.findall(tok)
+        if len(parts) > 1:
+            terms.extend(p.lower() for p in parts)
+    return terms
+
+
+def _encode_varint(vals: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Encode unsigned ints as LEB128 varints.
+
+    Returns the bytes and the amount of bytes used by each value.
+    """
+    vals = vals.astype(np.uint64)
+    nbytes = np.ones(len(vals), dtype=np.int64)
+    for k in range(1, 10):
+        nbytes += vals >= np.uint64(1 << (7 * k))
+    starts = np.cumsum(nbytes) - nbytes
+    owner = np.repeat(np.arange(len(vals)), nbytes)
+    shift = (np.arange(int(nbytes.sum())) - starts[owner]) * 7
+    out = (vals[owner] >> shift.astype(np.uint64)) & np.uint64(0x7F)
+    more = shift // 7 < nbytes[owner] - 1
+    out |= more.astype(np.uint64) << np.uint64(7)
+    return out.astype(np.uint8), nbytes
+
+
+def _decode_varint(buf: np.ndarray) -> np.ndarray:
+    """Decode LEB128 varints."""
+    if len(buf) == 0:
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero(buf < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    shift = np.arange(len(buf)) - np.repeat(starts, ends - starts + 1)
+    vals = (buf & 0x7F).astype(np.int64) << (7 * shift)
+    return np.add.reduceat(vals, starts)
+
+
+class Segment:
+    """Immutable postings for a contiguous range of documents.
+
+    The doc ids of each term are stored delta and varint encoded in one byte
+    array, term frequencies in a parallel array.
+    """
+
+    def __init__(
+        self,
+        base: int,
+        doc_lens: np.ndarray,
+        terms: list[str],
+        byte_offs: np.ndarray,
+        tf_offs: np.ndarray,
+        postings: np.ndarray,
+        tfs: np.ndarray,
+    ) -> None:
+        self.base = base
+        self.doc_lens = doc_lens
+        self.terms = terms
+        self.byte_offs = byte_offs
+        self.tf_offs = tf_offs
+        self.postings = postings
+        self.tfs = tfs
+        self._term_ids = {t: i for i, t in enumerate(terms)}
+
+    @property
+    def n_docs(self) -> int:
+        return len(self.doc_lens)
+
+    @property
+    def name(self) -> str:
+        return f"seg-{self.base:012d}-{self.base + self.n_docs:012d}.npz"
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory use, the term dict counted per term."""
+        arrays = (self.doc_lens, self.byte_offs, self.tf_offs, self.postings,
+                  self.tfs)
+        return sum(a.nbytes for a in arrays) + 100 * len(self.terms)
+
+    def df(self, term: str) -> int:
+        i = self._term_ids.get(term)
+        if i is None:
+            return 0
+        return int(self.tf_offs[i + 1] - self.tf_offs[i])
+
+    def postings_of(self, term: str) -> tuple[np.ndarray, np.ndarray]:
+        """Return the doc ids and term frequencies of a term."""
+        i = self._term_ids.get(term)
+        if i is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint16)
+        deltas = _decode_varint(
+            self.postings[self.byte_offs[i]:self.byte_offs[i + 1]])
+        ids = np.cumsum(deltas) + self.base
+        return ids, self.tfs[self.tf_offs[i]:self.tf_offs[i + 1]]
+
+    @classmethod
+    def from_postings(
+        cls,
+        base: int,
+        doc_lens: np.ndarray,
+        postings: dict[str, tuple[np.ndarray, np.ndarray]],
+    ) -> Segment:
+        """Create a segment from term -> (absolute doc ids, tfs)."""
+        terms = sorted(postings)
+        counts = np.array([len(postings[t][0]) for t in terms], dtype=np.int64)
+        tf_offs = np.concatenate(([0], np.cumsum(counts)))
+        if terms:
+            ids = np.concatenate([postings[t][0] for t in terms]) - base
+            tfs = np.concatenate([postings[t][1] for t in terms])
+        else:
+            ids = np.zeros(0, dtype=np.int64)
+            tfs = np.zeros(0, dtype=np.uint16)
+        # Delta encode the ids within each term, the first one as is
+        deltas = np.diff(ids, prepend=0)
+        deltas[tf_offs[:-1][counts > 0]] = ids[tf_offs[:-1][counts > 0]]
+        data, nbytes = _encode_varint(deltas)
+        byte_ends = np.cumsum(nbytes)
+        byte_offs = np.concatenate(
+            ([0], byte_ends[tf_offs[1:] - 1] if len(ids) else counts))
+        return cls(
+            base, doc_lens.astype(np.uint32), terms,
+            byte_offs.astype(np.int64), tf_offs.astype(np.int64),
+            data, tfs.astype(np.uint16),
+        )
+
+    @classmethod
+    def build(cls, base: int, texts: list[str]) -> Segment:
+        """Index texts that get the doc ids base, base + 1, ..."""
+        doc_lens = np.zeros(len(texts), dtype=np.uint32)
+        acc: dict[str, tuple[list[int], list[int]]] = {}
+        for i, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            doc_lens[i] = sum(counts.values())
+            for term, tf in counts.items():
+                entry = acc.get(term)
+                if entry is None:
+                    entry = acc[term] = ([], [])
+                entry[0].append(base + i)
+                entry[1].append(min(tf, 0xFFFF))
+        postings = {
+            t: (np.array(ids, dtype=np.int64), np.array(tfs, dtype=np.uint16))
+            for t, (ids, tfs) in acc.items()
+        }
+        return cls.from_postings(base, doc_lens, postings)
+
+    @classmethod
+    def merge(cls, segments: list[Segment]) -> Segment:
+        """Merge segments covering consecutive doc ranges."""
+        terms = sorted({t for s in segments for t in s.terms})
+        postings: dict[str, tuple[np.ndarray, np.ndarray]] = {}
+        for t in terms:
+            parts = [s.postings_of(t) for s in segments if s.df(t)]
+            postings[t] = (
+                np.concatenate([p[0] for p in parts]),
+                np.concatenate([p[1] for p in parts]),
+            )
+        doc_lens = np.concatenate([s.doc_lens for s in segments])
+        return cls.from_postings(segments[0].base, doc_lens, postings)
+
+    def save(self, path: Path) -> None:
+        tmp = path.with_name(path.name + ".tmp.npz")
+        np.savez(
+            tmp,
+            base=np.array([self.base], dtype=np.int64),
+            doc_lens=self.doc_lens,
+            terms=np.frombuffer(
+                "\n".join(self.terms).encode("utf-8"), dtype=np.uint8),
+            byte_offs=self.byte_offs,
+            tf_offs=self.tf_offs,
+            postings=self.postings,
+            tfs=self.tfs,
+        )
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: Path) -> Segment:
+        with np.load(path) as f:
+            raw = f["terms"].tobytes().decode("utf-8")
+            return cls(
+                int(f["base"][0]), f["doc_lens"],
+                raw.split("\n") if raw else [],
+                f["byte_offs"], f["tf_offs"], f["postings"], f["tfs"],
+            )
+
+
+class LexicalIndex:
+    """BM25 inverted index over the chunks of a store.
+
+    The index is a list of immutable segments. add() returns a new index
+    with an extra segment, small segments are merged so the amount of
+    segments stays logarithmic in the amount of documents.
+    """
+
+    def __init__(self, segments: tuple[Segment, ...] = ()) -> None:
+        self.segments = segments
+        self.n_docs = sum(s.n_docs for s in segments)
+        self.total_len = sum(int(s.doc_lens.sum()) for s in segments)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(s.nbytes for s in self.segments)
+
+    def add(self, texts: list[str]) -> LexicalIndex:
+        """Return a new index with the texts added as the next doc ids."""
+        if not texts:
+            return self
+        segments = list(self.segments)
+        segments.append(Segment.build(self.n_docs, texts))
+        while len(segments) >= 2 and \
+                segments[-2].n_docs <= 2 * segments[-1].n_docs:
+            merged = Segment.merge(segments[-2:])
+            segments[-2:] = [merged]
+        return LexicalIndex(tuple(segments))
+
+    def search(
+        self,
+        query: str,
+        top_k: int,
+        exclude: np.ndarray | None = None,
+    ) -> list[tuple[float, int]]:
+        """Return the top_k (score, doc id) pairs for the query.
+
+        exclude is a boolean mask of doc ids that must not be returned.
+        """
+        terms = set(tokenize(query))
+        if not terms or self.n_docs == 0:
+            return []
+        avg_len = self.total_len / self.n_docs
+        ids_parts: list[np.ndarray] = []
+        score_parts: list[np.ndarray] = []
+        for term in terms:
+            df = sum(s.df(term) for s in self.segments)
+            if df == 0:
+                continue
+            idf = np.log(1 + (self.n_docs - df + 0.5) / (df + 0.5))
+            for s in self.segments:
+                if not s.df(term):
+                    continue
+                ids, tfs = s.postings_of(term)
+                tf = tfs.astype(np.float32)
+                dl = s.doc_lens[ids - s.base].astype(np.float32)
+                norm = _K1 * (1 - _B + _B * dl / avg_len)
+                ids_parts.append(ids)
+                score_parts.append(idf * tf * (_K1 + 1) / (tf + norm))
+        if not ids_parts:
+            return []
+
+        ids = np.concatenate(ids_parts)
+        scores = np.concatenate(score_parts)
+        if exclude is not None:
+            keep = ~exclude[np.minimum(ids, len(exclude) - 1)] \
+                if len(exclude) else np.ones(len(ids), dtype=bool)
+            ids, scores = ids[keep], scores[keep]
+        uniq, inv = np.unique(ids, return_inverse=True)
+        totals = np.bincount(inv, weights=scores)
+        k = min(top_k, len(uniq))
+        if k <= 0:
+            return []
+        best = np.argpartition(-totals, k - 1)[:k]
+        best = best[np.argsort(-totals[best])]
+        return [(float(totals[i]), int(uniq[i])) for i in best]
+
+    def save(self, path: Path) -> None:
+        """Write new segments and remove the ones merged away."""
+        path.mkdir(parents=True, exist_ok=True)
+        keep = {s.name for s in self.segments}
+        for s in self.segments:
+            if not (path / s.name).exists():
+                s.save(path / s.name)
+        for p in path.glob("seg-*.npz"):
+            if p.name not in keep:
+                p.unlink(missing_ok=True)
+
+    @classmethod
+    def load(cls, path: Path) -> LexicalIndex:
+        """Load the segments that form a consecutive range from doc 0."""
+        by_base: dict[int, Segment] = {}
+        for p in sorted(path.glob("seg-*.npz")):
+            try:
+                seg = Segment.load(p)
+            except (OSError, ValueError, KeyError):
+                continue
+            # Prefer the larger, merged segment for a base
+            old = by_base.get(seg.base)
+            if old is None or seg.n_docs > old.n_docs:
+                by_base[seg.base] = seg
+        segments: list[Segment] = []
+        base = 0
+        while base in by_base:
+            seg = by_base[base]
+            segments.append(seg)
+            base += seg.n_docs
+        return cls(tuple(segments))
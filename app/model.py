@@ -1,13 +1,54 @@
 from __future__ import annotations
 
+import logging
+import random
+import threading
+import time
+from collections.abc import AsyncIterator
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from enum import Enum
 from functools import lru_cache
-from openai import NotFoundError, OpenAI, types
+from typing import Any
+from openai import (
+    APIConnectionError,
+    APIError,
+    APIStatusError,
+    AsyncOpenAI,
+    DefaultAsyncHttpxClient,
+    DefaultHttpxClient,
+    NotFoundError,
+    OpenAI,
+    RateLimitError,
+)
 
-from config import OPENAI_API_KEY, OPENAI_BASE_URL, OPENAI_CHAT_MODEL, OPENAI_EMBED_MODEL
+from config import (
+    EMBED_CONCURRENCY,
+    EMBED_MAX_RETRIES,
+    MODELS_CACHE_TTL,
+    OPENAI_API_KEY,
+    OPENAI_BASE_URL,
+    OPENAI_CHAT_MODEL,
+    OPENAI_EMBED_MODEL,
+)
+from tokens import count_tokens_max, truncate_tokens
 
+log = logging.getLogger(__name__)
+
+# Max tokens and inputs in one embeddings request
 MAX_TOKENS_EMBED = 300_000
+MAX_INPUTS_EMBED = 2048
+# Max tokens of one input of the embedding models
+MAX_TOKENS_INPUT = 8191
+# Share of the token limits that batches are packed to, the token counts
+# of the API may differ a little from the local ones
+_TOKEN_MARGIN = 0.9
+# Max amount of chat models kept by get_chat_model()
+MAX_CHAT_MODELS = 32
+
+_MODELS_LOCK = threading.Lock()
+# Model lists of each (api key, base url) and the time they were fetched
+_MODELS: dict[tuple[str, str | None], tuple[float, Any]] = {}
 
 
 class ModelType(Enum):  # TODO: use the type
@@ -16,6 +57,8 @@ class ModelType(Enum):  # TODO: use the type
 
 class ModelError(Enum):
     InvalidModel = 1
+    # The API failed to answer, after the retries of the client
+    RequestFailed = 2
 
 
 @dataclass
@@ -39,6 +82,7 @@ class Model:
             raise RuntimeError("OPENAI_API_KEY is not set")
         self._cfg = cfg
         self._client: OpenAI | None = None
+        self._async_client: AsyncOpenAI | None = None
 
     @property
     def cfg(self) -> ModelConfig:
@@ -46,11 +90,15 @@ class Model:
 
     def _get_client(self) -> OpenAI:
         if self._client is None:
-            api_key = self._cfg.api_key
-            base_url = self._cfg.base_url
-            self._client = OpenAI(api_key=api_key, base_url=base_url)
+            self._client = _shared_client(self._cfg.api_key, self._cfg.base_url)
         return self._client
 
+    def _get_async_client(self) -> AsyncOpenAI:
+        if self._async_client is None:
+            self._async_client = _shared_async_client(
+                self._cfg.api_key, self._cfg.base_url)
+        return self._async_client
+
     def generate_response(
         self,
         messages: list[dict[str, str]],
@@ -73,43 +121,137 @@ class Model:
             tokens_used
         )
 
+    async def generate_response_async(
+        self,
+        messages: list[dict[str, str]],
+    ) -> ModelResponse | ModelError:
+        """Generate response from a list of messages without blocking"""
+        client = self._get_async_client()
+        try:
+            resp = await client.chat.completions.create(
+                model=self._cfg.chat_model,
+                messages=messages,
+            )
+        except NotFoundError:
+            return ModelError.InvalidModel
+
+        tokens_used = 0
+        if (resp.usage):
+            tokens_used = resp.usage.total_tokens
+        return ModelResponse(
+            (resp.choices[0].message.content or "").strip(),
+            tokens_used
+        )
+
+    async def stream_response(
+        self,
+        messages: list[dict[str, str]],
+    ) -> AsyncIterator[str | ModelResponse | ModelError]:
+        """Stream a response from a list of messages.
+
+        Yields the text deltas as they arrive and finally the whole
+        ModelResponse, or a ModelError if the request fails, also after some
+        deltas have been sent.
+        """
+        client = self._get_async_client()
+        parts: list[str] = []
+        tokens_used = 0
+        try:
+            stream = await client.chat.completions.create(
+                model=self._cfg.chat_model,
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            async for chunk in stream:
+                if chunk.usage:
+                    tokens_used = chunk.usage.total_tokens
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    yield delta
+        except NotFoundError:
+            yield ModelError.InvalidModel
+            return
+        except APIError as e:
+            log.warning("Streaming a response from %s failed: %s",
+                        self._cfg.chat_model, e)
+            yield ModelError.RequestFailed
+            return
+        yield ModelResponse("".join(parts).strip(), tokens_used)
+
     def get_embeddings(self, text_chunks: list[str]) -> list[list[float]]:
-        """Generate embeddings"""
-        client = self._get_client()
+        """Generate embeddings
 
+        The texts are packed into batches by their token counts and the
+        batches are sent concurrently. The output is in the input order.
+        Texts over the token limit of an input are embedded by their start.
+        """
         if (text_chunks == []):
             return []
 
-        # Calculate the amount of chunks to process in one request
-        total_chunks = len(text_chunks)
-        reference_chunk = text_chunks[0]
-        tokens_per_chunk = calc_tokens_approx(reference_chunk)
-        total_chunk_tokens = tokens_per_chunk * total_chunks
-        batches: int = max(1, -(-total_chunk_tokens // MAX_TOKENS_EMBED))
-        batch_len = total_chunks // batches
+        counts = [count_tokens_max(t) for t in text_chunks]
+        max_input = int(MAX_TOKENS_INPUT * _TOKEN_MARGIN)
+        text_chunks = list(text_chunks)
+        for i, n in enumerate(counts):
+            if n > max_input:
+                log.warning("Embedding input of %d tokens truncated to %d",
+                            n, max_input)
+                text_chunks[i] = truncate_tokens(text_chunks[i], max_input)
+                counts[i] = max_input
+        batches = _pack_batches(
+            counts, int(MAX_TOKENS_EMBED * _TOKEN_MARGIN), MAX_INPUTS_EMBED)
+        if len(batches) == 1:
+            return self._embed_batch(text_chunks)
 
-        # Get embeddings for the batches
-        datas: list[types.Embedding] = []
-        tokens_used = 0
-        i = 0
-        while (i < total_chunks):
-            end = min(total_chunks, i + batch_len)
-            batch: list[str] = text_chunks[i:end]
-            resp = client.embeddings.create(
-                model=self._cfg.embed_model,
-                input=batch,
+        workers = max(1, min(EMBED_CONCURRENCY, len(batches)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(
+                lambda b: self._embed_batch(text_chunks[b[0]:b[1]]),
+                batches,
             )
-            datas.extend(resp.data)
-            if resp.usage:
-                tokens_used += resp.usage.total_tokens
-            i = end
+            return [vec for res in results for vec in res]
+
+    def _embed_batch(self, batch: list[str]) -> list[list[float]]:
+        """Embed one batch, retrying on rate limits and server errors."""
+        # Retries are handled here instead of in the client
+        client = self._get_client().with_options(max_retries=0)
+        attempt = 0
+        while True:
+            try:
+                resp = client.embeddings.create(
+                    model=self._cfg.embed_model,
+                    input=batch,
+                )
+                break
+            except (RateLimitError, APIConnectionError, APIStatusError) as e:
+                retryable = isinstance(e, (RateLimitError, APIConnectionError)) \
+                    or e.status_code >= 500
+                if not retryable or attempt >= EMBED_MAX_RETRIES:
+                    raise
+                time.sleep(_retry_delay(e, attempt))
+                attempt += 1
 
-        return [r.embedding for r in datas]
+        data = sorted(resp.data, key=lambda r: r.index)
+        return [r.embedding for r in data]
 
     def get_models(self):
-        """Get all the models."""
-        client = self._get_client()
-        return client.models.list()
+        """Get all the models.
+
+        The list is fetched at most once in MODELS_CACHE_TTL seconds.
+        """
+        key = (self._cfg.api_key, self._cfg.base_url)
+        with _MODELS_LOCK:
+            cached = _MODELS.get(key)
+        if cached is not None \
+                and time.monotonic() - cached[0] < MODELS_CACHE_TTL:
+            return cached[1]
+        models = self._get_client().models.list()
+        with _MODELS_LOCK:
+            _MODELS[key] = (time.monotonic(), models)
+        return models
 
     @staticmethod
     def get_model(model_name: str) -> Model:
@@ -130,12 +272,100 @@ class Model:
         return Model.get_model(OPENAI_CHAT_MODEL)
 
 
+@lru_cache(maxsize=None)
+def _shared_client(api_key: str, base_url: str | None) -> OpenAI:
+    """OpenAI client shared by all the models of an API."""
+    return OpenAI(
+        api_key=api_key,
+        base_url=base_url,
+        http_client=_shared_http_client(),
+    )
+
+
+@lru_cache(maxsize=None)
+def _shared_async_client(api_key: str, base_url: str | None) -> AsyncOpenAI:
+    """Async OpenAI client shared by all the models of an API."""
+    return AsyncOpenAI(
+        api_key=api_key,
+        base_url=base_url,
+        http_client=_shared_async_http_client(),
+    )
+
+
+@lru_cache(maxsize=1)
+def _shared_http_client() -> DefaultHttpxClient:
+    """HTTP client whose connection pool is shared by all the models."""
+    return DefaultHttpxClient()
+
+
+@lru_cache(maxsize=1)
+def _shared_async_http_client() -> DefaultAsyncHttpxClient:
+    """Async HTTP client whose connection pool is shared by all the models."""
+    return DefaultAsyncHttpxClient()
+
+
+def get_chat_model(model_name: str) -> Model | None:
+    """Return the Model of a chat model, created once per model name.
+
+    Returns None for a name the API does not list, so unknown names do not
+    push the models in use out of the cache. If the list cannot be fetched
+    the model is created without caching it.
+    """
+    if model_name == OPENAI_CHAT_MODEL:
+        return default_model()
+    try:
+        known = {m.id for m in default_model().get_models().data}
+    except APIError as e:
+        log.warning("Could not list the models: %s", e)
+        return Model.get_model(model_name)
+    if model_name not in known:
+        return None
+    return _chat_model(model_name)
+
+
+@lru_cache(maxsize=MAX_CHAT_MODELS)
+def _chat_model(model_name: str) -> Model:
+    return Model.get_model(model_name)
+
+
 @lru_cache(maxsize=1)
 def default_model() -> Model:
-    return Model.from_env()
+    return _chat_model(OPENAI_CHAT_MODEL)
+
+
+def _pack_batches(
+    counts: list[int],
+    max_tokens: int,
+    max_inputs: int,
+) -> list[tuple[int, int]]:
+    """Split texts into consecutive (start, end) batches under the limits.
+
+    counts are the token counts of the texts.
+    """
+    batches: list[tuple[int, int]] = []
+    start = 0
+    tokens = 0
+    for i, count in enumerate(counts):
+        # Every input costs at least one token
+        text_tokens = count + 1
+        if i > start and (tokens + text_tokens > max_tokens
+                          or i - start >= max_inputs):
+            batches.append((start, i))
+            start = i
+            tokens = 0
+        tokens += text_tokens
+    batches.append((start, len(counts)))
+    return batches
 
 
-def calc_tokens_approx(text: str) -> int:
-    """Approximate the token count of the text."""
-    char_to_token = 5
-    return len(text) // char_to_token
+def _retry_delay(error: Exception, attempt: int) -> float:
+    """Seconds to wait before the next retry, with jitter."""
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        if retry_after:
+            try:
+                return min(60.0, float(retry_after))
+            except ValueError:
+                pass
+    return min(30.0, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.0)
@@ -0,0 +1,183 @@
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+
+from config import (
+    QUERY_BATCH_CONCURRENCY,
+    QUERY_BATCH_MAX,
+    QUERY_BATCH_WINDOW_MS,
+    QUERY_CACHE_SIZE,
+    QUERY_CACHE_TTL,
+)
+
+_Key = tuple[str, str]
+
+
+def normalize_query(text: str) -> str:
+    """Collapse whitespace so trivially different queries share a key."""
+    return " ".join(text.split())
+
+
+class QueryEmbedder:
+    """Embeds search queries with an LRU/TTL cache.
+
+    Concurrent requests for the same query wait for a single embedding call
+    instead of each making their own. Different queries arriving within
+    batch_window seconds of each other are embedded in one request. While all
+    request slots are busy, new queries keep collecting into the next batch,
+    so a lone query under light traffic only waits for the window.
+    """
+
+    def __init__(
+        self,
+        embed_fn: Callable[[list[str]], np.ndarray],
+        model_fn: Callable[[], str],
+        max_entries: int = QUERY_CACHE_SIZE,
+        ttl: float = QUERY_CACHE_TTL,
+        batch_window: float = QUERY_BATCH_WINDOW_MS / 1000,
+        max_batch: int = QUERY_BATCH_MAX,
+        concurrency: int = QUERY_BATCH_CONCURRENCY,
+    ) -> None:
+        self._embed_fn = embed_fn
+        self._model_fn = model_fn
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.batches = 0
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.concurrency = max(1, concurrency)
+        self._lock = threading.Lock()
+        # Signals new pending queries and freed request slots
+        self._cond = threading.Condition(self._lock)
+        self._pending: list[tuple[_Key, Future[np.ndarray]]] = []
+        self._busy = 0
+        self._scheduler: threading.Thread | None = None
+        self._pool: ThreadPoolExecutor | None = None
+        self._cache: OrderedDict[_Key, tuple[float, np.ndarray]] = OrderedDict()
+        self._inflight: dict[_Key, Future[np.ndarray]] = {}
+
+    def embed(self, text: str) -> np.ndarray:
+        """Return the normalized embedding vector of the query."""
+        return self.submit(text).result()
+
+    def submit(self, text: str) -> Future[np.ndarray]:
+        """Return a future for the embedding of the query."""
+        text = normalize_query(text)
+        key = (self._model_fn(), text)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                created, vec = cached
+                if time.monotonic() - created < self.ttl:
+                    self._cache.move_to_end(key)
+                    self.hits += 1
+                    fut: Future[np.ndarray] = Future()
+                    fut.set_result(vec)
+                    return fut
+                del self._cache[key]
+
+            fut = self._inflight.get(key)
+            if fut is not None:
+                self.coalesced += 1
+                return fut
+            fut = Future()
+            self._inflight[key] = fut
+            self.misses += 1
+
+            if self.max_batch > 1:
+                self._pending.append((key, fut))
+                self._start_scheduler()
+                self._cond.notify_all()
+                return fut
+
+        self._run([(key, fut)])
+        return fut
+
+    def _start_scheduler(self) -> None:
+        """Start the batching thread. Needs the lock."""
+        if self._scheduler is not None:
+            return
+        self._pool = ThreadPoolExecutor(
+            max_workers=self.concurrency,
+            thread_name_prefix="query-embed",
+        )
+        self._scheduler = threading.Thread(
+            target=self._schedule, name="query-embed-scheduler", daemon=True)
+        self._scheduler.start()
+
+    def _schedule(self) -> None:
+        """Collect pending queries into batches and send them."""
+        assert self._pool is not None
+        while True:
+            with self._cond:
+                while not self._pending or self._busy >= self.concurrency:
+                    self._cond.wait()
+                # Give other queries a moment to join the batch
+                deadline = time.monotonic() + self.batch_window
+                while len(self._pending) < self.max_batch:
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        break
+                    self._cond.wait(left)
+                batch = self._pending[:self.max_batch]
+                del self._pending[:self.max_batch]
+                self._busy += 1
+                self.batches += 1
+            self._pool.submit(self._run_batch, batch)
+
+    def _run_batch(self, batch: list[tuple[_Key, Future[np.ndarray]]]) -> None:
+        try:
+            self._run(batch)
+        finally:
+            with self._cond:
+                self._busy -= 1
+                self._cond.notify_all()
+
+    def _run(self, batch: list[tuple[_Key, Future[np.ndarray]]]) -> None:
+        """Embed a batch of queries and resolve their futures."""
+        try:
+            vecs = self._embed_fn([key[1] for key, _fut in batch])
+        except BaseException as e:
+            with self._lock:
+                for key, _fut in batch:
+                    self._inflight.pop(key, None)
+            for _key, fut in batch:
+                fut.set_exception(e)
+            return
+        for (key, fut), vec in zip(batch, vecs):
+            self._resolve(key, fut, vec)
+
+    def _resolve(self, key: _Key, fut: Future[np.ndarray], vec: np.ndarray) -> None:
+        vec.setflags(write=False)
+        with self._lock:
+            self._inflight.pop(key, None)
+            if self.max_entries > 0:
+                self._cache[key] = (time.monotonic(), vec)
+                self._cache.move_to_end(key)
+                while len(self._cache) > self.max_entries:
+                    self._cache.popitem(last=False)
+        fut.set_result(vec)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._cache),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "batches": self.batches,
+            }
@@ -1,9 +1,22 @@
 from __future__ import annotations
 
+import asyncio
+from collections.abc import AsyncIterator
 from dataclasses import dataclass
 
-from index_store import ChunkDoc
-from model import Model, default_model, ModelError
+from answer_cache import AnswerLookup, answer_key, get_answer_cache
+from config import CONTEXT_CANDIDATES, HISTORY_TOKEN_SHARE, MMR_LAMBDA, SEARCH_MODE
+from context import (
+    ChatMessage,
+    build_context,
+    fit_history,
+    format_context,
+    message_tokens,
+    mmr,
+    prompt_budget,
+)
+from index_store import ChunkDoc, ChunkFilter, query_embedder
+from model import Model, default_model, get_chat_model, ModelError, ModelResponse
 
 _SYSTEM = (
     """
@@ -20,17 +33,8 @@ class RagAnswer:
     answer: str
     sources: list[str]
     tokens_used: int
-
-
-ChatMessage = dict[str, str]
-
-
-def _trim_history(history: list[ChatMessage], *, max_messages: int) -> list[ChatMessage]:
-    if max_messages <= 0:
-        return []
-    if len(history) <= max_messages:
-        return history
-    return history[-max_messages:]
+    # Answered from the answer cache without calling the model
+    cached: bool = False
 
 
 def _history_user_questions(history: list[ChatMessage], max_items: int = 6) -> list[str]:
@@ -64,18 +68,30 @@ class RagService:
 
 
     def set_model(self, model_name: str):
-        """Set the used model."""
-        self.model = Model.get_model(model_name)
+        """Set the default model."""
+        model = get_chat_model(model_name)
+        if model is None:
+            raise ValueError(f"Invalid model '{model_name}'")
+        self.model = model
 
 
-    def answer(
+    def _build_messages(
         self,
         index_store,
         prompt: str,
         top_k: int,
         history: list[ChatMessage] | None = None,
-    ) -> RagAnswer | ModelError:
-        """Generate an answer from user prompt"""
+        nprobe: int | None = None,
+        ef_search: int | None = None,
+        search_mode: str | None = None,
+        model: Model | None = None,
+        filters: ChunkFilter | None = None,
+    ) -> tuple[list[ChatMessage], list[str], AnswerLookup | None]:
+        """Retrieve the context and create the messages for the model.
+
+        Returns the messages, the unique source urls and the answer cache
+        lookup of the question, None if its answer is not cached.
+        """
 
         # Add chat history to the prompt
         retrieval_text = prompt
@@ -85,54 +101,199 @@ class RagService:
                 retrieval_text = prompt + "\n\nPrevious questions:\n" + \
                     "\n".join(f"- {q}" for q in qs)
 
-        # Search for relevant info using the embeddings
-        hits = index_store.search(top_k, retrieval_text)
-        context, urls = _format_context(hits)
+        # Search for relevant info, the context is picked from more hits
+        # than it can hold so that near duplicates can be left out
+        hits = index_store.search(
+            top_k * max(1, CONTEXT_CANDIDATES), retrieval_text,
+            nprobe=nprobe, ef_search=ef_search, mode=search_mode,
+            filters=filters)
+        hits = mmr(hits, top_k, MMR_LAMBDA)
+
+        # The history and the context share the prompt tokens of the model
+        question = "\n\nQUESTION\n" + prompt
+        chat_model = (model or self._get_model()).cfg.chat_model
+        budget = prompt_budget(chat_model) \
+            - message_tokens(self.system_prompt) \
+            - message_tokens("CONTEXT\n" + question)
+        kept = fit_history(history or [], int(budget * HISTORY_TOKEN_SHARE),
+                           self.max_history_messages)
+        budget -= sum(message_tokens(m.get("content") or "") for m in kept)
+        blocks = build_context(hits, budget)
+        lookup = self._lookup_answer(
+            index_store, prompt, [c for b in blocks for c in b.chunks],
+            history, search_mode, chat_model)
 
         # Create prompt
         messages: list[ChatMessage] = [
             {"role": "system", "content": self.system_prompt}]
-        if history:
-            messages.extend(_trim_history(
-                history, max_messages=self.max_history_messages))
+        messages.extend(kept)
 
-        user_text = ("CONTEXT\n" + context + "\n\n" + "QUESTION\n" + prompt)
+        user_text = "CONTEXT\n" + format_context(blocks) + question
         messages.append({"role": "user", "content": user_text})
 
-        res = self._get_model().generate_response(messages)
-        if (isinstance(res, ModelError)):
-            return res
-
         # Filter duplicate urls out
         seen: set[str] = set()
         unique: list[str] = []
-        for url in urls:
-            if url not in seen:
-                seen.add(url)
-                unique.append(url)
+        for block in blocks:
+            if block.url not in seen:
+                seen.add(block.url)
+                unique.append(block.url)
+
+        return messages, unique, lookup
+
+
+    def _lookup_answer(
+        self,
+        index_store,
+        prompt: str,
+        chunks: list[ChunkDoc],
+        history: list[ChatMessage] | None,
+        search_mode: str | None,
+        chat_model: str,
+    ) -> AnswerLookup | None:
+        """Look up the answer of a question in the answer cache.
+
+        Only questions without history are cached, the answers to follow
+        up questions depend on the conversation. Lexical searches make no
+        embedding call, their answers are not cached either.
+        """
+        cache = get_answer_cache()
+        if cache is None or history or index_store.stamp is None \
+                or (search_mode or SEARCH_MODE) == "lexical":
+            return None
+        key = answer_key(
+            repr(index_store.stamp),
+            chat_model,
+            [doc.id for doc in chunks],
+        )
+        # The same embedding as the dense search, served by the query cache
+        return cache.lookup(key, query_embedder.embed(prompt))
+
+
+    def answer(
+        self,
+        index_store,
+        prompt: str,
+        top_k: int,
+        history: list[ChatMessage] | None = None,
+        nprobe: int | None = None,
+        ef_search: int | None = None,
+        search_mode: str | None = None,
+        model: Model | None = None,
+        filters: ChunkFilter | None = None,
+    ) -> RagAnswer | ModelError:
+        """Generate an answer from user prompt.
+
+        model overrides the default model for this call only, filters
+        restricts the context to the matching chunks.
+        """
+        model = model or self._get_model()
+        messages, sources, lookup = self._build_messages(
+            index_store, prompt, top_k, history, nprobe, ef_search,
+            search_mode, model, filters)
+        if lookup is not None and lookup.answer is not None:
+            return RagAnswer(lookup.answer, sources, 0, cached=True)
+
+        res = model.generate_response(messages)
+        if (isinstance(res, ModelError)):
+            return res
+
+        _cache_answer(lookup, res.text)
+        return RagAnswer(
+            answer=res.text,
+            sources=sources,
+            tokens_used=res.tokens_used
+        )
+
+
+    async def answer_async(
+        self,
+        index_store,
+        prompt: str,
+        top_k: int,
+        history: list[ChatMessage] | None = None,
+        nprobe: int | None = None,
+        ef_search: int | None = None,
+        search_mode: str | None = None,
+        model: Model | None = None,
+        filters: ChunkFilter | None = None,
+    ) -> RagAnswer | ModelError:
+        """Generate an answer from user prompt without blocking the loop"""
+        model = model or self._get_model()
+        # Retrieval is CPU and thread bound, run it off the event loop
+        messages, sources, lookup = await asyncio.to_thread(
+            self._build_messages,
+            index_store, prompt, top_k, history, nprobe, ef_search,
+            search_mode, model, filters)
+        if lookup is not None and lookup.answer is not None:
+            return RagAnswer(lookup.answer, sources, 0, cached=True)
+
+        res = await model.generate_response_async(messages)
+        if (isinstance(res, ModelError)):
+            return res
 
+        await asyncio.to_thread(_cache_answer, lookup, res.text)
         return RagAnswer(
             answer=res.text,
-            sources=unique,
+            sources=sources,
             tokens_used=res.tokens_used
         )
 
 
+    async def answer_stream(
+        self,
+        index_store,
+        prompt: str,
+        top_k: int,
+        history: list[ChatMessage] | None = None,
+        nprobe: int | None = None,
+        ef_search: int | None = None,
+        search_mode: str | None = None,
+        model: Model | None = None,
+        filters: ChunkFilter | None = None,
+    ) -> AsyncIterator[list[str] | str | RagAnswer | ModelError]:
+        """Stream an answer from user prompt.
+
+        Yields the source urls once retrieval is done, then the answer text
+        deltas and finally the whole RagAnswer or a ModelError. A cached
+        answer comes as a single delta.
+        """
+        model = model or self._get_model()
+        messages, sources, lookup = await asyncio.to_thread(
+            self._build_messages,
+            index_store, prompt, top_k, history, nprobe, ef_search,
+            search_mode, model, filters)
+        yield sources
+        if lookup is not None and lookup.answer is not None:
+            yield lookup.answer
+            yield RagAnswer(lookup.answer, sources, 0, cached=True)
+            return
+
+        async for part in model.stream_response(messages):
+            if isinstance(part, ModelError):
+                yield part
+                return
+            if isinstance(part, ModelResponse):
+                await asyncio.to_thread(_cache_answer, lookup, part.text)
+                yield RagAnswer(
+                    answer=part.text,
+                    sources=sources,
+                    tokens_used=part.tokens_used,
+                )
+                return
+            yield part
+
+
     def get_all_models(self):
         """Get all the models."""
         model = self._get_model()
         return model.get_models()
 
 
-def _format_context(hits: list[tuple[float, ChunkDoc]]) -> tuple[str, list[str]]:
-    """Make a formatted user prompt from the list of relevant info"""
-    urls: list[str] = []
-    blocks: list[str] = []
-    for i, (_score, doc) in enumerate(hits, start=1):
-        urls.append(doc.url)
-        title = doc.title.strip() or doc.url
-        blocks.append(f"[{i}] {title}\nURL: {doc.url}\nCONTENT: {doc.chunk}")
-    return "\n\n".join(blocks), urls
+def _cache_answer(lookup: AnswerLookup | None, answer: str) -> None:
+    cache = get_answer_cache()
+    if lookup is not None and cache is not None:
+        cache.put(lookup, answer)
 
 
 rag_service = RagService()
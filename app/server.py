@@ -1,22 +1,29 @@
 from __future__ import annotations
-from dataclasses import dataclass
 
-from rag import ChatMessage, rag_service
-from model import ModelError
-from index_store import IndexStore, append_and_save
-from crawler import crawl_async
-from config import CHUNK_OVERLAP, CHUNK_SIZE, MAX_DEPTH, MAX_PAGES, TOP_K
-from chunker import chunk_pages
+from rag import ChatMessage, RagAnswer, rag_service
+from model import ModelError, default_model, get_chat_model
+from answer_cache import get_answer_cache
+from embed_cache import get_embed_cache
+from collection import collection_manager, collection_name, list_collections
+from index_store import ChunkFilter, query_embedder
+from jobs import job_manager
+from sessions import get_session_store
+from workers import shutdown_pool
+from config import MAX_DEPTH, MAX_PAGES, REFRESH_INTERVAL, TOP_K
 
 from pydantic import BaseModel, Field
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Response
 from dotenv import load_dotenv
 
+import asyncio
+import json
+import logging
 import sys
+from contextlib import asynccontextmanager
+from typing import Literal
 from pathlib import Path
-import threading
 import uuid
 from urllib.parse import urlparse
 
@@ -28,22 +35,25 @@ if str(_REPO_ROOT) not in sys.path:
 PORT = "8000"
 HOST = "127.0.0.1"
 
+log = logging.getLogger(__name__)
 
-@dataclass
-class Session:
-    id: str
-    history: list[ChatMessage]
-    tokens_used: int
 
+load_dotenv()
 
-_SESSIONS_LOCK = threading.Lock()
-_SESSIONS: dict[str, Session] = {}
-_MAX_SESSION_MESSAGES = 20
 
+@asynccontextmanager
+async def _lifespan(app: FastAPI):
+    refresher = None
+    if REFRESH_INTERVAL > 0:
+        refresher = asyncio.create_task(
+            job_manager.refresh_every(REFRESH_INTERVAL))
+    yield
+    if refresher is not None:
+        refresher.cancel()
+    shutdown_pool()
 
-load_dotenv()
 
-app = FastAPI(title="docrag")
+app = FastAPI(title="docrag", lifespan=_lifespan)
 
 _STATIC_DIR = Path(__file__).resolve().parent / "static"
 
@@ -52,8 +62,41 @@ app.mount("/static", StaticFiles(directory=str(_STATIC_DIR)), name="static")
 
 class IngestReq(BaseModel):
     urls: list[str] = Field(..., min_length=1)
+    # Collection to add the pages to, the default collection if not set
+    collection: str | None = None
     max_pages: int | None = None
     max_depth: int | None = None
+    # Wait for the ingest job to finish before responding
+    wait: bool = False
+
+
+class RefreshReq(BaseModel):
+    # Refresh only the sites on the hosts of these urls
+    urls: list[str] | None = None
+    # Refresh only the sites of this collection
+    collection: str | None = None
+    # Wait for the refresh jobs to finish before responding
+    wait: bool = False
+
+
+class DeleteReq(BaseModel):
+    # Pages to delete, as listed by /sites
+    urls: list[str] = Field(default_factory=list)
+    # Hosts whose pages are all deleted, e.g. docs.example.com
+    domains: list[str] = Field(default_factory=list)
+    collection: str | None = None
+
+
+class FilterReq(BaseModel):
+    # Hosts of the pages, e.g. docs.example.com
+    domains: list[str] = Field(default_factory=list)
+    # Beginnings of the page urls, e.g. https://docs.example.com/api/
+    url_prefixes: list[str] = Field(default_factory=list)
+    # Text the page titles contain, without case
+    title: str | None = None
+    # Unix times the chunks were ingested at or after and before
+    added_after: float | None = None
+    added_before: float | None = None
 
 
 class ChatReq(BaseModel):
@@ -61,6 +104,15 @@ class ChatReq(BaseModel):
     top_k: int | None = None
     session_id: str | None = None
     model: str | None = None
+    # Search parameters for IVF and HNSW indexes
+    nprobe: int | None = Field(None, ge=1)
+    ef_search: int | None = Field(None, ge=1)
+    # hybrid, dense or lexical, lexical needs no embedding call
+    search_mode: Literal["hybrid", "dense", "lexical"] | None = None
+    # Collection to search, or a list of collections searched together
+    collection: str | list[str] | None = None
+    # Search only the chunks of matching pages
+    filters: FilterReq | None = None
 
 
 def _allowed_urls(urls: list[str]) -> set[str]:
@@ -76,11 +128,47 @@ def _allowed_urls(urls: list[str]) -> set[str]:
     return out
 
 
+def _chunk_filter(req: FilterReq | None) -> ChunkFilter | None:
+    """Convert the filters of a request, None if nothing is filtered."""
+    if req is None:
+        return None
+    f = ChunkFilter(
+        domains=tuple(d.strip() for d in req.domains if d.strip()),
+        url_prefixes=tuple(p for p in req.url_prefixes if p),
+        title=(req.title or "").strip(),
+        added_after=req.added_after,
+        added_before=req.added_before,
+    )
+    return f or None
+
+
+def _collection(name: str | None) -> str:
+    """Validate a collection name of a request."""
+    try:
+        return collection_name(name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
 @app.get("/health")
 def health():
     return {"ok": True}
 
 
+@app.get("/stats")
+def stats():
+    """Get cache statistics."""
+    cache = get_embed_cache(default_model().cfg.embed_model)
+    answers = get_answer_cache()
+    return {
+        "embed_cache": cache.stats() if cache else None,
+        "query_cache": query_embedder.stats(),
+        "answer_cache": answers.stats() if answers else None,
+        "sessions": get_session_store().stats(),
+        "collections": collection_manager.stats(),
+    }
+
+
 @app.get("/getState")
 def getState():
     models = rag_service.get_all_models()
@@ -93,120 +181,267 @@ def getState():
     }
 
 
+@app.get("/collections")
+def collections():
+    """Get the names of the collections that have an index."""
+    return {"collections": list_collections()}
+
+
 @app.get("/sites")
-def sites():
-    """Get all the pages that are in the index."""
+def sites(collection: str | None = None):
+    """Get all the pages that are in the index of a collection."""
     try:
-        index_store = IndexStore.load()
+        index_store = collection_manager.get(_collection(collection))
     except FileNotFoundError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-    sites = [site.url for site in index_store.docs]
-    return {"sites": list(set(sites))}
+    return {"sites": index_store.docs.urls()}
 
 
 @app.post("/clear")
-def clear():
-    """Clear the data index."""
+def clear(collection: str | None = None):
+    """Clear the data index of a collection."""
     try:
-        index_store = IndexStore.load()
+        collection_manager.manager(_collection(collection)).clear()
     except FileNotFoundError as e:
         raise HTTPException(status_code=400, detail=str(e))
-    index_store.clear()
     return {"ok": True}
 
 
-@app.post("/ingest")
-async def ingest(req: IngestReq):
-    """Add a list of domains to the data store."""
+@app.post("/delete")
+def delete(req: DeleteReq):
+    """Delete the chunks of pages or whole domains from the index.
+
+    The chunks leave the search results right away, the index files are
+    compacted in the background.
+    """
+    if not req.urls and not req.domains:
+        raise HTTPException(status_code=400, detail="No urls or domains given")
+    collection = _collection(req.collection)
+    try:
+        return collection_manager.manager(collection).delete(
+            set(req.urls), set(req.domains))
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.post("/compact")
+def compact(collection: str | None = None):
+    """Rewrite the index of a collection without its deleted chunks."""
+    try:
+        return collection_manager.manager(_collection(collection)).compact()
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.post("/ingest", status_code=202)
+async def ingest(req: IngestReq, response: Response):
+    """Add a list of domains to the data store.
+
+    The ingest runs as a background job, its id is returned right away with
+    202. With wait the result is sent with 200 when the job has finished.
+    """
     urls = _allowed_urls(req.urls)
     if not urls:
         raise HTTPException(status_code=400, detail="No valid domains in urls")
 
-    # Crawl the pages for contents
-    pages = await crawl_async(
-        urls=urls,
+    job = job_manager.submit(
+        urls=list(urls),
         max_pages=req.max_pages or MAX_PAGES,
         max_depth=req.max_depth or MAX_DEPTH,
+        collection=_collection(req.collection),
     )
-
-    # Split the page contents to smaller chunks
-    chunks = chunk_pages(pages, CHUNK_SIZE, CHUNK_OVERLAP)
-
-    if not chunks:
-        raise HTTPException(
-            status_code=400, detail="No text extracted from provided sites")
-
-    meta = append_and_save(chunks)
-    return {
-        "total_chunks": meta["chunks"],
-        "added_chunks": len(chunks),
-        "added_pages": len(pages),
-        "added_domains": sorted(urls),
-    }
+    if not req.wait:
+        return job.to_dict()
+
+    await job_manager.wait(job)
+    if job.status == "failed":
+        raise HTTPException(status_code=400, detail=job.error)
+    response.status_code = 200
+    return job.result
+
+
+@app.post("/refresh", status_code=202)
+async def refresh(response: Response, req: RefreshReq | None = None):
+    """Re-crawl the ingested sites as background jobs.
+
+    Unchanged pages are skipped, only changed pages are embedded again. The
+    jobs are returned right away with 202, with wait they are sent with 200
+    when all of them have finished.
+    """
+    urls = list(_allowed_urls(req.urls)) if req and req.urls else None
+    collection = _collection(req.collection) \
+        if req and req.collection else None
+    jobs = job_manager.refresh(urls, collection)
+    if req and req.wait:
+        for job in jobs:
+            await job_manager.wait(job)
+        response.status_code = 200
+    return {"jobs": [job.to_dict() for job in jobs]}
+
+
+@app.get("/jobs")
+def jobs():
+    """Get the recent ingest jobs."""
+    return {"jobs": [job.to_dict() for job in job_manager.list()]}
+
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    """Get the status and progress of an ingest job."""
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+
+async def _session_history(sid: str) -> list[ChatMessage]:
+    """Return the history of a session, empty for a new or expired one."""
+    session = await asyncio.to_thread(get_session_store().get, sid)
+    return session.history if session is not None else []
+
+
+async def _save_turn(sid: str, question: str, ans: RagAnswer) -> int:
+    """Add a question and its answer to the session history.
+
+    Returns the total amount of tokens used by the session.
+    """
+    session = await asyncio.to_thread(
+        get_session_store().add_turn,
+        sid,
+        [{"role": "user", "content": question},
+         {"role": "assistant", "content": ans.answer}],
+        ans.tokens_used,
+    )
+    return session.tokens_used
 
 
-@app.post("/answer")
-def answer(req: ChatReq):
-    """Answer to a user query."""
+async def _prepare_answer(req: ChatReq):
+    """Load the index, the session history and the requested model."""
+    names = req.collection if isinstance(req.collection, list) \
+        else [req.collection]
+    names = [_collection(n) for n in names] or [_collection(None)]
     try:
-        index_store = IndexStore.load()
+        index_store = await asyncio.to_thread(
+            collection_manager.search_store, names)
     except FileNotFoundError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
     # Retrieve history
     sid = (req.session_id or "").strip() or uuid.uuid4().hex
-    with _SESSIONS_LOCK:
-        session = _SESSIONS.get(sid)
-        if session is None:
-            session = Session(id=sid, history=[], tokens_used=0)
-            _SESSIONS[sid] = session
-        history = session.history
-
-    old_model = rag_service._get_model()
-    # Set the used model
-    if (req.model):
-        rag_service.set_model(req.model)
+    history = await _session_history(sid)
+
+    # The model is used for this request only
+    model = None
+    if req.model:
+        model = await asyncio.to_thread(get_chat_model, req.model)
+        if model is None:
+            raise HTTPException(
+                status_code=400, detail=f"Invalid model '{req.model}'")
+    return index_store, sid, history, model
+
+
+@app.post("/answer")
+async def answer(req: ChatReq):
+    """Answer to a user query."""
+    index_store, sid, history, model = await _prepare_answer(req)
 
     # Generate answer
-    ans = rag_service.answer(
+    ans = await rag_service.answer_async(
         index_store,
         req.question,
         top_k=req.top_k or TOP_K,
         history=history,
+        nprobe=req.nprobe,
+        ef_search=req.ef_search,
+        search_mode=req.search_mode,
+        model=model,
+        filters=_chunk_filter(req.filters),
     )
 
     if (isinstance(ans, ModelError)):
         if (ans == ModelError.InvalidModel):
-            rag_service.model = old_model
             raise HTTPException(
                 status_code=400, detail=f"Invalid model '{req.model}'")
         raise HTTPException(status_code=400, detail=str(ans))
 
-    # Add to history
-    history.append({"role": "user", "content": req.question})
-    history.append({"role": "assistant", "content": ans.answer})
-    if len(history) > _MAX_SESSION_MESSAGES:
-        history = history[-_MAX_SESSION_MESSAGES:]
-    with _SESSIONS_LOCK:
-        session = _SESSIONS.get(sid)
-        if session is None:
-            session = Session(id=sid, history=[], tokens_used=0)
-            _SESSIONS[sid] = session
-        session.id = sid
-        session.history = history
-        session.tokens_used += ans.tokens_used
-        tokens_used_total = session.tokens_used
+    tokens_used_total = await _save_turn(sid, req.question, ans)
 
     return {
         "answer": ans.answer,
         "sources": ans.sources,
         "session_id": sid,
         "tokens": ans.tokens_used,
-        "tokens_used_total": tokens_used_total
+        "tokens_used_total": tokens_used_total,
+        "cached": ans.cached,
     }
 
 
+def _model_error(err: ModelError, req: ChatReq) -> str:
+    """Message for the user about a failed answer."""
+    if err == ModelError.InvalidModel:
+        return f"Invalid model '{req.model}'"
+    if err == ModelError.RequestFailed:
+        return "The model failed to answer, try again later"
+    return str(err)
+
+
+def _sse(event: str, data: dict) -> str:
+    """Format a server-sent event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.post("/answer/stream")
+async def answer_stream(req: ChatReq):
+    """Answer to a user query as a stream of server-sent events.
+
+    Sends a `sources` event when retrieval is done, `token` events as the
+    answer is generated and a final `done` or `error` event.
+    """
+    index_store, sid, history, model = await _prepare_answer(req)
+
+    async def events():
+        # The response has started, errors can only be sent as events
+        try:
+            stream = rag_service.answer_stream(
+                index_store,
+                req.question,
+                top_k=req.top_k or TOP_K,
+                history=history,
+                nprobe=req.nprobe,
+                ef_search=req.ef_search,
+                search_mode=req.search_mode,
+                model=model,
+                filters=_chunk_filter(req.filters),
+            )
+            async for part in stream:
+                if isinstance(part, list):
+                    yield _sse("sources", {"sources": part, "session_id": sid})
+                elif isinstance(part, str):
+                    yield _sse("token", {"text": part})
+                elif isinstance(part, ModelError):
+                    yield _sse("error", {"detail": _model_error(part, req)})
+                else:
+                    tokens_used_total = await _save_turn(
+                        sid, req.question, part)
+                    yield _sse("done", {
+                        "answer": part.answer,
+                        "session_id": sid,
+                        "tokens": part.tokens_used,
+                        "tokens_used_total": tokens_used_total,
+                        "cached": part.cached,
+                    })
+        except Exception:
+            log.exception("Streaming answer failed")
+            yield _sse("error", {"detail": "Failed to generate an answer"})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.get("/")
 def home():
     path = _STATIC_DIR / "index.html"
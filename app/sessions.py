@@ -0,0 +1,331 @@
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from functools import lru_cache
+from pathlib import Path
+
+from config import (
+    DATA_DIR,
+    SESSION_BACKEND,
+    SESSION_DB,
+    SESSION_HISTORY_TOKENS,
+    SESSION_MAX,
+    SESSION_MAX_BYTES,
+    SESSION_TTL,
+)
+from context import ChatMessage, fit_history
+
+SESSION_BACKENDS = ("memory", "sqlite")
+
+# Bytes counted for a session on top of the text of its messages
+_SESSION_OVERHEAD = 256
+# Seconds between sweeps of expired sessions in the database
+_SWEEP_INTERVAL = 60.0
+
+
+@dataclass
+class Session:
+    id: str
+    history: list[ChatMessage] = field(default_factory=list)
+    tokens_used: int = 0
+    # time.time() of the last saved turn
+    updated_at: float = 0.0
+
+    def size(self) -> int:
+        """Approximate memory use of the session in bytes."""
+        return _SESSION_OVERHEAD + sum(
+            len(m.get("content") or "") + 16 for m in self.history)
+
+
+def compact_history(history: list[ChatMessage], max_tokens: int) -> list[ChatMessage]:
+    """Drop the oldest messages until the history fits in max_tokens.
+
+    The kept history starts with a question, an answer without its
+    question is dropped as well.
+    """
+    kept = fit_history(history, max_tokens, len(history))
+    while kept and kept[0].get("role") != "user":
+        kept = kept[1:]
+    return kept
+
+
+class SessionStore(ABC):
+    """Chat sessions that expire ttl seconds after their last turn.
+
+    Subclasses keep the sessions in memory or in a shared database. The
+    history of a session is compacted to max_tokens tokens when a turn is
+    added.
+    """
+
+    def __init__(self, ttl: float, max_sessions: int, max_tokens: int) -> None:
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_tokens = max_tokens
+
+    @abstractmethod
+    def get(self, sid: str) -> Session | None:
+        """Return a copy of a live session, None if there is none."""
+
+    @abstractmethod
+    def add_turn(
+        self,
+        sid: str,
+        messages: list[ChatMessage],
+        tokens_used: int,
+    ) -> Session:
+        """Append messages to a session, creating it if needed."""
+
+    @abstractmethod
+    def delete(self, sid: str) -> None:
+        """Delete a session."""
+
+    @abstractmethod
+    def stats(self) -> dict:
+        """Return the size of the store."""
+
+    def _expired(self, session: Session, now: float) -> bool:
+        return self.ttl > 0 and now - session.updated_at > self.ttl
+
+    def _append(
+        self,
+        session: Session,
+        messages: list[ChatMessage],
+        tokens_used: int,
+        now: float,
+    ) -> Session:
+        return Session(
+            id=session.id,
+            history=compact_history(
+                session.history + list(messages), self.max_tokens),
+            tokens_used=session.tokens_used + tokens_used,
+            updated_at=now,
+        )
+
+
+class MemorySessionStore(SessionStore):
+    """Sessions of this process in an LRU dict.
+
+    The least recently used sessions are evicted when there are more than
+    max_sessions or their messages take more than max_bytes.
+    """
+
+    def __init__(
+        self,
+        ttl: float,
+        max_sessions: int,
+        max_tokens: int,
+        max_bytes: int,
+    ) -> None:
+        super().__init__(ttl, max_sessions, max_tokens)
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # Least recently used first
+        self._sessions: OrderedDict[str, Session] = OrderedDict()
+        self._bytes = 0
+
+    def get(self, sid: str) -> Session | None:
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            session = self._sessions.get(sid)
+            if session is None:
+                return None
+            if self._expired(session, now):
+                # Used sessions move to the end, they are not ordered by age
+                self._drop(sid)
+                return None
+            self._sessions.move_to_end(sid)
+            return Session(session.id, list(session.history),
+                           session.tokens_used, session.updated_at)
+
+    def add_turn(
+        self,
+        sid: str,
+        messages: list[ChatMessage],
+        tokens_used: int,
+    ) -> Session:
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            old = self._drop(sid)
+            if old is not None and self._expired(old, now):
+                old = None
+            session = self._append(old or Session(sid), messages,
+                                   tokens_used, now)
+            self._sessions[sid] = session
+            self._bytes += session.size()
+            while len(self._sessions) > 1 and (
+                    len(self._sessions) > self.max_sessions
+                    or self._bytes > self.max_bytes):
+                _sid, evicted = self._sessions.popitem(last=False)
+                self._bytes -= evicted.size()
+                self.evictions += 1
+            return Session(session.id, list(session.history),
+                           session.tokens_used, session.updated_at)
+
+    def _expire(self, now: float) -> None:
+        """Drop the expired sessions at the head of the LRU. Needs the lock.
+
+        Sessions read after their last turn may sit behind newer ones, they
+        are checked when they are used.
+        """
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if not self._expired(session, now):
+                break
+            self._sessions.popitem(last=False)
+            self._bytes -= session.size()
+
+    def _drop(self, sid: str) -> Session | None:
+        """Remove a session and return it. Needs the lock."""
+        session = self._sessions.pop(sid, None)
+        if session is not None:
+            self._bytes -= session.size()
+        return session
+
+    def delete(self, sid: str) -> None:
+        with self._lock:
+            self._drop(sid)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "backend": "memory",
+                "sessions": len(self._sessions),
+                "max_sessions": self.max_sessions,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+            }
+
+
+class SqliteSessionStore(SessionStore):
+    """Sessions in a SQLite database shared by all server processes.
+
+    Turns are added in a write transaction, so concurrent requests of a
+    session on different workers do not lose each other's messages.
+    Expired sessions and the least recently used ones over max_sessions
+    are deleted every _SWEEP_INTERVAL seconds.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        ttl: float,
+        max_sessions: int,
+        max_tokens: int,
+    ) -> None:
+        super().__init__(ttl, max_sessions, max_tokens)
+        self.path = path
+        self._local = threading.local()
+        self._swept_at = 0.0
+        path.parent.mkdir(parents=True, exist_ok=True)
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "id TEXT PRIMARY KEY, history TEXT NOT NULL, "
+            "tokens_used INTEGER NOT NULL, updated_at REAL NOT NULL)")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS sessions_updated_at "
+            "ON sessions (updated_at)")
+
+    def _conn(self) -> sqlite3.Connection:
+        """Return the connection of the calling thread."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30,
+                                   isolation_level=None)
+            # Readers do not block the writer of another process
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, sid: str) -> Session | None:
+        row = self._conn().execute(
+            "SELECT history, tokens_used, updated_at FROM sessions "
+            "WHERE id = ?", (sid,)).fetchone()
+        if row is None:
+            return None
+        session = Session(sid, json.loads(row[0]), row[1], row[2])
+        return None if self._expired(session, time.time()) else session
+
+    def add_turn(
+        self,
+        sid: str,
+        messages: list[ChatMessage],
+        tokens_used: int,
+    ) -> Session:
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT history, tokens_used, updated_at FROM sessions "
+                "WHERE id = ?", (sid,)).fetchone()
+            old = Session(sid, json.loads(row[0]), row[1], row[2]) \
+                if row is not None else Session(sid)
+            if self._expired(old, now):
+                old = Session(sid)
+            session = self._append(old, messages, tokens_used, now)
+            conn.execute(
+                "INSERT INTO sessions (id, history, tokens_used, updated_at) "
+                "VALUES (?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET "
+                "history = excluded.history, "
+                "tokens_used = excluded.tokens_used, "
+                "updated_at = excluded.updated_at",
+                (sid, json.dumps(session.history), session.tokens_used, now))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        if now - self._swept_at > _SWEEP_INTERVAL:
+            self._sweep(now)
+        return session
+
+    def _sweep(self, now: float) -> None:
+        self._swept_at = now
+        conn = self._conn()
+        if self.ttl > 0:
+            conn.execute("DELETE FROM sessions WHERE updated_at < ?",
+                         (now - self.ttl,))
+        conn.execute(
+            "DELETE FROM sessions WHERE id IN (SELECT id FROM sessions "
+            "ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+            (max(1, self.max_sessions),))
+
+    def delete(self, sid: str) -> None:
+        self._conn().execute("DELETE FROM sessions WHERE id = ?", (sid,))
+
+    def stats(self) -> dict:
+        (count,) = self._conn().execute(
+            "SELECT COUNT(*) FROM sessions").fetchone()
+        return {
+            "backend": "sqlite",
+            "sessions": count,
+            "max_sessions": self.max_sessions,
+        }
+
+
+@lru_cache(maxsize=1)
+def get_session_store() -> SessionStore:
+    """Return the session store picked by SESSION_BACKEND."""
+    if SESSION_BACKEND == "memory":
+        return MemorySessionStore(SESSION_TTL, SESSION_MAX,
+                                  SESSION_HISTORY_TOKENS, SESSION_MAX_BYTES)
+    if SESSION_BACKEND == "sqlite":
+        path = Path(SESSION_DB) if SESSION_DB \
+            else Path(DATA_DIR) / "sessions.sqlite3"
+        return SqliteSessionStore(path, SESSION_TTL, SESSION_MAX,
+                                  SESSION_HISTORY_TOKENS)
+    raise ValueError(
+        f"Unknown session backend '{SESSION_BACKEND}', expected one of "
+        f"{', '.join(SESSION_BACKENDS)}"
+    )
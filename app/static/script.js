@@ -97,11 +97,34 @@ async function ingestSites() {
     return;
   }
 
-  const body = await readBody(res);
+  let body = await readBody(res);
   console.log(body)
-  ingestOut.textContent = JSON.stringify(body, null, 2);
+  if (!res.ok) {
+    ingestOut.textContent = JSON.stringify(body, null, 2);
+    return;
+  }
+
+  // Poll the ingest job until it has finished
+  while (body.status === "queued" || body.status === "running") {
+    const stage = body.stage ? ` (${body.stage})` : "";
+    const p = body.progress;
+    const rate = body.crawl ? ` (${body.crawl.pages_per_sec} pages/s)` : "";
+    ingestOut.textContent = `Ingesting${stage}... pages: ${p.pages}${rate}, chunks: ${p.chunks}, embedded: ${p.embedded}, indexed: ${p.indexed}`;
+    await new Promise((r) => setTimeout(r, 1000));
+    try {
+      res = await fetch(`/jobs/${body.job_id}`);
+    } catch (e) {
+      ingestOut.textContent = String(e);
+      return;
+    }
+    body = await readBody(res);
+    if (!res.ok) break;
+  }
+
+  ingestOut.textContent = JSON.stringify(
+    body.status === "done" ? body.result : body, null, 2);
 
-  if (res.ok) {
+  if (body.status === "done") {
     getIngestedSites();
   }
 }
@@ -111,43 +134,91 @@ async function handleAsk() {
   tokensUsed.textContent = "Tokens used: - | Total: -";
   const question = textAsk.value;
 
-  const res = await fetch("/answer", {
-    method: "POST",
-    headers: { "Content-Type": "application/json" },
-    body: JSON.stringify({
-      question: question,
-      session_id: sessionId,
-      model: selected_model_id,
-    }),
-  }).catch((e) => {
-    ingestOut.textContent = String(e);
+  let res;
+  try {
+    res = await fetch("/answer/stream", {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({
+        question: question,
+        session_id: sessionId,
+        model: selected_model_id,
+      }),
+    });
+  } catch (e) {
+    answerOut.textContent = String(e);
     return;
-  });
+  }
 
-  const body = await readBody(res);
   if (!res.ok) {
+    const body = await readBody(res);
     answerOut.textContent = JSON.stringify(body, null, 2);
     return;
   }
-  console.log(body)
-
-  tokensUsed.textContent = `Tokens used: ${body.tokens} | Total: ${body.tokens_used_total}`;
 
-  let out = body.answer;
-  if (body.session_id) {
-    sessionId = body.session_id;
-    localStorage.setItem("sessionId", sessionId)
-  }
+  let answer = "";
+  let sources = [];
+  const render = () => {
+    let out = answer;
+    if (sources.length) {
+      out += "\n\nSources:\n"
+      let i = 1;
+      for (const s of sources) {
+        out += `[${i}] ${s}\n`;
+        i++;
+      }
+    }
+    answerOut.textContent = out;
+  };
+
+  await readEvents(res, (event, data) => {
+    if (event === "sources") {
+      sources = data.sources || [];
+      setSession(data.session_id);
+    } else if (event === "token") {
+      answer += data.text;
+      render();
+    } else if (event === "done") {
+      answer = data.answer;
+      tokensUsed.textContent = `Tokens used: ${data.tokens} | Total: ${data.tokens_used_total}` +
+        (data.cached ? " | cached" : "");
+      setSession(data.session_id);
+      render();
+    } else if (event === "error") {
+      answerOut.textContent = JSON.stringify(data, null, 2);
+    }
+  });
+}
 
-  if (body.sources) {
-    out += "\n\nSources:\n"
-    let i = 1;
-    for (const s of body.sources) {
-      out += `[${i}] ${s}\n`;
-      i++;
+// Read server-sent events from a streaming response
+async function readEvents(res, onEvent) {
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buf = "";
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buf += decoder.decode(value, { stream: true });
+
+    let end;
+    while ((end = buf.indexOf("\n\n")) >= 0) {
+      const block = buf.slice(0, end);
+      buf = buf.slice(end + 2);
+      let event = "message";
+      let data = "";
+      for (const line of block.split("\n")) {
+        if (line.startsWith("event: ")) event = line.slice(7);
+        else if (line.startsWith("data: ")) data += line.slice(6);
+      }
+      if (data) onEvent(event, JSON.parse(data));
     }
   }
-  answerOut.textContent = out;
+}
+
+function setSession(id) {
+  if (!id) return;
+  sessionId = id;
+  localStorage.setItem("sessionId", sessionId)
 }
 
 async function initState() {
@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+import logging
+import re
+from functools import lru_cache
+
+from config import TOKENIZER_ENCODING
+
+try:
+    import tiktoken
+except ImportError:  # optional, counts are estimated without it
+    tiktoken = None
+
+log = logging.getLogger(__name__)
+
+# Word pieces of up to four characters and single symbols, close to one
+# token each for English text
+_PIECE_RE = re.compile(r"\w{1,4}|[^\w\s]")
+
+
+@lru_cache(maxsize=None)
+def _encoding(name: str):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding(name)
+    except Exception as e:
+        # The encoding files are downloaded on first use
+        log.warning("Tokenizer %s not available, estimating tokens: %s", name, e)
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """Return the amount of tokens in a text.
+
+    Uses the TOKENIZER_ENCODING of tiktoken when it is available and a
+    regex estimate otherwise.
+    """
+    enc = _encoding(TOKENIZER_ENCODING)
+    if enc is not None:
+        return len(enc.encode_ordinary(text))
+    return len(_PIECE_RE.findall(text))
+
+
+def count_tokens_max(text: str) -> int:
+    """Return the amount of tokens in a text, never less than the real count.
+
+    Exact with tiktoken. The regex estimate undercounts code, urls and
+    non-English text, so without tiktoken a text counts at least one token
+    per 3 characters as well.
+    """
+    if _encoding(TOKENIZER_ENCODING) is not None:
+        return count_tokens(text)
+    return max(count_tokens(text), -(-len(text) // 3))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """Return the start of text that has at most max_tokens tokens."""
+    enc = _encoding(TOKENIZER_ENCODING)
+    if enc is not None:
+        ids = enc.encode_ordinary(text)
+        return text if len(ids) <= max_tokens else enc.decode(ids[:max_tokens])
+    while text and (n := count_tokens_max(text)) > max_tokens:
+        text = text[:int(len(text) * max_tokens / n * 0.95)]
+    return text
@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import TypeVar
+
+import numpy as np
+
+from chunker import text_spans
+from config import INGEST_PROCESS_NICE, INGEST_PROCESSES
+from dedup import signatures
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+_POOL: ProcessPoolExecutor | None = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_pool() -> ProcessPoolExecutor | None:
+    """Return the process pool for CPU heavy ingest work.
+
+    None if INGEST_PROCESSES is 0, the work then runs in threads of the
+    server process.
+    """
+    global _POOL
+    if INGEST_PROCESSES <= 0:
+        return None
+    with _POOL_LOCK:
+        if _POOL is None:
+            # Forking a process with running threads is unsafe, the workers
+            # are forked from a clean server process instead
+            methods = multiprocessing.get_all_start_methods()
+            ctx = multiprocessing.get_context(
+                "forkserver" if "forkserver" in methods else "spawn")
+            _POOL = ProcessPoolExecutor(
+                max_workers=INGEST_PROCESSES,
+                mp_context=ctx,
+                initializer=_init_worker,
+                initargs=(INGEST_PROCESS_NICE,),
+            )
+        return _POOL
+
+
+def shutdown_pool() -> None:
+    global _POOL
+    with _POOL_LOCK:
+        pool, _POOL = _POOL, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _init_worker(nice: int) -> None:
+    # Queries served by the server process get the CPU first
+    if nice and hasattr(os, "nice"):
+        os.nice(nice)
+
+
+async def run_cpu(fn: Callable[..., T], *args) -> T:
+    """Run fn(*args) in the process pool without blocking the event loop.
+
+    fn must be a module level function, its arguments and result are
+    pickled. A pool broken by a crashed worker is replaced on the next call.
+    """
+    global _POOL
+    pool = get_pool()
+    if pool is None:
+        return await asyncio.to_thread(fn, *args)
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, fn, *args)
+    except BrokenProcessPool:
+        log.warning("Ingest worker process died, restarting the pool")
+        with _POOL_LOCK:
+            if _POOL is pool:
+                _POOL = None
+        raise
+
+
+def chunk_offsets(
+    text: str,
+    chunker: str,
+    min_words: int,
+) -> tuple[np.ndarray, list[str], np.ndarray]:
+    """Chunk a page text and compute the signatures of the chunks.
+
+    Returns the (start, end) offsets of the chunks in text, their headings
+    and signatures. The chunk texts are not sent back, they are slices of
+    the text the caller already has.
+    """
+    spans = text_spans(text, chunker)
+    offsets = np.array([(s.start, s.end) for s in spans],
+                       dtype=np.int64).reshape(-1, 2)
+    sigs = signatures([s.text for s in spans], min_words)
+    return offsets, [s.heading for s in spans], sigs